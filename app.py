@@ -1,24 +1,48 @@
 import os
+from datetime import date
+from io import TextIOWrapper
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify
-from sqlalchemy import func
+from flask import Flask, request, jsonify, Response
+from sqlalchemy import delete, func, select
 from models import db, connect_db, Listing, User, Message, Booking
+from models import LISTING_DETAIL_PLAN, USER_DETAIL_PLAN
+from models import LISTING_SUMMARY_COLUMNS, BOOKING_COLUMNS, MESSAGE_COLUMNS
+from models import DEFAULT_IMAGE_URL, GEOCODE_PENDING
 from sqlalchemy.exc import IntegrityError
-from awsUpload import uploadFileToS3
+from awsUpload import uploadFileToS3, AMAZON_BASE_URL
+from imagePipeline import ImagePipeline
+from queryTrace import QueryTracer
+from metrics import metrics
+from identity import IdentityCache
+from passwords import password_hasher, PasswordPoolSaturated
+from responseCache import response_cache, listing_tags, listings_tags
+from responseCache import messages_tags, nearby_tags
+from pagination import paginate_by_id, paginate_by_keys, get_page_size
+from pagination import paginate_union_by_keys, InvalidCursor
+from search import search_listings, nearby_listings, within_bbox, parse_bbox
+from search import available_between, price_between, MAX_RADIUS_KM
 from flask_json_schema import JsonSchema, JsonValidationError
 from schemas.userschema import user_schema
 from flask_cors import CORS
-# from geoCoder import geoCoder
-from geoCode import getGeoCode
+from geocodeWorker import GeocodeWorker
+from jsonProvider import init_json
+from listingImport import ListingImporter, IMPORT_FORMATS
+from dbPool import engine_options, init_pool_metrics
+from readReplicas import ReplicaRouter
+from schemaMigrations import init_migrations
+from messageStream import MessageStream, conversations_of
+from messageStream import lock_message_order, notify_message
+from dataLoader import init_loader, request_loader, parse_keys
+from dataLoader import MAX_BATCH_KEYS
+from fieldsets import parse_fieldset, FieldsetError, LISTING_SUMMARY_FIELDS
 
 from flask_jwt_extended import create_access_token
 from flask_jwt_extended import current_user
 from flask_jwt_extended import jwt_required
 from flask_jwt_extended import JWTManager
 
-AMAZON_BASE_URL = "https://sharebnb-bucket.s3.us-west-1.amazonaws.com"
-
 app = Flask(__name__)
+init_json(app)
 CORS(app)
 
 database_url = os.environ['DATABASE_URL']
@@ -26,13 +50,36 @@ database_url = database_url.replace('postgres://', 'postgresql://')
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get(
     "DATABASE_URL", "postgresql:///sharebnb")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ECHO"] = True
+# Echoing every statement to stdout is slow; only do it when debugging.
+# QueryTracer reports query counts and slow statements in production.
+app.config["SQLALCHEMY_ECHO"] = app.debug
+app.config["SQL_TRACE_SLOW_MS"] = float(
+    os.environ.get("SQL_TRACE_SLOW_MS", 100))
+app.config["SQL_TRACE_SAMPLE_RATE"] = float(
+    os.environ.get("SQL_TRACE_SAMPLE_RATE", 0.1))
 app.config["JWT_SECRET_KEY"] = os.environ["JWT_SECRET_KEY"]
+# Raising the cost factor upgrades each user's hash at their next login.
+app.config["BCRYPT_LOG_ROUNDS"] = int(os.environ.get("BCRYPT_LOG_ROUNDS", 12))
 app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+# Pool size, timeouts, pre-ping and pgbouncer mode come from DB_* env vars.
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(database_url)
 
 schema=JsonSchema(app)
 jwt = JWTManager(app)
+identity_cache = IdentityCache()
+password_hasher.init_app(app)
+response_cache.init_app(app)
 connect_db(app)
+init_migrations(app)
+init_pool_metrics(app)
+# Reads go to DATABASE_REPLICA_URLS when set; see readReplicas.py.
+replica_router = ReplicaRouter(app)
+query_tracer = QueryTracer(app)
+geocode_worker = GeocodeWorker(app)
+image_pipeline = ImagePipeline(app)
+listing_importer = ListingImporter(app, geocode_worker, image_pipeline)
+message_stream = MessageStream(app)
+init_loader(app)
 load_dotenv()
 
 
@@ -40,10 +87,25 @@ load_dotenv()
 def validation_error(e):
     return jsonify({ 'error': e.message, 'errors': [validation_error.message for validation_error  in e.errors]})
 
+@app.errorhandler(PasswordPoolSaturated)
+def password_pool_saturated(e):
+    """Shed signup/login load fast instead of queueing behind bcrypt."""
+
+    message = {'message': "Too many logins at once, try again shortly"}
+    return (jsonify(error=message), 503, {'Retry-After': '1'})
+
+@app.errorhandler(FieldsetError)
+def fieldset_error(e):
+    message = {'message': str(e)}
+    return (jsonify(error=message), 400)
+
 @jwt.user_lookup_loader
 def user_lookup_callback(_jwt_header, jwt_data):
+    """Resolve the token to a cached Principal (username, is_host), so
+    authenticated routes don't query users on every call."""
+
     identity = jwt_data.get('sub')["username"]
-    return User.query.filter_by(username=identity).one_or_none()
+    return identity_cache.lookup(identity, jwt_data.get('ver', 0))
 
 ##############################################################################
 # auth routes:
@@ -89,7 +151,9 @@ def signup():
     
 
     if user:
-        encoded_jwt = create_access_token(identity=user.serialize())
+        encoded_jwt = create_access_token(
+            identity=user.serialize(),
+            additional_claims={'ver': user.token_version})
         return (jsonify(token=encoded_jwt), 201)
 
     message = {'message': "Invalid credentials"}
@@ -114,13 +178,109 @@ def login():
     )
 
     if user:
-        encoded_jwt = create_access_token(identity=user.serialize())
+        encoded_jwt = create_access_token(
+            identity=user.serialize(),
+            additional_claims={'ver': user.token_version})
         return jsonify(token=encoded_jwt)
 
     message = {'message': "Invalid credentials"}
 
     return (jsonify(error=message), 401)
 
+##############################################################################
+# Batch reads:
+
+# Batchable kinds: model and key type.
+BATCH_KINDS = {
+    'listings': (Listing, int),
+    'bookings': (Booking, int),
+    'users': (User, str),
+}
+
+
+def batch_read(model, keys, fieldset=None):
+    """Serialize the rows of `model` for `keys` through the request's loader,
+    with just `fieldset`'s columns and includes if given.
+
+    Returns (serialized rows in key order, keys that were not found).
+    """
+
+    loader = request_loader()
+    if fieldset:
+        loader.select(model, fieldset.columns())
+
+    rows = loader.get_many(model, keys)
+    found = [row for row in rows if row is not None]
+    missing = [key for key, row in zip(keys, rows) if row is None]
+
+    if fieldset:
+        return fieldset.serialize_all(found), missing
+
+    return [row.serialize() for row in found], missing
+
+
+def batch_keys_error(name):
+    message = {'message': f"{name} must be at most {MAX_BATCH_KEYS} "
+               "comma-separated values"}
+    return (jsonify(error=message), 400)
+
+
+@app.post('/batch')
+def batch():
+    """Read listings, bookings and users in one call, by id or username.
+    receives a json (every key optional)
+        {"listings": [id, ...], "bookings": [id, ...], "users": [username, ...]}
+    returns a json
+        {
+            "listings": [listing, ...], "bookings": [booking, ...],
+            "users": [user, ...],
+            "missing": {"listings": [id, ...], "bookings": [...], "users": [...]}
+        }
+    for the kinds asked for. Each kind is read with one query, however many
+    keys it has, and repeated keys are read once. Sparse fieldsets are
+    given per kind: ?fields[listings]=id,title&include[users]=listings.
+    """
+
+    data = request.get_json(silent=True)
+
+    if not isinstance(data, dict) or not set(data) <= set(BATCH_KINDS):
+        message = {'message': f"Send a json object with any of: "
+                   f"{', '.join(BATCH_KINDS)}"}
+        return (jsonify(error=message), 400)
+
+    requested = {}
+
+    for kind, keys in data.items():
+        model, key_type = BATCH_KINDS[kind]
+
+        if (not isinstance(keys, list) or len(keys) > MAX_BATCH_KEYS
+                or not all(type(key) is key_type for key in keys)):
+            message = {'message': f"{kind} must be a list of at most "
+                       f"{MAX_BATCH_KEYS} {key_type.__name__} keys"}
+            return (jsonify(error=message), 400)
+
+        requested[kind] = list(dict.fromkeys(keys))
+
+    fieldsets = {kind: parse_fieldset(request.args, kind, typed=True)
+                 for kind in requested}
+
+    # Queue every kind before reading any, so each is one query.
+    loader = request_loader()
+    for kind, keys in requested.items():
+        model = BATCH_KINDS[kind][0]
+        if fieldsets[kind]:
+            loader.select(model, fieldsets[kind].columns())
+        loader.want(model, keys)
+
+    response = {'missing': {}}
+
+    for kind, keys in requested.items():
+        response[kind], response['missing'][kind] = batch_read(
+            BATCH_KINDS[kind][0], keys, fieldsets[kind])
+
+    return jsonify(response)
+
+
 ##############################################################################
 # User routes:
 
@@ -136,9 +296,27 @@ def get_user(username):
             "listing": [listing, listing],
         }
     }
+
+    Takes ?fields= and ?include= (see fieldsets.py), e.g.
+    ?fields=username,first_name&include=listings.
     """
 
-    user = User.query.get(username)
+    fieldset = parse_fieldset(request.args, 'users')
+
+    if fieldset:
+        rows = (db.session.query(*fieldset.columns())
+                .filter(User.username == username)
+                .all())
+        if rows:
+            return jsonify(user=fieldset.serialize_all(rows)[0])
+
+        message = {'message': f"No user: {username}"}
+        return (jsonify(error=message), 404)
+
+    user = (User.query
+            .options(*USER_DETAIL_PLAN)
+            .filter_by(username=username)
+            .one_or_none())
 
     if user:
         json_user = user.serialize()
@@ -155,9 +333,31 @@ def get_users():
     {
         "users": [{user}, {user}, {user}]
     }
+
+    With `usernames=a,b,c`, returns just those users, in that order:
+        {"users": [{user}, ...], "missing": [username, ...]}
+
+    Takes ?fields= and ?include= (see fieldsets.py).
     """
 
-    users = [user.serialize() for user in User.query.all()]
+    usernames = request.args.get('usernames')
+    fieldset = parse_fieldset(request.args, 'users')
+
+    if usernames is not None:
+        try:
+            keys = parse_keys(usernames)
+        except ValueError:
+            return batch_keys_error('usernames')
+
+        users, missing = batch_read(User, keys, fieldset)
+        return jsonify(users=users, missing=missing)
+
+    if fieldset:
+        rows = db.session.query(*fieldset.columns()).all()
+        return jsonify(user=fieldset.serialize_all(rows))
+
+    users = [user.serialize()
+             for user in User.query.options(*USER_DETAIL_PLAN).all()]
 
     return jsonify(user=users)
 
@@ -173,7 +373,7 @@ def update_user(username):
         } 
     """
 
-    if current_user != username:
+    if current_user.username != username:
         return jsonify({"error": "Invalid Authorization"})
 
     data = request.json
@@ -186,6 +386,9 @@ def update_user(username):
     user.is_host = bool(data.get('isHost', user.is_host))
 
     db.session.commit()
+    identity_cache.invalidate(user.username, user.token_version)
+    # Listing and message pages may embed the user (?include=host).
+    response_cache.invalidate('users')
 
     return jsonify(user=user.serialize())
 
@@ -197,11 +400,31 @@ def delete_user(username):
     Returns JSON of {message: "delete successfully"}
     """
 
-    user = User.query.get(username)
-
-    if user:
-        db.session.delete(user)
+    # Only the ids of their listings, and of listings they booked or
+    # messaged on, are read; the database deletes the user's listings,
+    # bookings and messages through ON DELETE CASCADE.
+    listing_ids = db.session.scalars(
+        select(Listing.id).where(Listing.username == username)
+        .union(select(Booking.property_id)
+               .where(Booking.username == username),
+               select(Message.property_id)
+               .where(Message.from_username == username))
+    ).all()
+    token_version = db.session.execute(
+        delete(User)
+        .where(User.username == username)
+        .returning(User.token_version)
+    ).scalar_one_or_none()
+
+    if token_version is not None:
         db.session.commit()
+        identity_cache.invalidate(username, token_version)
+        # Their messages leave every conversation they were in, and their
+        # bookings every listing they stayed at.
+        response_cache.invalidate(
+            'listings', 'users', 'bookings', 'messages',
+            *(tag for id in listing_ids
+              for tag in (f'listing:{id}', f'messages:{id}')))
 
         return jsonify(message='delete successfully')
 
@@ -221,8 +444,11 @@ def create_listing():
     return a json
         {
         "listing": {"city", "country", "details", "id", "image_url", "price_per_night",
-            "state", "street", "title", "username", "zip"}
+            "state", "street", "title", "username", "zip", "geocode_status"}
         } 
+    The listing is saved right away with geocode_status "pending" and no
+    coordinates; the background geocoder fills them in. Resized variants of
+    the image show up in "image_srcset" once the image pipeline is done.
     """
     image = request.files.get('image', None)
 
@@ -234,28 +460,67 @@ def create_listing():
         image_url = uploadFileToS3(image)
         full_url = f"{AMAZON_BASE_URL}/{image_url}"
 
-    lng_lat = getGeoCode(f"{form.get('street')} {form.get('city')}")
-
     new_listing = Listing(
         title=form['title'],
         details=form['details'],
         street=form['street'],
         city=form['city'],
         state=form['state'],
-        latitude=lng_lat['latitude'],
-        longitude=lng_lat['longitude'],
         zip=form['zip'],
         country=form['country'],
         price_per_night=form['price_per_night'],
-        image_url=full_url,
+        image_url=full_url or DEFAULT_IMAGE_URL,
         username=form['username'])
 
     db.session.add(new_listing)
     db.session.commit()
+    response_cache.invalidate('listings')
+
+    if full_url:
+        image.stream.seek(0)
+        image_pipeline.submit(new_listing.id, image.read(), full_url)
+
+    # Coordinates are filled in by the background geocoder; until then the
+    # listing is "pending" and left out of map searches.
+    geocode_worker.submit(new_listing.id)
 
     return (jsonify(listing=new_listing.serialize()), 201)
 
 
+@app.post('/listings/import')
+@jwt_required()
+def import_listings():
+    """Bulk-create listings for the logged-in host from a CSV (with a header
+    row) or NDJSON request body, sent as text/csv or application/x-ndjson.
+    Each record has the create_listing fields, with an optional image_url
+    and latitude/longitude. Any username in the records is ignored.
+    returns a json
+        {
+            "imported", "geocoded", "pending_geocode", "images",
+            "errors": [{"row", "message"}, ...]
+        }
+    Invalid records are listed in "errors" and the rest are still imported.
+    """
+
+    formats = {'text/csv': 'csv', 'application/x-ndjson': 'ndjson'}
+    format = formats.get(request.mimetype, request.args.get('format'))
+
+    if format not in IMPORT_FORMATS:
+        message = {'message': "Send text/csv or application/x-ndjson"}
+        return (jsonify(error=message), 415)
+
+    stream = TextIOWrapper(request.stream, encoding='utf-8', newline='')
+
+    try:
+        report = listing_importer.run(
+            stream, format, username=current_user.username)
+    except UnicodeDecodeError:
+        message = {'message': "Body must be UTF-8"}
+        return (jsonify(error=message), 400)
+
+    return (jsonify(report.serialize()), 201)
+
+
 @app.patch('/listings/<int:id>')
 def update_listing(id):
     """Update listing from data in request. Returns updated data.
@@ -279,19 +544,40 @@ def update_listing(id):
         full_url = f"{AMAZON_BASE_URL}/{image_url}"
 
     if listing:
-        listing.title = form.get('title', listing.title),
-        listing.details = form.get('details', listing.details),
-        listing.street = form.get('street', listing.street),
-        listing.city = form.get('city', listing.city),
-        listing.state = form.get('state', listing.state),
-        listing.zip = form.get('zip', listing.zip),
-        listing.country = form.get('country', listing.country),
+        old_address = (listing.street, listing.city)
+
+        listing.title = form.get('title', listing.title)
+        listing.details = form.get('details', listing.details)
+        listing.street = form.get('street', listing.street)
+        listing.city = form.get('city', listing.city)
+        listing.state = form.get('state', listing.state)
+        listing.zip = form.get('zip', listing.zip)
+        listing.country = form.get('country', listing.country)
         listing.price_per_night = form.get(
-            'price_per_night', listing.price_per_night),
+            'price_per_night', listing.price_per_night)
         listing.image_url = full_url or listing.image_url
+
+        if full_url:
+            # The old variants are of the old image; new ones are on the way.
+            listing.image_variants = None
         listing.username = form.get('username', listing.username)
 
+        address_changed = (listing.street, listing.city) != old_address
+
+        if address_changed:
+            listing.latitude = None
+            listing.longitude = None
+            listing.geocode_status = GEOCODE_PENDING
+
         db.session.commit()
+        response_cache.invalidate(f'listing:{id}', 'listings')
+
+        if address_changed:
+            geocode_worker.submit(listing.id)
+
+        if full_url:
+            image.stream.seek(0)
+            image_pipeline.submit(listing.id, image.read(), full_url)
 
         return (jsonify(listing=listing.serialize()), 200)
 
@@ -301,32 +587,183 @@ def update_listing(id):
 
 
 @app.get('/listings')
+@response_cache.cached(tags=listings_tags)
 def get_listings():
-    """Get all listings from database or filter if there is a query string passed in 
-    returns an json with a list of users
+    """Get a page of listings, optionally searched with a query string `q`.
+
+    Accepts `limit` (default 20, max 100) and `cursor` (the `next` value
+    from the previous page). Returns compact listings, without nested
+    messages and bookings:
     {
-        "listings": [{listing}, {listing}, {listing}]
+        "listings": [{listing}, {listing}, {listing}],
+        "next": "eyJpZCI6MjB9" or null
     }
+
+    With `q`, listings whose title, city, state or details match are
+    returned most relevant first. These filters narrow the results and can
+    be combined:
+        bbox=min_lng,min_lat,max_lng,max_lat  listings inside the box
+        min_price=, max_price=                price_per_night bounds
+        available_from=, available_to=        no booking overlaps the stay
+                                              (YYYY-MM-DD, check-out day free)
+
+    Pass `full=true` for the old unpaginated response of fully serialized
+    listings.
+
+    With `ids=1,2,3`, returns just those listings, fully serialized and in
+    that order:
+        {"listings": [{listing}, ...], "missing": [id, ...]}
+
+    Takes ?fields= and ?include= (see fieldsets.py); pages default to the
+    summary fields, `ids` and `full` to all of them.
     """
 
-    searchTerm = request.args.get('q', None)
+    ids = request.args.get('ids')
+    full = request.args.get('full') == 'true'
+    fieldset = parse_fieldset(
+        request.args, 'listings',
+        None if full or ids is not None else LISTING_SUMMARY_FIELDS)
 
-    if searchTerm:
+    if ids is not None:
+        try:
+            keys = parse_keys(ids, int)
+        except ValueError:
+            return batch_keys_error('ids')
 
-        filtered_listing = [listing.serialize() for listing in Listing.query
-                            .filter(func
-                                    .lower(Listing.title)
-                                    .contains(searchTerm.lower()))
-                                    .all()
-                            ]
-        return jsonify(listings=filtered_listing)
+        listings, missing = batch_read(Listing, keys, fieldset)
+        return jsonify(listings=listings, missing=missing)
+
+    searchTerm = request.args.get('q', None)
+    bbox = request.args.get('bbox', None)
+
+    # Pages of summaries only need a few columns; skip building entities.
+    if fieldset:
+        query = db.session.query(*fieldset.columns())
+    elif full:
+        query = Listing.query
+    else:
+        query = db.session.query(*LISTING_SUMMARY_COLUMNS)
+
+    if bbox:
+        try:
+            query = within_bbox(query, *parse_bbox(bbox))
+        except ValueError:
+            message = {'message': "bbox must be min_lng,min_lat,max_lng,max_lat"}
+            return (jsonify(error=message), 400)
+
+    try:
+        min_price = request.args.get('min_price', None)
+        max_price = request.args.get('max_price', None)
+        query = price_between(
+            query,
+            min_price=None if min_price is None else int(min_price),
+            max_price=None if max_price is None else int(max_price))
+    except ValueError:
+        message = {'message': "min_price and max_price must be whole numbers"}
+        return (jsonify(error=message), 400)
+
+    try:
+        available_from = request.args.get('available_from', None)
+        available_to = request.args.get('available_to', None)
+
+        if available_from or available_to:
+            check_in = date.fromisoformat(available_from)
+            check_out = date.fromisoformat(available_to)
+            if check_in >= check_out:
+                raise ValueError
+            query = available_between(query, check_in, check_out)
+    except (TypeError, ValueError):
+        message = {'message': "available_from and available_to must be "
+                   "YYYY-MM-DD dates, available_from first"}
+        return (jsonify(error=message), 400)
+
+    if full:
+        if searchTerm:
+            query = query.filter(func
+                                 .lower(Listing.title)
+                                 .contains(searchTerm.lower()))
+
+        if fieldset:
+            return jsonify(listings=fieldset.serialize_all(query.all()))
+
+        listings = [listing.serialize()
+                    for listing in query.options(*LISTING_DETAIL_PLAN).all()]
+        return jsonify(listings=listings)
+
+    limit = get_page_size(request.args)
+    cursor = request.args.get('cursor')
+
+    try:
+        if searchTerm:
+            page, next_cursor = search_listings(
+                query, searchTerm, limit=limit, cursor=cursor)
+        else:
+            page, next_cursor = paginate_by_id(
+                query, Listing.id, limit=limit, cursor=cursor)
+    except InvalidCursor:
+        message = {'message': "Invalid cursor"}
+        return (jsonify(error=message), 400)
+
+    if fieldset:
+        listings = fieldset.serialize_all(page)
+    else:
+        listings = [Listing.summary_from_row(row) for row in page]
+
+    return jsonify(listings=listings, next=next_cursor)
+
+
+@app.get('/listings/nearby')
+@response_cache.cached(tags=nearby_tags)
+def get_nearby_listings():
+    """Get a page of listings within `radius_km` (default 10) of `lat`/`lng`,
+    nearest first. Accepts `limit` and `cursor` like /listings.
+    returns
+    {
+        "listings": [{listing, "distance_km"}, {listing, "distance_km"}],
+        "next": "eyJtb2RlIjoibmVhcmJ5Ii..." or null
+    }
 
-    listings = [listing.serialize() for listing in Listing.query.all()]
+    Takes ?fields= and ?include= like /listings; distance_km is always
+    returned.
+    """
 
-    return jsonify(listings=listings)
+    fieldset = parse_fieldset(request.args, 'listings', LISTING_SUMMARY_FIELDS)
+
+    try:
+        lat = float(request.args['lat'])
+        lng = float(request.args['lng'])
+        radius_km = float(request.args.get('radius_km', 10))
+    except (KeyError, ValueError):
+        message = {'message': "lat and lng are required numbers"}
+        return (jsonify(error=message), 400)
+
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180
+            and 0 < radius_km <= MAX_RADIUS_KM):
+        message = {'message': "lat, lng or radius_km out of range"}
+        return (jsonify(error=message), 400)
+
+    try:
+        page, next_cursor = nearby_listings(
+            db.session.query(*(fieldset.columns() if fieldset
+                               else LISTING_SUMMARY_COLUMNS)),
+            lat, lng, radius_km,
+            limit=get_page_size(request.args),
+            cursor=request.args.get('cursor'))
+    except InvalidCursor:
+        message = {'message': "Invalid cursor"}
+        return (jsonify(error=message), 400)
+
+    if fieldset:
+        listings = [dict(listing, distance_km=round(row.score, 3))
+                    for row, listing in zip(page, fieldset.serialize_all(page))]
+    else:
+        listings = [Listing.nearby_from_row(row, row.score) for row in page]
+
+    return jsonify(listings=listings, next=next_cursor)
 
 
 @app.get('/listings/<int:id>')
+@response_cache.cached(tags=listing_tags)
 def get_listing(id):
     """Get a listings from database based on the url params 
     returns an json with a user
@@ -334,9 +771,27 @@ def get_listing(id):
         "listing":{"city", "country", "details", "id", "image_url", 
         "price_per_night", "state", "street", "title", "username", "zip"}]
     }
+
+    Takes ?fields= and ?include= (see fieldsets.py), e.g.
+    ?fields=id,title&include=bookings,host.
     """
 
-    listing = Listing.query.get(id)
+    fieldset = parse_fieldset(request.args, 'listings')
+
+    if fieldset:
+        rows = (db.session.query(*fieldset.columns())
+                .filter(Listing.id == id)
+                .all())
+        if rows:
+            return jsonify(listing=fieldset.serialize_all(rows)[0])
+
+        message = {'message': f"No listing: {id}"}
+        return (jsonify(error=message), 404)
+
+    listing = (Listing.query
+               .options(*LISTING_DETAIL_PLAN)
+               .filter_by(id=id)
+               .one_or_none())
 
     if listing:
         json_listing = listing.serialize()
@@ -356,25 +811,69 @@ def delete_listing(id):
     Returns JSON of {message: "Deleted listing successfully"}
     """
 
-    listing = Listing.query.get(id)
+    host = (db.session.query(Listing.username)
+            .filter(Listing.id == id)
+            .scalar())
 
-    if current_user.username != listing.username:
+    if host is None:
+        message = {'message': f"No listing: {id}"}
+        return (jsonify(error=message), 404)
+
+    if current_user.username != host:
         return jsonify({"error": "Invalid Authorization"})
 
-    if listing:
-        for message in listing.messages:
-            db.session.delete(message)
+    # One statement: its bookings and messages go through ON DELETE CASCADE.
+    db.session.execute(delete(Listing).where(Listing.id == id))
+    db.session.commit()
+    # Its bookings and messages go with it.
+    response_cache.invalidate(f'listing:{id}', f'messages:{id}', 'listings',
+                              'bookings', 'messages')
 
-        for booking in listing.messages:
-            db.session.delete(booking)
+    return jsonify(message='Deleted listing successfully')
 
-        db.session.delete(listing)
-        db.session.commit()
-        return jsonify(message='Deleted listing successfully')
 
-    message = {'message': f"No listing: {id}"}
+@app.delete('/users/<username>/listings')
+@jwt_required()
+def delete_user_listings(username):
+    """Delete many of the logged-in host's listings in one transaction.
+    receives a json
+        {"ids": [id, ...]}
+    returns a json
+        {"deleted": [id, ...], "missing": [id, ...]}
+    where missing are ids that aren't listings of theirs. Bookings and
+    messages of the deleted listings go with them.
+    """
 
-    return (jsonify(error=message), 404)
+    if current_user.username != username:
+        message = {'message': "Invalid Authorization"}
+        return (jsonify(error=message), 401)
+
+    data = request.get_json(silent=True)
+    ids = data.get('ids') if isinstance(data, dict) else None
+
+    if (not isinstance(ids, list) or len(ids) > MAX_BATCH_KEYS
+            or not all(type(id) is int for id in ids)):
+        message = {'message': f"ids must be a list of at most "
+                   f"{MAX_BATCH_KEYS} listing ids"}
+        return (jsonify(error=message), 400)
+
+    deleted = set(db.session.execute(
+        delete(Listing)
+        .where(Listing.id.in_(ids), Listing.username == username)
+        .returning(Listing.id)
+    ).scalars())
+    db.session.commit()
+
+    if deleted:
+        response_cache.invalidate(
+            'listings', 'bookings', 'messages',
+            *(tag for id in deleted
+                          for tag in (f'listing:{id}', f'messages:{id}')))
+
+    ids = list(dict.fromkeys(ids))
+
+    return jsonify(deleted=[id for id in ids if id in deleted],
+                   missing=[id for id in ids if id not in deleted])
 
 
 ##############################################################################
@@ -395,10 +894,19 @@ def create_message():
     property_id = data['property_id']
     from_username = data['from_username']
 
+    host = db.session.scalar(
+        select(Listing.username).where(Listing.id == property_id))
+
+    # Streams resume by id, so each stream's messages commit in id order.
+    lock_message_order(property_id, from_username, host)
     message = Message(body=body, property_id=property_id,
                       from_username=from_username)
     db.session.add(message)
+    db.session.flush()
+    # Delivered to open message streams once the row is committed.
+    notify_message(message.id)
     db.session.commit()
+    response_cache.invalidate(f'messages:{property_id}', 'messages')
 
     return (jsonify(message=message.serialize()), 201)
 
@@ -408,8 +916,22 @@ def get_message(id):
     """Get a message from database by id 
     returns an json with a message
         {"message": { "body", "id", "sent_at_date" }
+
+    Takes ?fields= and ?include= (see fieldsets.py).
     """
 
+    fieldset = parse_fieldset(request.args, 'messages')
+
+    if fieldset:
+        rows = (db.session.query(*fieldset.columns())
+                .filter(Message.id == id)
+                .all())
+        if rows:
+            return jsonify(message=fieldset.serialize_all(rows)[0])
+
+        message = {'message': f"No message: {id}"}
+        return (jsonify(error=message), 404)
+
     message = Message.query.get(id)
 
     if message:
@@ -420,6 +942,151 @@ def get_message(id):
     return (jsonify(error=message), 404)
 
 
+@app.get('/listings/<int:id>/messages')
+@response_cache.cached(tags=messages_tags)
+def get_listing_messages(id):
+    """Get a page of the conversation on a listing, oldest first.
+
+    Takes optional "limit" and "cursor" query params; pass the returned
+    "next" as "cursor" to get the next page.
+    returns a json
+        {
+            "messages": [{"id", "body", "from_user", "property_id",
+                          "sent_at_date"}, ...],
+            "next"
+        }
+
+    Takes ?fields= and ?include= (see fieldsets.py).
+    """
+
+    cursor = request.args.get('cursor')
+    fieldset = parse_fieldset(request.args, 'messages')
+    # The page keys are selected whichever fields are asked for.
+    columns = (fieldset.columns(Message.sent_at_date) if fieldset
+               else MESSAGE_COLUMNS)
+    query = db.session.query(*columns).filter(Message.property_id == id)
+
+    try:
+        page, next_cursor = paginate_by_keys(
+            query, (Message.sent_at_date, Message.id),
+            limit=get_page_size(request.args), cursor=cursor)
+    except InvalidCursor:
+        message = {'message': "Invalid cursor"}
+        return (jsonify(error=message), 400)
+
+    if not page and not cursor and db.session.get(Listing, id) is None:
+        message = {'message': f"No listing: {id}"}
+        return (jsonify(error=message), 404)
+
+    if fieldset:
+        messages = fieldset.serialize_all(page)
+    else:
+        messages = [Message.from_row(row) for row in page]
+
+    return jsonify(messages=messages, next=next_cursor)
+
+
+def last_event_id():
+    """The last message id a reconnecting stream client saw, from the
+    Last-Event-ID header (sent by browsers) or ?last_event_id=."""
+
+    value = request.headers.get('Last-Event-ID',
+                                request.args.get('last_event_id'))
+    return int(value) if value else None
+
+
+@app.get('/listings/<int:id>/messages/stream')
+def stream_listing_messages(id):
+    """Stream new messages on a listing as Server-Sent Events.
+
+    Each event is "event: message" with the message json as its data and
+    the message id as its event id. A client reconnecting with the last id
+    it saw first gets the messages it missed. Clients that fall too far
+    behind are disconnected, and should reconnect.
+    """
+
+    try:
+        after = last_event_id()
+    except ValueError:
+        message = {'message': "Invalid Last-Event-ID"}
+        return (jsonify(error=message), 400)
+
+    if db.session.get(Listing, id) is None:
+        message = {'message': f"No listing: {id}"}
+        return (jsonify(error=message), 404)
+
+    return message_stream.response(('listing', id), after)
+
+
+@app.get('/users/<username>/messages')
+@jwt_required()
+def get_user_messages(username):
+    """Get a page of the logged-in user's conversations: the messages they
+    sent and the messages on listings they host, grouped by listing and
+    oldest first within each.
+
+    Takes optional "property_id" to get a single conversation, and "limit"
+    and "cursor" query params, and ?fields= and ?include=, like
+    GET /listings/<id>/messages.
+    returns a json
+        {
+            "messages": [{"id", "body", "from_user", "property_id",
+                          "sent_at_date"}, ...],
+            "next"
+        }
+    """
+
+    if current_user.username != username:
+        message = {'message': "Invalid Authorization"}
+        return (jsonify(error=message), 401)
+
+    fieldset = parse_fieldset(request.args, 'messages')
+    columns = (fieldset.columns(Message.property_id, Message.sent_at_date)
+               if fieldset else MESSAGE_COLUMNS)
+    query = db.session.query(*columns)
+
+    property_id = request.args.get('property_id', type=int)
+    if property_id is not None:
+        query = query.filter(Message.property_id == property_id)
+
+    try:
+        page, next_cursor = paginate_union_by_keys(
+            conversations_of(query, username),
+            (Message.property_id, Message.sent_at_date, Message.id),
+            limit=get_page_size(request.args),
+            cursor=request.args.get('cursor'))
+    except InvalidCursor:
+        message = {'message': "Invalid cursor"}
+        return (jsonify(error=message), 400)
+
+    if fieldset:
+        messages = fieldset.serialize_all(page)
+    else:
+        messages = [Message.from_row(row) for row in page]
+
+    return jsonify(messages=messages, next=next_cursor)
+
+
+@app.get('/users/<username>/messages/stream')
+@jwt_required()
+def stream_user_messages(username):
+    """Stream new messages in the logged-in user's conversations as
+    Server-Sent Events, like GET /listings/<id>/messages/stream.
+    """
+
+    if current_user.username != username:
+        message = {'message': "Invalid Authorization"}
+        return (jsonify(error=message), 401)
+
+    try:
+        after = last_event_id()
+    except ValueError:
+        message = {'message': "Invalid Last-Event-ID"}
+        return (jsonify(error=message), 400)
+
+    return message_stream.response(('user', username), after)
+
+
 ##############################################################################
 #  Booking routes:
 
@@ -429,8 +1096,22 @@ def get_booking(id):
     returns an json with a booking
         {"booking": {"id", "booking_price_per_night", "check_in_date", "check_out_date"
         "property_id", "username"}
+
+    Takes ?fields= and ?include= (see fieldsets.py).
     """
 
+    fieldset = parse_fieldset(request.args, 'bookings')
+
+    if fieldset:
+        rows = (db.session.query(*fieldset.columns())
+                .filter(Booking.id == id)
+                .all())
+        if rows:
+            return jsonify(booking=fieldset.serialize_all(rows)[0])
+
+        message = {'message': f"No booking: {id}"}
+        return (jsonify(error=message), 404)
+
     booking = Booking.query.get_or_404(id)
 
     if booking:
@@ -446,9 +1127,31 @@ def get_bookings():
     """Get all booking from database 
     returns an json with a booking
         {"booking": [booking, booking, booking]}
+
+    With `ids=1,2,3`, returns just those bookings, in that order:
+        {"bookings": [booking, ...], "missing": [id, ...]}
+
+    Takes ?fields= and ?include= (see fieldsets.py).
     """
 
-    bookings = [booking.serialize() for booking in Booking.query.all()]
+    ids = request.args.get('ids')
+    fieldset = parse_fieldset(request.args, 'bookings')
+
+    if ids is not None:
+        try:
+            keys = parse_keys(ids, int)
+        except ValueError:
+            return batch_keys_error('ids')
+
+        bookings, missing = batch_read(Booking, keys, fieldset)
+        return jsonify(bookings=bookings, missing=missing)
+
+    if fieldset:
+        bookings = fieldset.serialize_all(
+            db.session.query(*fieldset.columns()).all())
+    else:
+        bookings = [Booking.from_row(row)
+                    for row in db.session.query(*BOOKING_COLUMNS)]
 
     if bookings:
         return jsonify(bookings=bookings)
@@ -485,6 +1188,7 @@ def create_booking():
 
     db.session.add(booking)
     db.session.commit()
+    response_cache.invalidate(f'listing:{booking.property_id}', 'bookings')
 
     return (jsonify(booking=booking.serialize()), 201)
 
@@ -507,9 +1211,20 @@ def delete_booking(id):
     if booking:
         db.session.delete(booking)
         db.session.commit()
+        response_cache.invalidate(f'listing:{booking.property_id}', 'bookings')
 
         return jsonify(message='Deleted booking successfully')
 
     message = {'message': f"No booking: {id}"}
 
     return (jsonify(error=message), 404)
+
+
+##############################################################################
+#  Metrics routes:
+
+@app.get('/metrics')
+def get_metrics():
+    """Return process metrics (cache hit rates, ...) in Prometheus text format."""
+
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
@@ -3,11 +3,42 @@ import os
 os.environ["DATABASE_URL"] = 'postgresql:///sharebnb_test'
 
 from unittest import TestCase
+from contextlib import contextmanager
 
-from app import app
-from models import db, User
+from sqlalchemy import event
+from sqlalchemy.exc import DBAPIError
+
+from app import app, geocode_worker, image_pipeline, identity_cache
+from app import message_stream, replica_router
+from responseCache import response_cache
+from flask_jwt_extended import create_access_token
+from models import db, User, Listing, Message, Booking
+from queryTrace import normalize_sql
+from messageStream import LISTING_ORDER_LOCK, message_order_locks
+from geoCode import GeoCoder, normalize_address
+from metrics import metrics
+import threading
+from passwords import password_hasher, PasswordHasher, PasswordPoolSaturated
+import awsUpload
+from io import BytesIO
+from werkzeug.datastructures import FileStorage
+from PIL import Image
+from imagePipeline import render_variants, fetch_image, HTTPSRedirectHandler
+from urllib.request import Request
+from models import GeocodeCache, LISTING_SUMMARY_COLUMNS
+from listingImport import import_listings
+from io import StringIO
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+import json
+from sqlalchemy.pool import NullPool
+from dbPool import engine_options, TimedQueuePool, TimedAsyncQueuePool
+from schemaMigrations import upgrade, schema_migrations
 
 app.config['TESTING'] = True
+# Most tests change rows behind the routes' back; ResponseCacheTestCase
+# turns the cache back on.
+app.config['RESPONSE_CACHE_ENABLED'] = False
 
 db.drop_all()
 db.create_all()
@@ -30,6 +61,19 @@ USER_DATA_JSON = {
     "isHost":False
 }
 
+LISTING_DATA = {
+    "title": "test listing",
+    "details": "test details",
+    "city": "Daly City",
+    "state": "CA",
+    "zip": 12345,
+    "country": "USA",
+    "price_per_night": 10,
+    "username": "testuser1",
+    "latitude": 37.6879241,
+    "longitude": -122.4702079,
+}
+
 class UserViewsTestCase(TestCase):
     """Tests for views of API."""
 
@@ -109,4 +153,1851 @@ class UserViewsTestCase(TestCase):
             self.assertEqual(resp.status_code, 409)
             data = resp.json
 
-            self.assertEqual(data, {"error":{"message": "Username already exists"}})
\ No newline at end of file
+            self.assertEqual(data, {"error":{"message": "Username already exists"}})
+
+
+class ListingViewsTestCase(TestCase):
+    """Tests for listing views of API."""
+
+    def setUp(self):
+        """Make demo data."""
+
+        Listing.query.delete()
+        User.query.delete()
+
+        user = User(**USER_DATA_SQL)
+        db.session.add(user)
+        db.session.commit()
+
+        listings = [Listing(street=f"{n} Main", **LISTING_DATA)
+                    for n in range(5)]
+        db.session.add_all(listings)
+        db.session.commit()
+
+        self.listing_ids = [listing.id for listing in listings]
+
+    def tearDown(self):
+        """Clean up fouled transactions."""
+
+        db.session.rollback()
+
+    def test_get_listings_paginated(self):
+        """test walking every page of listings with the next cursor"""
+
+        seen = []
+        url = "/listings?limit=2"
+
+        with app.test_client() as client:
+            while url:
+                resp = client.get(url)
+                self.assertEqual(resp.status_code, 200)
+                data = resp.json
+
+                self.assertLessEqual(len(data["listings"]), 2)
+                seen.extend(listing["id"] for listing in data["listings"])
+
+                url = data["next"] and f"/listings?limit=2&cursor={data['next']}"
+
+        self.assertEqual(seen, self.listing_ids)
+
+    def test_get_listings_compact(self):
+        """test list view leaves out nested collections"""
+
+        with app.test_client() as client:
+            resp = client.get("/listings")
+
+        listing = resp.json["listings"][0]
+        self.assertNotIn("messages", listing)
+        self.assertNotIn("bookings", listing)
+        self.assertIsNone(resp.json["next"])
+
+    def test_get_listings_full(self):
+        """test old clients can still get every fully serialized listing"""
+
+        with app.test_client() as client:
+            resp = client.get("/listings?full=true")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp.json["listings"]), 5)
+        self.assertEqual(resp.json["listings"][0]["bookings"], [])
+        self.assertNotIn("messages", resp.json["listings"][0])
+        self.assertNotIn("next", resp.json)
+
+    def test_search_listings_ranked(self):
+        """test search matches title and details, best match first"""
+
+        in_details = Listing.query.get(self.listing_ids[0])
+        in_details.details = "a cozy cabin"
+        in_title = Listing.query.get(self.listing_ids[3])
+        in_title.title = "Rustic Cabin"
+        db.session.commit()
+
+        with app.test_client() as client:
+            resp = client.get("/listings?q=cabins")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([listing["id"] for listing in resp.json["listings"]],
+                         [self.listing_ids[3], self.listing_ids[0]])
+
+    def test_search_listings_paginated(self):
+        """test walking search results with the next cursor"""
+
+        seen = []
+        url = "/listings?q=test&limit=2"
+
+        with app.test_client() as client:
+            while url:
+                data = client.get(url).json
+                seen.extend(listing["id"] for listing in data["listings"])
+                url = data["next"] and f"/listings?q=test&limit=2&cursor={data['next']}"
+
+        self.assertEqual(sorted(seen), self.listing_ids)
+
+    def move_listings(self):
+        """Move one listing ~1.4km north and one to Los Angeles."""
+
+        north = Listing.query.get(self.listing_ids[1])
+        north.latitude = 37.7
+        la = Listing.query.get(self.listing_ids[2])
+        la.latitude, la.longitude = 34.0522342, -118.2436849
+        db.session.commit()
+
+    def test_nearby_listings(self):
+        """test nearby search returns listings in radius, nearest first"""
+
+        self.move_listings()
+        ids = self.listing_ids
+        seen = []
+        url = "/listings/nearby?lat=37.6879241&lng=-122.4702079&radius_km=20&limit=2"
+
+        with app.test_client() as client:
+            while url:
+                data = client.get(url).json
+                seen.extend(data["listings"])
+                url = data["next"] and (
+                    "/listings/nearby?lat=37.6879241&lng=-122.4702079"
+                    f"&radius_km=20&limit=2&cursor={data['next']}")
+
+        self.assertEqual([listing["id"] for listing in seen],
+                         [ids[0], ids[3], ids[4], ids[1]])
+        self.assertEqual(seen[0]["distance_km"], 0)
+        self.assertAlmostEqual(seen[-1]["distance_km"], 1.347, places=2)
+
+    def test_nearby_listings_invalid(self):
+        with app.test_client() as client:
+            resp = client.get("/listings/nearby?lat=100&lng=0")
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_get_listings_bbox(self):
+        """test bbox filter only returns listings inside the box"""
+
+        self.move_listings()
+
+        with app.test_client() as client:
+            resp = client.get("/listings?bbox=-119,33,-118,35")
+            bad_resp = client.get("/listings?bbox=1,2,3")
+
+        self.assertEqual([listing["id"] for listing in resp.json["listings"]],
+                         [self.listing_ids[2]])
+        self.assertEqual(bad_resp.status_code, 400)
+
+    def test_get_listings_available(self):
+        """test availability excludes listings with overlapping bookings"""
+
+        ids = self.listing_ids
+        for property_id, check_in, check_out in [
+                (ids[0], "2023-06-01", "2023-06-05"),
+                (ids[1], "2023-06-09", "2023-06-12"),
+                (ids[2], "2023-06-10", "2023-06-11")]:
+            db.session.add(Booking(
+                username="testuser1",
+                property_id=property_id,
+                check_in_date=check_in,
+                check_out_date=check_out,
+                booking_price_per_night=10))
+        db.session.commit()
+
+        with app.test_client() as client:
+            resp = client.get(
+                "/listings?available_from=2023-06-05&available_to=2023-06-10")
+            bad_resp = client.get("/listings?available_from=2023-06-05")
+
+        # ids[0] checks out and ids[2] checks in on the boundary days.
+        self.assertEqual([listing["id"] for listing in resp.json["listings"]],
+                         [ids[0], ids[2], ids[3], ids[4]])
+        self.assertEqual(bad_resp.status_code, 400)
+
+    def test_get_listings_price(self):
+        cheap = Listing.query.get(self.listing_ids[4])
+        cheap.price_per_night = 5
+        db.session.commit()
+
+        with app.test_client() as client:
+            resp = client.get("/listings?max_price=8")
+            bad_resp = client.get("/listings?max_price=cheap")
+
+        self.assertEqual([listing["id"] for listing in resp.json["listings"]],
+                         [self.listing_ids[4]])
+        self.assertEqual(bad_resp.status_code, 400)
+
+    def test_get_listings_invalid_cursor(self):
+        with app.test_client() as client:
+            resp = client.get("/listings?cursor=not-a-cursor")
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json, {"error": {"message": "Invalid cursor"}})
+
+    def test_summary_from_projection(self):
+        """test a projected row serializes the same as the entity"""
+
+        listing = Listing.query.get(self.listing_ids[0])
+        listing.image_variants = {"image/webp": {"800": "b.webp", "320": "a.webp"}}
+        db.session.commit()
+
+        row = (db.session.query(*LISTING_SUMMARY_COLUMNS)
+               .filter(Listing.id == listing.id)
+               .one())
+
+        self.assertEqual(Listing.summary_from_row(row),
+                         listing.serialize_summary())
+        self.assertEqual(Listing.summary_from_row(row)["image_srcset"],
+                         {"image/webp": "a.webp 320w, b.webp 800w"})
+
+    def test_json_dumps_arguments(self):
+        """test dumps() honors sort_keys and the json module's arguments"""
+
+        data = {"b": 1, "a": 2}
+
+        self.assertEqual(app.json.dumps(data), '{"b":1,"a":2}')
+        self.assertEqual(app.json.dumps(data, sort_keys=True),
+                         '{"a":2,"b":1}')
+        self.assertEqual(app.json.dumps(data, separators=(", ", ": ")),
+                         '{"b": 1, "a": 2}')
+
+    def test_get_bookings_iso_dates(self):
+        """test dates are encoded as ISO 8601"""
+
+        db.session.add(Booking(
+            username="testuser1",
+            property_id=self.listing_ids[0],
+            check_in_date="2023-06-01",
+            check_out_date="2023-06-05",
+            booking_price_per_night=10))
+        db.session.commit()
+
+        with app.test_client() as client:
+            resp = client.get("/bookings")
+
+        booking = resp.json["bookings"][0]
+        self.assertEqual(booking["check_in_date"], "2023-06-01")
+        self.assertEqual(booking["check_out_date"], "2023-06-05")
+
+
+
+@contextmanager
+def count_queries():
+    """Count the SQL statements executed inside the block."""
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+
+class QueryCountTestCase(TestCase):
+    """Read endpoints issue a fixed number of queries, however many rows."""
+
+    MAX_QUERIES = {
+        "/users": 6,
+        "/users/testuser1": 6,
+        "/listings": 1,
+        "/listings?full=true": 3,
+    }
+
+    def setUp(self):
+        """Make a busy host: many listings, each with messages and bookings."""
+
+        Listing.query.delete()
+        User.query.delete()
+
+        db.session.add(User(**USER_DATA_SQL))
+        db.session.commit()
+
+        self.listing_count = 0
+        self.listing_id = self.add_listings(10, 3)
+
+    def tearDown(self):
+        """Clean up fouled transactions."""
+
+        db.session.rollback()
+
+    def add_listings(self, count, per_listing):
+        """Add `count` listings, each with `per_listing` messages and
+        bookings. Returns the last one's id."""
+
+        for _ in range(count):
+            listing = Listing(street=f"{self.listing_count} Main",
+                              **LISTING_DATA)
+            self.listing_count += 1
+            db.session.add(listing)
+            db.session.flush()
+            self.add_children(listing.id, per_listing)
+
+        return listing.id
+
+    def add_children(self, listing_id, count):
+        """Add `count` messages and bookings to a listing."""
+
+        for m in range(count):
+            db.session.add(Message(
+                from_username="testuser1",
+                property_id=listing_id,
+                body=f"message {m}"))
+            db.session.add(Booking(
+                username="testuser1",
+                property_id=listing_id,
+                check_in_date="2023-01-01",
+                check_out_date="2023-01-02",
+                booking_price_per_night=10))
+
+        db.session.commit()
+
+    def query_count(self, url):
+        # Start each request from an empty identity map, like a new worker.
+        db.session.expunge_all()
+
+        with app.test_client() as client:
+            with count_queries() as statements:
+                resp = client.get(url)
+
+        self.assertEqual(resp.status_code, 200)
+        return len(statements)
+
+    def assert_constant_queries(self, url, max_queries, add_rows):
+        """Assert `url` runs the same number of queries, at most
+        `max_queries`, before and after add_rows() adds related rows."""
+
+        before = self.query_count(url)
+        add_rows()
+        after = self.query_count(url)
+
+        self.assertEqual(after, before,
+                         f"{url} ran {before}, then {after} queries")
+        self.assertLessEqual(after, max_queries,
+                             f"{url} ran {after} queries")
+
+    def test_max_queries(self):
+        for url, max_queries in self.MAX_QUERIES.items():
+            with self.subTest(url=url):
+                self.assert_constant_queries(
+                    url, max_queries, lambda: self.add_listings(5, 4))
+
+    def test_get_listing_max_queries(self):
+        self.assert_constant_queries(
+            f"/listings/{self.listing_id}", 3,
+            lambda: self.add_children(self.listing_id, 5))
+
+    def test_server_timing_header(self):
+        """test the query tracer reports the request's DB time and count"""
+
+        with app.test_client() as client:
+            with count_queries() as statements:
+                resp = client.get(f"/listings/{self.listing_id}")
+
+        self.assertRegex(resp.headers["Server-Timing"],
+                         rf'^db;dur=[0-9.]+;desc="{len(statements)} queries"$')
+
+    def test_failed_statement_start_dropped(self):
+        """test a statement that raises doesn't leave its start time behind"""
+
+        with db.engine.connect() as connection:
+            with self.assertRaises(DBAPIError):
+                connection.execute(
+                    db.text("SELECT no_such_column FROM listings"))
+
+            self.assertEqual(connection.info.get('sql_trace_start'), [])
+
+    def test_normalize_sql(self):
+        self.assertEqual(
+            normalize_sql("SELECT *\n FROM listings WHERE id IN (1, 2, 3) "
+                          "AND title = 'it''s' AND price > %(price_1)s"),
+            "SELECT * FROM listings WHERE id IN (...) AND title = ? "
+            "AND price > ?")
+
+
+
+class StubLocation:
+    def __init__(self, latitude, longitude):
+        self.latitude = latitude
+        self.longitude = longitude
+
+
+class StubGeocoder:
+    """Local stand-in for Nominatim that records every lookup."""
+
+    def __init__(self, known):
+        self.known = known
+        self.calls = []
+
+    def geocode(self, address):
+        self.calls.append(address)
+        coordinates = self.known.get(address)
+        return coordinates and StubLocation(*coordinates)
+
+
+class GeoCodeCacheTestCase(TestCase):
+    """Tests for the geocode cache layers."""
+
+    def setUp(self):
+        GeocodeCache.query.delete()
+        db.session.commit()
+
+        self.stub = StubGeocoder({"123 Main Street Daly City":
+                                  (37.6879241, -122.4702079)})
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_normalize_address(self):
+        self.assertEqual(normalize_address(" 123  Main Street, Daly City. "),
+                         normalize_address("123 main st daly city"))
+
+    def test_memory_and_db_hits(self):
+        """test each layer answers repeat lookups without the geocoder"""
+
+        geo_coder = GeoCoder(geocoder=self.stub)
+        db_hits = metrics.value('geocode_cache_hits_total', layer='db')
+
+        first = geo_coder.geocode("123 Main Street Daly City")
+        again = geo_coder.geocode("123 main st., daly city")
+
+        self.assertEqual(first, {"latitude": 37.6879241,
+                                 "longitude": -122.4702079})
+        self.assertEqual(again, first)
+        self.assertEqual(len(self.stub.calls), 1)
+
+        # A fresh process has an empty LRU but shares the table.
+        fresh = GeoCoder(geocoder=self.stub)
+        self.assertEqual(fresh.geocode("123 MAIN STREET DALY CITY"), first)
+        self.assertEqual(len(self.stub.calls), 1)
+        self.assertEqual(
+            metrics.value('geocode_cache_hits_total', layer='db'), db_hits + 1)
+
+    def test_negative_cache(self):
+        """test unresolvable addresses are cached as misses"""
+
+        geo_coder = GeoCoder(geocoder=self.stub)
+
+        self.assertIsNone(geo_coder.geocode("nowhere"))
+        self.assertIsNone(GeoCoder(geocoder=self.stub).geocode("nowhere"))
+        self.assertEqual(self.stub.calls, ["nowhere"])
+
+        with app.test_client() as client:
+            resp = client.get("/metrics")
+
+        self.assertIn('geocode_failures_total{reason="not_found"}',
+                      resp.get_data(as_text=True))
+
+
+
+class GeocodeWorkerTestCase(TestCase):
+    """Tests for background geocoding of listings."""
+
+    def setUp(self):
+        Listing.query.delete()
+        User.query.delete()
+        GeocodeCache.query.delete()
+        db.session.add(User(**USER_DATA_SQL))
+        db.session.commit()
+
+        self.real_geo_coder = geocode_worker.geo_coder
+        geocode_worker.geo_coder = GeoCoder(geocoder=StubGeocoder(
+            {"1 Main Daly City": (37.6879241, -122.4702079)}))
+
+    def tearDown(self):
+        geocode_worker.geo_coder = self.real_geo_coder
+        db.session.rollback()
+
+    def create_listing(self, client, street):
+        form = {key: str(value) for key, value in LISTING_DATA.items()
+                if key not in ("latitude", "longitude")}
+        return client.post("/listings", data={**form, "street": street})
+
+    def test_create_listing_pending_then_geocoded(self):
+        """test listings are saved at once and geocoded in the background"""
+
+        with app.test_client() as client:
+            resp = self.create_listing(client, "1 Main")
+            self.create_listing(client, "2 Nowhere")
+
+        self.assertEqual(resp.status_code, 201)
+        listing = resp.json["listing"]
+        self.assertEqual(listing["geocode_status"], "pending")
+        self.assertIsNone(listing["latitude"])
+
+        geocode_worker.drain()
+
+        with app.test_client() as client:
+            data = client.get("/listings").json["listings"]
+
+        self.assertEqual(
+            [(l["geocode_status"], l["latitude"]) for l in data],
+            [("done", 37.6879241), ("failed", None)])
+
+    def test_stale_geocode_not_stored(self):
+        """test a result for an address edited mid-lookup isn't written"""
+
+        with app.test_client() as client:
+            id = self.create_listing(client, "1 Main").json["listing"]["id"]
+
+        stub = geocode_worker.geo_coder.geocoder
+        lookup = stub.geocode
+
+        def edit_then_geocode(address):
+            # The listing moves while its old address is being looked up.
+            with db.engine.begin() as connection:
+                connection.execute(
+                    db.text("UPDATE listings SET street = '2 Nowhere' "
+                            "WHERE id = :id"), {"id": id})
+            return lookup(address)
+
+        stub.geocode = edit_then_geocode
+        geocode_worker.drain()
+
+        listing = db.session.get(Listing, id)
+        self.assertEqual(listing.geocode_status, "pending")
+        self.assertIsNone(listing.latitude)
+
+
+IMPORT_CSV = """\
+title,details,street,city,state,zip,country,price_per_night,username,latitude,longitude
+Cabin,nice,1 Main,Daly City,CA,12345,USA,10,testuser1,37.5,-122.5
+Loft,nice,5 Oak Street,Daly City,CA,12345,USA,20,testuser1,,
+Bad zip,nice,7 Main,Daly City,CA,zip,USA,10,testuser1,,
+Copy,nice,1 Main,Daly City,CA,12345,USA,10,testuser1,,
+Stranger,nice,9 Main,Daly City,CA,12345,USA,10,nobody,,
+"""
+
+
+class ListingImportTestCase(TestCase):
+    """Tests for bulk listing import."""
+
+    def setUp(self):
+        Listing.query.delete()
+        User.query.delete()
+        GeocodeCache.query.delete()
+        db.session.add(User(**USER_DATA_SQL))
+        db.session.add(GeocodeCache(
+            address=normalize_address("5 Oak St Daly City"),
+            latitude=37.7, longitude=-122.4,
+            expires_at=datetime.now() + timedelta(days=1)))
+        db.session.commit()
+        identity_cache.lru.clear()
+
+        self.real_geo_coder = geocode_worker.geo_coder
+        geocode_worker.geo_coder = GeoCoder(geocoder=StubGeocoder({}))
+
+        token = create_access_token(identity={"username": "testuser1"},
+                                    additional_claims={"ver": 0})
+        self.headers = {"Authorization": f"Bearer {token}"}
+
+    def tearDown(self):
+        geocode_worker.drain()
+        geocode_worker.geo_coder = self.real_geo_coder
+        db.session.rollback()
+
+    def test_import_csv(self):
+        """test good rows are merged and bad ones reported by row"""
+
+        report = import_listings(StringIO(IMPORT_CSV), "csv", batch_size=2)
+
+        self.assertEqual(report.imported, 2)
+        self.assertEqual(report.geocoded, 2)
+        self.assertEqual(report.errors, [
+            {"row": 3, "message": "zip must be an integer"},
+            {"row": 4, "message": "a listing at this street and city already exists"},
+            {"row": 5, "message": "unknown username"},
+        ])
+
+        listings = Listing.query.order_by(Listing.id).all()
+        self.assertEqual(
+            [(l.title, l.latitude, l.geocode_status) for l in listings],
+            [("Cabin", 37.5, "done"), ("Loft", 37.7, "done")])
+
+    def test_import_endpoint(self):
+        """test NDJSON upload imports for the logged-in host"""
+
+        body = "\n".join([
+            json.dumps({**LISTING_DATA, "street": "1 Elm", "username": "x"}),
+            "",
+            json.dumps({"title": "No address"}),
+            "not json",
+        ])
+
+        with app.test_client() as client:
+            resp = client.post("/listings/import", data=body,
+                               content_type="application/x-ndjson",
+                               headers=self.headers)
+            bad_resp = client.post("/listings/import", data="{}",
+                                   content_type="application/json",
+                                   headers=self.headers)
+
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.json["imported"], 1)
+        self.assertEqual([error["row"] for error in resp.json["errors"]],
+                         [2, 3])
+        self.assertEqual(Listing.query.one().username, "testuser1")
+        self.assertEqual(bad_resp.status_code, 415)
+
+    def test_import_out_of_range_rows(self):
+        """test values the columns can't hold are reported per row, and the
+        rest of their batch still imports"""
+
+        rows = [{**LISTING_DATA, "street": f"{n} Elm"} for n in range(4)]
+        rows[1]["zip"] = 99999999999
+        rows[2]["title"] = "Null\x00byte"
+
+        with app.test_client() as client:
+            resp = client.post(
+                "/listings/import",
+                data="\n".join(json.dumps(row) for row in rows),
+                content_type="application/x-ndjson", headers=self.headers)
+
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.json["imported"], 2)
+        self.assertEqual(resp.json["errors"], [
+            {"row": 2, "message": "zip must be at most 2147483647"},
+            {"row": 3, "message": "title must not contain NUL characters"},
+        ])
+
+
+
+class FakeS3:
+    """In-memory stand-in for an S3 client, like a local MinIO."""
+
+    def __init__(self):
+        self.objects = {}
+
+    def upload_fileobj(self, fileobj, bucket, key, ExtraArgs=None,
+                       Callback=None, Config=None):
+        data = b""
+        while chunk := fileobj.read(64 * 1024):
+            data += chunk
+            Callback(len(chunk))
+        self.objects[(bucket, key)] = (data, (ExtraArgs or {}).get("ContentType"))
+
+
+class S3UploaderTestCase(TestCase):
+    """Tests for the shared S3 uploader."""
+
+    def setUp(self):
+        self.fake_s3 = FakeS3()
+        self.real_uploader = awsUpload.s3_uploader
+        awsUpload.s3_uploader = awsUpload.S3Uploader("bucket", client=self.fake_s3)
+
+    def tearDown(self):
+        awsUpload.s3_uploader = self.real_uploader
+
+    def test_upload_file(self):
+        """test a FileStorage is streamed to the bucket and metered"""
+
+        content = b"x" * 200_000
+        image = FileStorage(BytesIO(content), filename="photo.JPG",
+                            content_type="image/jpeg")
+        bytes_before = metrics.value("s3_upload_bytes_total")
+
+        key = awsUpload.uploadFileToS3(image)
+
+        self.assertRegex(key, r"^[0-9a-f]{32}\.jpg$")
+        self.assertEqual(self.fake_s3.objects[("bucket", key)],
+                         (content, "image/jpeg"))
+        self.assertEqual(metrics.value("s3_upload_bytes_total"),
+                         bytes_before + len(content))
+
+
+    def test_image_variants(self):
+        """test a new listing's photo is published in three widths, two formats"""
+
+        uploader = awsUpload.S3Uploader("bucket", client=self.fake_s3)
+        real_pipeline_uploader = image_pipeline.uploader
+        image_pipeline.uploader = awsUpload.s3_uploader = uploader
+
+        Listing.query.delete()
+        User.query.delete()
+        db.session.add(User(**USER_DATA_SQL))
+        db.session.commit()
+
+        photo = BytesIO()
+        Image.new("RGB", (2000, 1000), "teal").save(photo, "JPEG")
+        photo.seek(0)
+
+        form = {key: str(value) for key, value in LISTING_DATA.items()}
+        try:
+            with app.test_client() as client:
+                resp = client.post("/listings", data={
+                    **form, "street": "1 Main", "image": (photo, "photo.jpg")})
+                listing = client.get(
+                    f"/listings/{resp.json['listing']['id']}").json["listing"]
+        finally:
+            image_pipeline.uploader = real_pipeline_uploader
+
+        self.assertEqual(len(self.fake_s3.objects), 7)
+        srcset = listing["image_srcset"]
+        self.assertEqual(set(srcset), {"image/webp", "image/jpeg"})
+        self.assertRegex(srcset["image/webp"],
+                         r"^\S+-320\.webp 320w, \S+-800\.webp 800w, "
+                         r"\S+-1600\.webp 1600w$")
+
+    def test_stale_variants_not_stored(self):
+        """test variants of a replaced image don't overwrite the listing's"""
+
+        Listing.query.delete()
+        User.query.delete()
+        db.session.add(User(**USER_DATA_SQL))
+        listing = Listing(**LISTING_DATA, street="1 Main",
+                          image_url="https://img/new.jpg")
+        db.session.add(listing)
+        db.session.commit()
+
+        photo = BytesIO()
+        Image.new("RGB", (400, 200)).save(photo, "JPEG")
+
+        real_pipeline_uploader = image_pipeline.uploader
+        image_pipeline.uploader = awsUpload.s3_uploader
+        try:
+            image_pipeline.submit(listing.id, photo.getvalue(),
+                                  "https://img/old.jpg")
+        finally:
+            image_pipeline.uploader = real_pipeline_uploader
+
+        db.session.refresh(listing)
+        self.assertIsNone(listing.image_variants)
+
+    def test_fetch_image_only_public_https(self):
+        """test image URLs can't reach plain http or internal addresses"""
+
+        for url in ["http://example.com/a.jpg", "https://127.0.0.1/a.jpg",
+                    "https://169.254.169.254/latest/meta-data",
+                    "https://10.0.0.1/a.jpg", "https://[::1]/a.jpg"]:
+            with self.subTest(url=url):
+                with self.assertRaises(ValueError):
+                    fetch_image(url)
+
+        redirect = Request("https://example.com/a.jpg")
+        with self.assertRaises(ValueError):
+            HTTPSRedirectHandler().redirect_request(
+                redirect, None, 302, "Found", {}, "http://10.0.0.1/a.jpg")
+
+    def test_render_variants_never_upscales(self):
+        photo = BytesIO()
+        Image.new("RGB", (500, 500)).save(photo, "PNG")
+
+        variants = render_variants(photo.getvalue())
+
+        self.assertEqual(sorted(variants),
+                         [("jpg", 320), ("jpg", 500), ("webp", 320), ("webp", 500)])
+
+
+
+class IdentityCacheTestCase(TestCase):
+    """Tests for cached JWT identity resolution."""
+
+    def setUp(self):
+        Listing.query.delete()
+        User.query.delete()
+        db.session.add(User(**USER_DATA_SQL))
+        db.session.commit()
+        identity_cache.lru.clear()
+
+        token = create_access_token(identity={"username": "testuser1"},
+                                    additional_claims={"ver": 0})
+        self.headers = {"Authorization": f"Bearer {token}"}
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def authenticated_call(self, client):
+        """An authenticated route that stops right after the user lookup."""
+
+        return client.delete("/bookings/0", headers=self.headers)
+
+    def test_identity_cached_until_user_changes(self):
+        hits = metrics.value("identity_cache_hits_total")
+        misses = metrics.value("identity_cache_misses_total")
+
+        with app.test_client() as client:
+            self.authenticated_call(client)
+            self.authenticated_call(client)
+
+            self.assertEqual(metrics.value("identity_cache_misses_total"),
+                             misses + 1)
+            self.assertEqual(metrics.value("identity_cache_hits_total"),
+                             hits + 1)
+
+            resp = client.patch("/users/testuser1", headers=self.headers,
+                                json={"firstName": "changed"})
+            self.assertEqual(resp.json["user"]["first_name"], "changed")
+
+            self.authenticated_call(client)
+
+        self.assertEqual(metrics.value("identity_cache_misses_total"),
+                         misses + 2)
+
+    def test_revoked_token_version(self):
+        user = User.query.get("testuser1")
+        user.token_version = 1
+        db.session.commit()
+
+        with app.test_client() as client:
+            resp = self.authenticated_call(client)
+
+        self.assertEqual(resp.status_code, 401)
+
+
+
+class PasswordHasherTestCase(TestCase):
+    """Tests for pooled bcrypt hashing."""
+
+    def setUp(self):
+        Listing.query.delete()
+        User.query.delete()
+        db.session.commit()
+        self.rounds = password_hasher.rounds
+        password_hasher.rounds = 4
+
+    def tearDown(self):
+        password_hasher.rounds = self.rounds
+        db.session.rollback()
+
+    def test_rehash_on_login(self):
+        """test a hash made at an old cost is upgraded at login"""
+
+        User.signup("testuser1", "first", "last", "e@mail.com", "secret", False)
+        self.assertTrue(User.query.get("testuser1").password.startswith("$2b$04$"))
+
+        password_hasher.rounds = 5
+
+        self.assertFalse(User.authenticate("testuser1", "wrong"))
+        self.assertTrue(User.authenticate("testuser1", "secret"))
+        self.assertTrue(User.query.get("testuser1").password.startswith("$2b$05$"))
+        self.assertTrue(User.authenticate("testuser1", "secret"))
+
+    def test_saturated_pool(self):
+        """test calls are refused once every worker and queue slot is taken"""
+
+        hasher = PasswordHasher()
+        hasher.configure(rounds=4, workers=1, max_queue=0)
+        release = threading.Event()
+        busy = threading.Thread(target=hasher._run, args=(release.wait,))
+        busy.start()
+
+        try:
+            while hasher._in_flight == 0:
+                pass
+            with self.assertRaises(PasswordPoolSaturated):
+                hasher.hash("secret")
+        finally:
+            release.set()
+            busy.join()
+
+        self.assertTrue(hasher.verify(hasher.hash("secret"), "secret"))
+
+    def test_saturated_login_returns_503(self):
+        db.session.add(User(**USER_DATA_SQL))
+        db.session.commit()
+        real_run = password_hasher._run
+
+        def saturated(*args):
+            raise PasswordPoolSaturated()
+
+        password_hasher._run = saturated
+        try:
+            with app.test_client() as client:
+                resp = client.post("/auth/login", json={
+                    "username": "testuser1", "password": "secret"})
+        finally:
+            password_hasher._run = real_run
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers["Retry-After"], "1")
+
+
+
+class BatchReadTestCase(TestCase):
+    """Tests for multi-get endpoints and the request-scoped loader."""
+
+    def setUp(self):
+        Listing.query.delete()
+        User.query.delete()
+        db.session.add(User(**USER_DATA_SQL))
+        listings = [Listing(street=f"{n} Main", **LISTING_DATA)
+                    for n in range(3)]
+        db.session.add_all(listings)
+        db.session.flush()
+        booking = Booking(username="testuser1", property_id=listings[0].id,
+                          check_in_date="2023-01-01",
+                          check_out_date="2023-01-02",
+                          booking_price_per_night=10)
+        db.session.add(booking)
+        db.session.commit()
+
+        self.listing_ids = [listing.id for listing in listings]
+        self.booking_id = booking.id
+        db.session.expunge_all()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_listings_by_ids(self):
+        """test ids come back in order, deduplicated, misses reported"""
+
+        first, second, _ = self.listing_ids
+
+        with app.test_client() as client:
+            with count_queries() as statements:
+                resp = client.get(
+                    f"/listings?ids={second},{first},{second},0")
+
+        self.assertEqual([l["id"] for l in resp.json["listings"]],
+                         [second, first])
+        self.assertEqual(resp.json["missing"], [0])
+        self.assertEqual(len(resp.json["listings"][1]["bookings"]), 1)
+        # The listings, then their bookings.
+        self.assertEqual(len(statements), 2)
+
+    def test_bookings_and_users_by_keys(self):
+        with app.test_client() as client:
+            bookings = client.get(f"/bookings?ids={self.booking_id},0")
+            users = client.get("/users?usernames=testuser1,nobody")
+            bad = client.get("/bookings?ids=1,x")
+
+        self.assertEqual(bookings.json["bookings"][0]["id"], self.booking_id)
+        self.assertEqual(bookings.json["missing"], [0])
+        self.assertEqual(users.json["users"][0]["username"], "testuser1")
+        self.assertEqual(users.json["missing"], ["nobody"])
+        self.assertEqual(bad.status_code, 400)
+
+    def test_batch(self):
+        """test a composite read runs one query per model, plus plans"""
+
+        with app.test_client() as client:
+            with count_queries() as statements:
+                resp = client.post("/batch", json={
+                    "listings": self.listing_ids + self.listing_ids,
+                    "bookings": [self.booking_id],
+                    "users": ["testuser1", "testuser1"],
+                })
+            bad = client.post("/batch", json={"listings": ["1"]})
+
+        self.assertEqual(len(resp.json["listings"]), 3)
+        self.assertEqual(len(resp.json["bookings"]), 1)
+        self.assertEqual(len(resp.json["users"]), 1)
+        self.assertEqual(resp.json["missing"],
+                         {"listings": [], "bookings": [], "users": []})
+        self.assertEqual(
+            sum("WHERE listings.id IN" in s for s in statements), 1)
+        self.assertEqual(sum("WHERE bookings.id IN" in s
+                             for s in statements), 1)
+        self.assertEqual(bad.status_code, 400)
+
+
+class FieldsetTestCase(TestCase):
+    """Tests for ?fields= and ?include= on read routes."""
+
+    def setUp(self):
+        Message.query.delete()
+        Listing.query.delete()
+        User.query.delete()
+        db.session.add(User(**USER_DATA_SQL))
+        listing = Listing(street="1 Main", **LISTING_DATA)
+        db.session.add(listing)
+        db.session.flush()
+        db.session.add(Booking(username="testuser1", property_id=listing.id,
+                               check_in_date="2023-01-01",
+                               check_out_date="2023-01-02",
+                               booking_price_per_night=10))
+        db.session.add(Message(body="hello", property_id=listing.id,
+                               from_username="testuser1"))
+        db.session.commit()
+
+        self.listing_id = listing.id
+        db.session.expunge_all()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_fields_select_only_those_columns(self):
+        with app.test_client() as client:
+            with count_queries() as statements:
+                resp = client.get(f"/listings/{self.listing_id}"
+                                  "?fields=id,title,price_per_night")
+
+        self.assertEqual(resp.json["listing"], {
+            "id": self.listing_id, "title": "test listing",
+            "price_per_night": 10})
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn("listings.details", statements[0])
+
+    def test_includes(self):
+        """test each include is one more query, with its own fields"""
+
+        with app.test_client() as client:
+            with count_queries() as statements:
+                resp = client.get(
+                    "/users/testuser1?fields=username"
+                    "&include=listings.bookings,sent_messages"
+                    "&fields[listings]=id,title&fields[bookings]=check_in_date"
+                    "&fields[messages]=body")
+
+        self.assertEqual(resp.json["user"], {
+            "username": "testuser1",
+            "listings": [{"id": self.listing_id, "title": "test listing",
+                          "bookings": [{"check_in_date": "2023-01-01"}]}],
+            "sent_messages": [{"body": "hello"}],
+        })
+        self.assertEqual(len(statements), 4)
+
+    def test_single_includes_and_pages(self):
+        with app.test_client() as client:
+            booking = client.get(
+                f"/bookings?fields=id&include=listing,guest"
+                f"&fields[listings]=title&fields[users]=first_name")
+            page = client.get("/listings?fields=title")
+            messages = client.get(
+                f"/listings/{self.listing_id}/messages?fields=body&limit=1")
+
+        self.assertEqual(booking.json["bookings"][0]["listing"],
+                         {"title": "test listing"})
+        self.assertEqual(booking.json["bookings"][0]["guest"],
+                         {"first_name": "firsttest"})
+        self.assertEqual(page.json["listings"], [{"title": "test listing"}])
+        self.assertEqual(messages.json["messages"], [{"body": "hello"}])
+
+    def test_batch_fields_per_kind(self):
+        with app.test_client() as client:
+            resp = client.post(
+                "/batch?fields[listings]=title&fields[users]=username",
+                json={"listings": [self.listing_id], "users": ["testuser1"]})
+
+        self.assertEqual(resp.json["listings"], [{"title": "test listing"}])
+        self.assertEqual(resp.json["users"], [{"username": "testuser1"}])
+
+    def test_batch_fields_of_other_kind(self):
+        """test fields for one kind leave the other kinds fully serialized"""
+
+        with app.test_client() as client:
+            full = client.post("/batch", json={"users": ["testuser1"]})
+            resp = client.post(
+                "/batch?fields[listings]=title",
+                json={"listings": [self.listing_id], "users": ["testuser1"]})
+
+        self.assertEqual(resp.json["listings"], [{"title": "test listing"}])
+        self.assertEqual(resp.json["users"], full.json["users"])
+
+    def test_unknown_fields(self):
+        with app.test_client() as client:
+            field = client.get(f"/listings/{self.listing_id}?fields=secret")
+            include = client.get("/users/testuser1?include=password")
+
+        self.assertEqual(field.status_code, 400)
+        self.assertEqual(field.json["error"]["message"],
+                         "Unknown listings fields: secret")
+        self.assertEqual(include.status_code, 400)
+
+
+class CascadingDeleteTestCase(TestCase):
+    """Deletes run as single statements and cascade in the database."""
+
+    def setUp(self):
+        Listing.query.delete()
+        User.query.delete()
+        db.session.add(User(**USER_DATA_SQL))
+        db.session.add(User(**{**USER_DATA_SQL, "username": "testuser2",
+                               "email": "email2@gmail.com"}))
+        listings = [Listing(street=f"{n} Main", **LISTING_DATA)
+                    for n in range(3)]
+        listings.append(Listing(street="Other St",
+                                **{**LISTING_DATA, "username": "testuser2"}))
+        db.session.add_all(listings)
+        db.session.flush()
+
+        for listing in listings:
+            db.session.add(Booking(username="testuser2",
+                                   property_id=listing.id,
+                                   check_in_date="2023-01-01",
+                                   check_out_date="2023-01-02",
+                                   booking_price_per_night=10))
+            db.session.add_all(Message(body=f"message {n}",
+                                       property_id=listing.id,
+                                       from_username="testuser2")
+                               for n in range(5))
+        db.session.commit()
+
+        self.listing_ids = [listing.id for listing in listings]
+        db.session.expunge_all()
+
+        token = create_access_token(identity={"username": "testuser1"},
+                                    additional_claims={"ver": 0})
+        self.headers = {"Authorization": f"Bearer {token}"}
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def remaining(self, model, property_id):
+        return model.query.filter_by(property_id=property_id).count()
+
+    def test_delete_listing(self):
+        """test one DELETE removes the listing, its bookings and messages"""
+
+        id = self.listing_ids[0]
+
+        with app.test_client() as client:
+            with count_queries() as statements:
+                resp = client.delete(f"/listings/{id}", headers=self.headers)
+            missing = client.delete(f"/listings/{id}", headers=self.headers)
+
+        self.assertEqual(resp.json["message"], "Deleted listing successfully")
+        self.assertEqual(sum(s.startswith("DELETE") for s in statements), 1)
+        self.assertEqual(self.remaining(Booking, id), 0)
+        self.assertEqual(self.remaining(Message, id), 0)
+        self.assertEqual(missing.status_code, 404)
+
+    def test_delete_listings_in_bulk(self):
+        first, second, _, others = self.listing_ids
+
+        with app.test_client() as client:
+            with count_queries() as statements:
+                resp = client.delete(
+                    "/users/testuser1/listings", headers=self.headers,
+                    json={"ids": [second, first, others, 0]})
+            bad = client.delete("/users/testuser1/listings",
+                                headers=self.headers, json={"ids": ["1"]})
+
+        self.assertEqual(resp.json["deleted"], [second, first])
+        self.assertEqual(resp.json["missing"], [others, 0])
+        self.assertEqual(sum(s.startswith("DELETE") for s in statements), 1)
+        self.assertEqual(Listing.query.count(), 2)
+        self.assertEqual(self.remaining(Message, first), 0)
+        self.assertEqual(self.remaining(Message, others), 5)
+        self.assertEqual(bad.status_code, 400)
+
+    def test_delete_user(self):
+        """test deleting a user takes their listings and messages along"""
+
+        with app.test_client() as client:
+            resp = client.delete("/users/testuser2")
+
+        self.assertEqual(resp.json["message"], "delete successfully")
+        self.assertEqual(Listing.query.count(), 3)
+        self.assertEqual(Booking.query.count(), 0)
+        self.assertEqual(Message.query.count(), 0)
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Tests for sending reads to a replica. Simulated by a second engine
+    on the test database unless TEST_REPLICA_DATABASE_URL names a real
+    standby."""
+
+    def setUp(self):
+        Listing.query.delete()
+        User.query.delete()
+        db.session.add(User(**USER_DATA_SQL))
+        listing = Listing(street="1 Main", **LISTING_DATA)
+        db.session.add(listing)
+        db.session.commit()
+        self.listing_id = listing.id
+
+        self.replica = replica_router.add(os.environ.get(
+            "TEST_REPLICA_DATABASE_URL", "postgresql:///sharebnb_test"))
+        replica_router.check()
+        replica_router.sticky.clear()
+
+        self.replica_statements = []
+        event.listen(self.replica.engine, "before_cursor_execute",
+                     self.on_replica)
+
+        token = create_access_token(identity={"username": "testuser1"},
+                                    additional_claims={"ver": 0})
+        self.headers = {"Authorization": f"Bearer {token}"}
+
+    def tearDown(self):
+        db.session.rollback()
+        replica_router.replicas.remove(self.replica)
+        self.replica.engine.dispose()
+        app.config["REPLICA_MAX_LAG"] = 2
+        app.config["RESPONSE_CACHE_ENABLED"] = False
+
+    def on_replica(self, conn, cursor, statement, *args):
+        # Leave out the background health checks.
+        if "pg_is_in_recovery" not in statement:
+            self.replica_statements.append(statement)
+
+    def read(self, client, **kwargs):
+        """GET the listing; returns (replica statements, primary ones)."""
+
+        self.replica_statements.clear()
+
+        with count_queries() as statements:
+            resp = client.get(f"/listings/{self.listing_id}", **kwargs)
+
+        self.assertEqual(resp.status_code, 200)
+        return len(self.replica_statements), len(statements)
+
+    def test_reads_go_to_replica(self):
+        self.assertTrue(self.replica.healthy)
+        self.assertEqual(self.replica.lag, 0)
+
+        with app.test_client() as client:
+            on_replica, on_primary = self.read(client)
+
+        self.assertGreater(on_replica, 0)
+        self.assertEqual(on_primary, 0)
+
+    def test_writers_read_their_writes_from_primary(self):
+        """test a write keeps its user, and only them, on the primary"""
+
+        with app.test_client() as client:
+            resp = client.post("/messages", headers=self.headers, json={
+                "body": "hi", "property_id": self.listing_id,
+                "from_username": "testuser1"})
+            writer = self.read(client, headers=self.headers)
+
+        # A client without the cookie sticks by user in this process only.
+        with app.test_client() as client:
+            cookieless = self.read(client, headers=self.headers)
+            other = self.read(client)
+
+            replica_router.sticky.clear()
+            later = self.read(client, headers=self.headers)
+
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(writer[0], 0)
+        self.assertEqual(cookieless[0], 0)
+        self.assertGreater(other[0], 0)
+        self.assertGreater(later[0], 0)
+
+    def test_sticky_cookie(self):
+        """test the write's cookie keeps reads on the primary in any
+        process, and a forged or expired one doesn't"""
+
+        with app.test_client() as client:
+            client.post("/messages", json={
+                "body": "hi", "property_id": self.listing_id,
+                "from_username": "testuser1"})
+            # As if the next read went to another worker process.
+            replica_router.sticky.clear()
+            sticky = self.read(client)
+
+            app.config["REPLICA_STICKY_SECONDS"] = -1
+            try:
+                expired = self.read(client)
+            finally:
+                app.config["REPLICA_STICKY_SECONDS"] = 5
+
+            client.set_cookie("read_primary", "forged", domain="localhost")
+            forged = self.read(client)
+
+        self.assertEqual(sticky[0], 0)
+        self.assertGreater(expired[0], 0)
+        self.assertGreater(forged[0], 0)
+
+    def test_sticky_reads_skip_cache(self):
+        """test a client that just wrote isn't served a cached page another
+        process's write may have made stale"""
+
+        app.config["RESPONSE_CACHE_ENABLED"] = True
+
+        with app.test_client() as client:
+            self.read(client)
+            generations = dict(response_cache._generations)
+            client.post("/messages", json={
+                "body": "hi", "property_id": self.listing_id,
+                "from_username": "testuser1"})
+            # As if the write went to another process: this one's cache
+            # still holds the page as current.
+            response_cache._generations = generations
+            response_cache._invalidated_at.clear()
+            on_replica, on_primary = self.read(client)
+
+        self.assertEqual(on_replica, 0)
+        self.assertGreater(on_primary, 0)
+
+    def test_falls_back_to_primary(self):
+        """test lagging or unreachable replicas take no reads"""
+
+        app.config["REPLICA_MAX_LAG"] = -1
+        replica_router.check()
+
+        with app.test_client() as client:
+            lagging = self.read(client)
+
+        app.config["REPLICA_MAX_LAG"] = 2
+        down = replica_router.add("postgresql://localhost:1/sharebnb_test")
+        try:
+            replica_router.replicas.remove(self.replica)
+            replica_router.check()
+            self.assertFalse(down.healthy)
+            self.assertIsNone(down.lag)
+
+            with app.test_client() as client:
+                unreachable = self.read(client)
+        finally:
+            replica_router.replicas.remove(down)
+            replica_router.replicas.append(self.replica)
+
+        self.assertEqual(lagging, (0, lagging[1]))
+        self.assertGreater(lagging[1], 0)
+        self.assertGreater(unreachable[1], 0)
+
+    def test_cache_renders_recent_changes_from_primary(self):
+        app.config["RESPONSE_CACHE_ENABLED"] = True
+        response_cache.invalidate(f"listing:{self.listing_id}")
+
+        with app.test_client() as client:
+            on_replica, on_primary = self.read(client)
+
+        self.assertEqual(on_replica, 0)
+        self.assertGreater(on_primary, 0)
+
+
+# The schema as the first release's db.create_all() made it.
+BASELINE_SCHEMA_SQL = """
+CREATE TABLE users (
+    username varchar(30) PRIMARY KEY,
+    first_name varchar(25) NOT NULL,
+    last_name varchar(25) NOT NULL,
+    email varchar(50) NOT NULL UNIQUE,
+    password varchar(100) NOT NULL,
+    is_host boolean NOT NULL
+);
+CREATE TABLE listings (
+    id serial PRIMARY KEY,
+    title varchar(40) NOT NULL,
+    details text NOT NULL,
+    street varchar(50) NOT NULL,
+    city varchar(30) NOT NULL,
+    longitude double precision NOT NULL,
+    latitude double precision NOT NULL,
+    state varchar(2) NOT NULL,
+    zip integer NOT NULL,
+    country varchar(3) NOT NULL,
+    price_per_night integer NOT NULL,
+    image_url varchar(255) NOT NULL,
+    username varchar(30) NOT NULL
+        REFERENCES users (username) ON DELETE CASCADE,
+    UNIQUE (street, city)
+);
+CREATE TABLE bookings (
+    id serial PRIMARY KEY,
+    username varchar(30) NOT NULL
+        REFERENCES users (username) ON DELETE CASCADE,
+    property_id integer NOT NULL
+        REFERENCES listings (id) ON DELETE CASCADE,
+    check_in_date date NOT NULL,
+    check_out_date date NOT NULL,
+    booking_price_per_night integer NOT NULL
+);
+CREATE TABLE messages (
+    id serial PRIMARY KEY,
+    from_username varchar(30) NOT NULL
+        REFERENCES users (username) ON DELETE CASCADE,
+    property_id integer NOT NULL
+        REFERENCES listings (id) ON DELETE CASCADE,
+    body text NOT NULL,
+    sent_at_date timestamp NOT NULL
+);
+INSERT INTO users VALUES
+    ('testuser1', 'first', 'last', 'email@gmail.com', 'password', true);
+INSERT INTO listings (title, details, street, city, longitude, latitude,
+                      state, zip, country, price_per_night, image_url,
+                      username)
+VALUES ('Cabin', 'Quiet cabin', '1 Main', 'Daly City', -122.47, 37.69,
+        'CA', 12345, 'USA', 10, 'https://img/cabin.jpg', 'testuser1');
+"""
+
+
+class MigrationTestCase(TestCase):
+    """Tests for versioned schema migrations."""
+
+    def setUp(self):
+        db.session.rollback()
+        db.session.close()
+
+    def indexes(self):
+        return set(db.session.scalars(db.text(
+            "SELECT indexname FROM pg_indexes WHERE schemaname = 'public'")))
+
+    def test_upgrade_empty_database(self):
+        """test migrations build the models' schema, once"""
+
+        db.drop_all()
+        schema_migrations.drop(db.engine, checkfirst=True)
+
+        self.assertEqual(upgrade(db.engine, echo=lambda line: None),
+                         [1, 2, 3, 4])
+        self.assertEqual(upgrade(db.engine, echo=lambda line: None), [])
+
+        model_indexes = {index.name for table in db.metadata.tables.values()
+                         for index in table.indexes}
+        self.assertLessEqual(model_indexes, self.indexes())
+
+    def columns(self):
+        rows = db.session.execute(db.text(
+            "SELECT table_name, column_name, is_nullable "
+            "FROM information_schema.columns WHERE table_schema = 'public'"))
+        return {(table, column): nullable == 'YES'
+                for table, column, nullable in rows}
+
+    def test_upgrade_baseline_schema(self):
+        """test a database made by the first release is brought up to the
+        models' schema, and its rows work with the app"""
+
+        db.drop_all()
+        schema_migrations.drop(db.engine, checkfirst=True)
+
+        with db.engine.begin() as connection:
+            connection.execute(db.text(BASELINE_SCHEMA_SQL))
+
+        self.assertEqual(upgrade(db.engine, echo=lambda line: None),
+                         [1, 2, 3, 4])
+
+        model_columns = {(table.name, column.name): column.nullable
+                         for table in db.metadata.tables.values()
+                         for column in table.columns}
+        self.assertLessEqual(model_columns.items(), self.columns().items())
+
+        model_indexes = {index.name for table in db.metadata.tables.values()
+                         for index in table.indexes}
+        self.assertLessEqual(model_indexes, self.indexes())
+
+        with app.test_client() as client:
+            resp = client.get("/listings?q=cabin")
+
+        self.assertEqual([(listing["title"], listing["geocode_status"])
+                          for listing in resp.json["listings"]],
+                         [("Cabin", "done")])
+        self.assertEqual(db.session.get(User, "testuser1").token_version, 0)
+
+    def test_upgrade_adds_missing_indexes(self):
+        """test a database from before the indexes gets them"""
+
+        upgrade(db.engine, echo=lambda line: None)
+
+        with db.engine.begin() as connection:
+            connection.execute(db.text(
+                "DROP INDEX ix_bookings_username, ix_listings_username"))
+            connection.execute(schema_migrations.delete().where(
+                schema_migrations.c.version == 2))
+
+        self.assertNotIn("ix_bookings_username", self.indexes())
+        db.session.rollback()
+
+        self.assertEqual(upgrade(db.engine, echo=lambda line: None), [2])
+        self.assertLessEqual({"ix_bookings_username", "ix_listings_username"},
+                             self.indexes())
+
+
+class MessageThreadTestCase(TestCase):
+    """Tests for paginated conversations on listings and per user."""
+
+    def setUp(self):
+        Listing.query.delete()
+        User.query.delete()
+        db.session.add(User(**USER_DATA_SQL))
+        db.session.add(User(**{**USER_DATA_SQL, "username": "guest",
+                               "email": "guest@gmail.com"}))
+        listings = [Listing(street=f"{n} Main", **LISTING_DATA)
+                    for n in range(2)]
+        db.session.add_all(listings)
+        db.session.flush()
+
+        # Sent out of id order, to check pages follow sent_at_date.
+        for n, minute in enumerate([5, 1, 3, 2, 4]):
+            for listing in listings:
+                db.session.add(Message(
+                    from_username="guest" if n % 2 else "testuser1",
+                    property_id=listing.id,
+                    body=f"message {n}",
+                    sent_at_date=datetime(2023, 6, 1, 12, minute)))
+
+        db.session.commit()
+        self.listing_ids = [listing.id for listing in listings]
+
+        token = create_access_token(identity={"username": "guest"},
+                                    additional_claims={"ver": 0})
+        self.headers = {"Authorization": f"Bearer {token}"}
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def pages(self, client, url, **kwargs):
+        messages = []
+
+        while url:
+            resp = client.get(url, **kwargs)
+            self.assertEqual(resp.status_code, 200)
+            self.assertLessEqual(len(resp.json["messages"]), 2)
+            messages.extend(resp.json["messages"])
+            cursor = resp.json["next"]
+            url = cursor and f"{url.split('&cursor=')[0]}&cursor={cursor}"
+
+        return messages
+
+    def test_listing_messages(self):
+        """test a listing's conversation pages oldest first"""
+
+        listing_id = self.listing_ids[0]
+
+        with app.test_client() as client:
+            messages = self.pages(
+                client, f"/listings/{listing_id}/messages?limit=2")
+
+        self.assertEqual([m["body"] for m in messages],
+                         ["message 1", "message 3", "message 2",
+                          "message 4", "message 0"])
+        self.assertEqual({m["property_id"] for m in messages}, {listing_id})
+
+    def test_listing_messages_errors(self):
+        with app.test_client() as client:
+            missing = client.get("/listings/0/messages")
+            bad_cursor = client.get(
+                f"/listings/{self.listing_ids[0]}/messages?cursor=nope")
+
+        self.assertEqual(missing.status_code, 404)
+        self.assertEqual(bad_cursor.status_code, 400)
+
+    def test_user_messages(self):
+        """test a user's conversations page by listing, then time"""
+
+        with app.test_client() as client:
+            messages = self.pages(client, "/users/guest/messages?limit=2",
+                                  headers=self.headers)
+            thread = client.get(
+                f"/users/guest/messages?property_id={self.listing_ids[1]}",
+                headers=self.headers)
+            other = client.get("/users/testuser1/messages",
+                               headers=self.headers)
+
+        self.assertEqual(
+            [(m["property_id"], m["body"]) for m in messages],
+            [(id, body) for id in self.listing_ids
+             for body in ("message 1", "message 3")])
+        self.assertEqual([m["body"] for m in thread.json["messages"]],
+                         ["message 1", "message 3"])
+        self.assertEqual(other.status_code, 401)
+
+    def test_host_sees_guest_messages(self):
+        token = create_access_token(identity={"username": "testuser1"},
+                                    additional_claims={"ver": 0})
+
+        with app.test_client() as client:
+            resp = client.get("/users/testuser1/messages?limit=100",
+                              headers={"Authorization": f"Bearer {token}"})
+
+        self.assertEqual(len(resp.json["messages"]), 10)
+        self.assertIsNone(resp.json["next"])
+
+
+class MessageStreamTestCase(TestCase):
+    """Tests for pushing new messages over Server-Sent Events."""
+
+    def setUp(self):
+        Listing.query.delete()
+        User.query.delete()
+        db.session.add(User(**USER_DATA_SQL))
+        listing = Listing(street="1 Main", **LISTING_DATA)
+        db.session.add(listing)
+        db.session.commit()
+        self.listing_id = listing.id
+
+        app.config['MESSAGE_STREAM_HEARTBEAT'] = 0.2
+
+    def tearDown(self):
+        app.config['MESSAGE_STREAM_HEARTBEAT'] = 15.0
+        app.config['MESSAGE_STREAM_BUFFER'] = 100
+        db.session.rollback()
+
+    def post_message(self, client, body):
+        resp = client.post("/messages", json={
+            "body": body, "property_id": self.listing_id,
+            "from_username": "testuser1"})
+        return resp.json["message"]["id"]
+
+    def next_event(self, chunks):
+        """The next message event from a stream, skipping keepalives."""
+
+        for _ in range(50):
+            chunk = next(chunks)
+            chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
+            if chunk.startswith("id: "):
+                return chunk
+
+        self.fail("no message event")
+
+    def test_messages_commit_in_id_order(self):
+        """test a message insert waits for its streams' order locks, and
+        only for those"""
+
+        posted = []
+
+        def post():
+            with app.test_client() as client:
+                posted.append(self.post_message(client, "waiting"))
+
+        # The listing's lock, then the sender's, who is also the host.
+        locks = message_order_locks(self.listing_id, "testuser1", "testuser1")
+        self.assertEqual(len(locks), 2)
+        self.assertEqual(locks[0], (LISTING_ORDER_LOCK, self.listing_id))
+
+        for lock, waits in [((LISTING_ORDER_LOCK, self.listing_id + 1), False),
+                            ((LISTING_ORDER_LOCK, self.listing_id), True)]:
+            with db.engine.connect() as connection:
+                connection.execute(
+                    db.text("SELECT pg_advisory_xact_lock(:ns, :key)"),
+                    {"ns": lock[0], "key": lock[1]})
+                thread = threading.Thread(target=post)
+                thread.start()
+                thread.join(timeout=0.5)
+                self.assertEqual(thread.is_alive(), waits)
+                connection.rollback()
+
+            thread.join(timeout=5)
+
+        self.assertEqual(len(posted), 2)
+
+    def test_replay_then_push(self):
+        """test a reconnect replays missed messages, then pushes new ones"""
+
+        with app.test_client() as client:
+            seen = self.post_message(client, "seen")
+            self.post_message(client, "missed")
+
+            resp = client.get(
+                f"/listings/{self.listing_id}/messages/stream",
+                headers={"Last-Event-ID": str(seen)}, buffered=False)
+            chunks = iter(resp.response)
+
+            self.assertEqual(resp.mimetype, "text/event-stream")
+            self.assertIn('"body":"missed"', self.next_event(chunks))
+
+            new_id = self.post_message(client, "live")
+            event = self.next_event(chunks)
+            resp.close()
+
+        self.assertTrue(event.startswith(f"id: {new_id}\nevent: message\n"))
+        self.assertIn('"body":"live"', event)
+        self.assertEqual(message_stream.subscriber_count(), 0)
+
+    def test_slow_consumer_dropped(self):
+        """test a subscriber with a full buffer is disconnected"""
+
+        app.config['MESSAGE_STREAM_BUFFER'] = 1
+        subscription = message_stream.subscribe(("user", "testuser1"))
+        rows = [SimpleNamespace(
+                    id=n, body="hi", from_username="guest",
+                    property_id=self.listing_id, sent_at_date=datetime.now(),
+                    host="testuser1")
+                for n in range(2)]
+
+        message_stream.publish(rows)
+
+        self.assertTrue(subscription.closed)
+        self.assertEqual(message_stream.subscriber_count(), 0)
+
+    def test_stream_errors(self):
+        with app.test_client() as client:
+            missing = client.get("/listings/0/messages/stream")
+            bad_id = client.get(
+                f"/listings/{self.listing_id}/messages/stream",
+                headers={"Last-Event-ID": "abc"})
+            other = client.get("/users/someone/messages/stream")
+
+        self.assertEqual(missing.status_code, 404)
+        self.assertEqual(bad_id.status_code, 400)
+        self.assertEqual(other.status_code, 401)
+
+
+class ResponseCacheTestCase(TestCase):
+    """Tests for cached listing reads and their invalidation."""
+
+    def setUp(self):
+        Listing.query.delete()
+        User.query.delete()
+        db.session.add(User(**USER_DATA_SQL))
+        listing = Listing(street="1 Main", **LISTING_DATA)
+        db.session.add(listing)
+        db.session.commit()
+        self.listing_id = listing.id
+
+        app.config['RESPONSE_CACHE_ENABLED'] = True
+        response_cache.store.clear()
+
+    def tearDown(self):
+        app.config['RESPONSE_CACHE_ENABLED'] = False
+        db.session.rollback()
+
+    def test_cached_until_invalidated(self):
+        """test repeat reads skip the DB until a write touches them"""
+
+        url = f"/listings/{self.listing_id}/messages"
+
+        with app.test_client() as client:
+            first = client.get(url)
+            with count_queries() as statements:
+                second = client.get(url)
+            self.assertEqual(statements, [])
+            self.assertEqual(second.get_data(), first.get_data())
+
+            client.post("/messages", json={
+                "body": "hello", "property_id": self.listing_id,
+                "from_username": "testuser1"})
+            third = client.get(url)
+
+        self.assertEqual(len(third.json["messages"]), 1)
+        self.assertNotEqual(third.headers["ETag"], first.headers["ETag"])
+
+    def test_conditional_get(self):
+        """test a matching If-None-Match gets an empty 304, and
+        If-Modified-Since, too coarse to trust, the full response"""
+
+        with app.test_client() as client:
+            first = client.get("/listings")
+            resp = client.get("/listings", headers={
+                "If-None-Match": first.headers["ETag"]})
+            since = client.get("/listings", headers={
+                "If-Modified-Since": first.headers["Last-Modified"]})
+
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.get_data(), b"")
+        self.assertEqual(resp.headers["ETag"], first.headers["ETag"])
+        self.assertEqual(since.status_code, 200)
+        self.assertEqual(since.get_data(), first.get_data())
+
+    def test_deleted_guest_leaves_listing(self):
+        """test deleting a guest refreshes listings they had booked"""
+
+        db.session.add(User(**{**USER_DATA_SQL, "username": "guest",
+                               "email": "guest@gmail.com"}))
+        db.session.add(Booking(username="guest", property_id=self.listing_id,
+                               check_in_date="2023-01-01",
+                               check_out_date="2023-01-02",
+                               booking_price_per_night=10))
+        db.session.commit()
+
+        url = f"/listings/{self.listing_id}"
+
+        with app.test_client() as client:
+            before = client.get(url)
+            client.delete("/users/guest")
+            after = client.get(url)
+
+        self.assertEqual(len(before.json["listing"]["bookings"]), 1)
+        self.assertEqual(after.json["listing"]["bookings"], [])
+
+    def test_message_keeps_list_pages(self):
+        """test a new message doesn't invalidate compact list pages"""
+
+        hits = metrics.value("response_cache_hits_total")
+
+        with app.test_client() as client:
+            client.get("/listings")
+            client.post("/messages", json={
+                "body": "hello", "property_id": self.listing_id,
+                "from_username": "testuser1"})
+            client.get("/listings")
+
+        self.assertEqual(metrics.value("response_cache_hits_total"), hits + 1)
+
+    def test_booking_refreshes_availability(self):
+        """test a booking invalidates availability searches, through the
+        bookings tag, but not pages that don't read bookings"""
+
+        url = "/listings?available_from=2023-01-01&available_to=2023-01-03"
+        nearby = "/listings/nearby?lat=37.69&lng=-122.47"
+
+        with app.test_client() as client:
+            before = client.get(url)
+            client.get(nearby)
+            client.post("/bookings", json={
+                "username": "testuser1", "property_id": self.listing_id,
+                "check_in_date": "2023-01-01", "check_out_date": "2023-01-02",
+                "booking_price_per_night": 10})
+            after = client.get(url)
+            hits = metrics.value("response_cache_hits_total")
+            client.get(nearby)
+
+        self.assertEqual(len(before.json["listings"]), 1)
+        self.assertEqual(after.json["listings"], [])
+        self.assertEqual(metrics.value("response_cache_hits_total"), hits + 1)
+
+    def test_included_rows_invalidated(self):
+        """test pages embedding a user or messages refresh when they change"""
+
+        token = create_access_token(identity={"username": "testuser1"},
+                                    additional_claims={"ver": 0})
+        headers = {"Authorization": f"Bearer {token}"}
+        url = f"/listings/{self.listing_id}?include=host.sent_messages"
+
+        with app.test_client() as client:
+            before = client.get(url)
+            client.patch("/users/testuser1", headers=headers,
+                         json={"firstName": "renamed"})
+            renamed = client.get(url)
+            client.post("/messages", json={
+                "body": "hello", "property_id": self.listing_id,
+                "from_username": "testuser1"})
+            messaged = client.get(url)
+
+        self.assertEqual(before.json["listing"]["host"]["first_name"],
+                         "firsttest")
+        self.assertEqual(renamed.json["listing"]["host"]["first_name"],
+                         "renamed")
+        self.assertEqual(
+            [m["body"] for m in messaged.json["listing"]["host"]
+             ["sent_messages"]],
+            ["hello"])
+
+
+class DbPoolTestCase(TestCase):
+    """Tests for connection pool configuration and metrics."""
+
+    def test_engine_options(self):
+        options = engine_options("postgresql:///sharebnb", {
+            "DB_POOL_SIZE": "20", "DB_POOL_PRE_PING": "false"})
+
+        self.assertIs(options["poolclass"], TimedQueuePool)
+        self.assertEqual(options["pool_size"], 20)
+        self.assertEqual(options["max_overflow"], 10)
+        self.assertFalse(options["pool_pre_ping"])
+
+        options = engine_options("postgresql+asyncpg:///sharebnb", {})
+        self.assertIs(options["poolclass"], TimedAsyncQueuePool)
+
+    def test_pgbouncer_options(self):
+        options = engine_options("postgresql+asyncpg:///sharebnb",
+                                 {"DB_PGBOUNCER": "true"})
+
+        self.assertIs(options["poolclass"], NullPool)
+        self.assertEqual(options["connect_args"]["statement_cache_size"], 0)
+
+        with self.assertRaises(ValueError):
+            engine_options("postgresql:///sharebnb", {"DB_POOL": "static"})
+
+    def test_pool_metrics(self):
+        """test checkouts are counted and the pool is exported as gauges"""
+
+        checkouts = metrics.value("db_pool_checkouts_total")
+
+        with app.test_client() as client:
+            client.get("/listings")
+            resp = client.get("/metrics")
+
+        self.assertGreater(metrics.value("db_pool_checkouts_total"), checkouts)
+        self.assertIn("db_pool_checked_out ", resp.get_data(as_text=True))
@@ -1,45 +1,145 @@
 import boto3
 import uuid
 import os
+import threading
+import time
 from dotenv import load_dotenv
-from botocore.exceptions import ClientError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 import logging
 
+from metrics import metrics
+
 load_dotenv()
 
 BUCKET_NAME = os.environ["BUCKET_NAME"]
+AMAZON_BASE_URL = "https://sharebnb-bucket.s3.us-west-1.amazonaws.com"
 ALLOWED_EXTENSIONS = {'png', 'jpeg', 'jpg'}
 
 # def allowed_file(filename):
 #     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-aws_access_key_id = os.environ['aws_access_key_id']
-aws_secret_access_key = os.environ['aws_secret_access_key']
+# Unset keys fall back to boto3's default chain (instance role, ~/.aws, ...).
+aws_access_key_id = os.environ.get('aws_access_key_id')
+aws_secret_access_key = os.environ.get('aws_secret_access_key')
+
+# Point at MinIO or another S3 stand-in for local development.
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')
+
+MB = 1024 * 1024
+
+# Phone photos are a few MB: send them in one PUT, and split anything
+# bigger into 8MB parts uploaded 4 at a time.
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * MB,
+    multipart_chunksize=8 * MB,
+    max_concurrency=4,
+    use_threads=True,
+)
+
+# One connection pool shared by every request thread (and the transfer
+# threads above), instead of a new client and pool per upload.
+CLIENT_CONFIG = Config(
+    region_name="us-west-1",
+    max_pool_connections=32,
+    retries={'max_attempts': 3, 'mode': 'standard'},
+)
+
+metrics.describe('s3_uploads_total', 'S3 uploads, by outcome.')
+metrics.describe('s3_upload_seconds_total', 'Wall time spent uploading to S3.')
+metrics.describe('s3_upload_bytes_total', 'Bytes uploaded to S3.')
+
+
+class S3Uploader:
+    """Long-lived S3 uploader shared across threads.
+
+    boto3 clients are thread-safe once created, so one client (and its
+    connection pool) is built lazily and reused. Pass `client` to use a
+    local S3 stand-in in tests.
+    """
+
+    def __init__(self, bucket, client=None, transfer_config=TRANSFER_CONFIG):
+        self.bucket = bucket
+        self.transfer_config = transfer_config
+        self._client = client
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = boto3.client(
+                        "s3",
+                        endpoint_url=S3_ENDPOINT_URL,
+                        aws_access_key_id=aws_access_key_id,
+                        aws_secret_access_key=aws_secret_access_key,
+                        config=CLIENT_CONFIG,
+                    )
+        return self._client
+
+    def upload(self, fileobj, key, content_type=None):
+        """Stream `fileobj` to `key` in the bucket. Returns True on success."""
+
+        extra_args = {'ContentType': content_type} if content_type else None
+        uploaded = 0
+        # Multipart uploads call back from several transfer threads at once.
+        counted = threading.Lock()
+
+        def count_bytes(n):
+            nonlocal uploaded
+            with counted:
+                uploaded += n
+
+        started = time.perf_counter()
+
+        try:
+            self.client.upload_fileobj(
+                fileobj, self.bucket, key,
+                ExtraArgs=extra_args,
+                Callback=count_bytes,
+                Config=self.transfer_config)
+        except (BotoCoreError, ClientError) as e:
+            logging.error(e)
+            metrics.inc('s3_uploads_total', outcome='error')
+            return False
+        finally:
+            metrics.inc('s3_upload_seconds_total',
+                        time.perf_counter() - started)
+            metrics.inc('s3_upload_bytes_total', uploaded)
+
+        metrics.inc('s3_uploads_total', outcome='ok')
+        return True
+
+
+s3_uploader = S3Uploader(BUCKET_NAME)
+
+
+def new_key(filename):
+    """A fresh, unique object key keeping `filename`'s extension."""
+
+    return uuid.uuid4().hex + '.' + filename.rsplit('.', 1)[1].lower()
+
 
 def uploadFileToS3(file):
 
     """
     Takes a file, set a new file name based, upload to a Amazon s3 bucket.
-    Returns the new file name 
+    Returns the new file name, or False if the upload failed.
+
+    The Werkzeug FileStorage's underlying stream is handed to boto3 as-is,
+    so large uploads are read in chunks rather than buffered whole.
     """
 
     uploaded_file = file
     # if not allowed_file(uploaded_file.filename):
     #     return "FILE NOT ALLOWED!"
 
-    new_filename = uuid.uuid4().hex + '.' + uploaded_file.filename.rsplit('.', 1)[1].lower()
-
-    s3 = boto3.client(
-        "s3",
-        "us-west-1",
-        aws_access_key_id= aws_access_key_id,
-        aws_secret_access_key= aws_secret_access_key,
-    )
+    new_filename = new_key(uploaded_file.filename)
 
-    try:
-        s3.upload_fileobj(uploaded_file, BUCKET_NAME, new_filename )
+    if s3_uploader.upload(uploaded_file.stream, new_filename,
+                          content_type=uploaded_file.mimetype):
         return new_filename
-    except ClientError as e:
-        logging.error(e)
-        return False
 
+    return False
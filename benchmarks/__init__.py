@@ -0,0 +1,17 @@
+"""Benchmarks for shareBnB hot paths.
+
+Run from the project root, e.g. ``python -m benchmarks.search_bench``.
+Benchmarks seed their own database (``sharebnb_bench`` unless
+BENCH_DATABASE_URL is set), so never point them at real data.
+"""
+
+import os
+
+BENCH_DATABASE_URL = os.environ.get(
+    'BENCH_DATABASE_URL', 'postgresql:///sharebnb_bench')
+
+
+def use_bench_database():
+    """Point the app at the benchmark database. Call before importing app."""
+
+    os.environ['DATABASE_URL'] = BENCH_DATABASE_URL
@@ -0,0 +1,221 @@
+"""Deterministic synthetic dataset: users, listings, bookings and messages.
+
+    python -m benchmarks.dataset --listings 1000000
+
+Rows are generated server-side with generate_series. Every "random" choice
+is a hash of the row number and a salt, so the same scale always produces
+the same data, whatever the query plan. Choices are skewed the way real
+traffic is: a few hosts own most listings, a few cities hold most of them,
+and popular listings get most bookings and messages.
+"""
+
+import argparse
+import time
+
+from benchmarks import use_bench_database
+
+use_bench_database()
+
+from sqlalchemy import text  # noqa: E402
+
+from app import app  # noqa: E402,F401
+from benchmarks.listings import (  # noqa: E402
+    ADJECTIVES, DETAILS, NOUNS, _sql_array)
+from models import db  # noqa: E402
+from passwords import password_hasher  # noqa: E402
+
+# Everyone's password, so login benchmarks can sign in as any user.
+PASSWORD = 'password'
+
+# (city, state, latitude, longitude), most popular first.
+CITIES = [
+    ('New York', 'NY', 40.7128, -74.0060),
+    ('Los Angeles', 'CA', 34.0522, -118.2437),
+    ('San Francisco', 'CA', 37.7749, -122.4194),
+    ('Miami', 'FL', 25.7617, -80.1918),
+    ('Austin', 'TX', 30.2672, -97.7431),
+    ('Seattle', 'WA', 47.6062, -122.3321),
+    ('Chicago', 'IL', 41.8781, -87.6298),
+    ('Denver', 'CO', 39.7392, -104.9903),
+    ('Nashville', 'TN', 36.1627, -86.7816),
+    ('Portland', 'OR', 45.5152, -122.6784),
+    ('New Orleans', 'LA', 29.9511, -90.0715),
+    ('San Diego', 'CA', 32.7157, -117.1611),
+    ('Boston', 'MA', 42.3601, -71.0589),
+    ('Savannah', 'GA', 32.0809, -81.0912),
+    ('South Lake Tahoe', 'NV', 38.9399, -119.9772),
+    ('Napa', 'CA', 38.2975, -122.2869),
+    ('Asheville', 'NC', 35.5951, -82.5515),
+    ('Sedona', 'AZ', 34.8697, -111.7610),
+    ('Bar Harbor', 'ME', 44.3876, -68.2039),
+    ('Moab', 'UT', 38.5733, -109.5498),
+]
+
+STREETS = ['Main St', 'Oak Ave', 'Pine St', 'Maple Dr', 'Cedar Ln',
+           'Elm St', 'Lake Rd', 'Hill St', 'Park Ave', 'River Rd']
+FIRST_NAMES = ['Ava', 'Ben', 'Chloe', 'Dan', 'Emma', 'Finn', 'Grace', 'Hugo',
+               'Isla', 'Jack', 'Kai', 'Luna', 'Maya', 'Noah', 'Owen', 'Pia']
+LAST_NAMES = ['Smith', 'Garcia', 'Chen', 'Patel', 'Kim', 'Nguyen', 'Brown',
+              'Lopez', 'Cohen', 'Silva', 'Okafor', 'Wright']
+
+# Rows per INSERT ... SELECT; each chunk is its own transaction.
+CHUNK_SIZE = 500_000
+
+
+def rand(expr, salt):
+    """SQL: a deterministic float in [0, 1) derived from `expr` and `salt`."""
+
+    return (f"((hashint8(({expr})::bigint * 1000003 + {salt})"
+            f" & 2147483647)::float8 / 2147483648)")
+
+
+def skewed(n, expr, salt, power):
+    """SQL: a 1-based index into `n` items, biased toward the first ones.
+
+    power=1 is uniform; with power=3 the top 1% of items get about a fifth
+    of the picks.
+    """
+
+    return f"(1 + floor({n} * power({rand(expr, salt)}, {power})))::int"
+
+
+def pick(values, expr, salt, power=1):
+    """SQL: an element of `values` chosen by skewed()."""
+
+    return f"({_sql_array(values)})[{skewed(len(values), expr, salt, power)}]"
+
+
+def dataset_size(listings, users=None, hosts=None, bookings=None,
+                 messages=None):
+    """Fill in row counts not given explicitly, relative to `listings`."""
+
+    users = users or max(10, listings // 5)
+    return {
+        'listings': listings,
+        'users': users,
+        'hosts': hosts or max(1, users // 10),
+        'bookings': listings * 2 if bookings is None else bookings,
+        'messages': listings if messages is None else messages,
+    }
+
+
+def _chunks(total):
+    for start in range(1, total + 1, CHUNK_SIZE):
+        yield start, min(start + CHUNK_SIZE - 1, total)
+
+
+def _insert(sql, total, params, label):
+    for start, stop in _chunks(total):
+        db.session.execute(text(sql), {**params, 'start': start, 'stop': stop})
+        db.session.commit()
+        print(f"  {label}: {stop}/{total}", flush=True)
+
+
+def generate_dataset(listings, users=None, hosts=None, bookings=None,
+                     messages=None, create_schema=db.create_all):
+    """Recreate the schema with `create_schema()` and fill it with a
+    synthetic dataset.
+
+    Users are user1..userN and the first `hosts` of them are hosts, so
+    user1 is the busiest host. Listing ids run 1..listings, and messages
+    favour low ids. `bookings` is a target: the exact count depends on the
+    per-listing skew. Returns the row counts asked for.
+    """
+
+    size = dataset_size(listings, users, hosts, bookings, messages)
+
+    db.drop_all()
+    create_schema()
+
+    _insert(f"""
+        INSERT INTO users (username, first_name, last_name, email, password,
+                           is_host)
+        SELECT 'user' || i,
+               {pick(FIRST_NAMES, 'i', 1)},
+               {pick(LAST_NAMES, 'i', 2)},
+               'user' || i || '@example.com',
+               :password,
+               i <= :hosts
+        FROM generate_series(:start, :stop) AS i
+    """, size['users'],
+        {'hosts': size['hosts'], 'password': password_hasher.hash(PASSWORD)},
+        'users')
+
+    cities = [city for city, _, _, _ in CITIES]
+    city_index = skewed(len(CITIES), 'i', 13, 2)
+
+    _insert(f"""
+        INSERT INTO listings (title, details, street, city, state, zip,
+                              country, price_per_night, image_url, username,
+                              latitude, longitude, geocode_status)
+        SELECT {pick(ADJECTIVES, 'i', 10)} || ' ' || {pick(NOUNS, 'i', 11)},
+               'A place ' || {pick(DETAILS, 'i', 12)},
+               i || ' ' || {pick(STREETS, 'i', 14)},
+               ({_sql_array(cities)})[c],
+               ({_sql_array([state for _, state, _, _ in CITIES])})[c],
+               10000 + (i % 90000),
+               'USA',
+               (40 + 460 * power({rand('i', 15)}, 2))::int,
+               'https://example.com/listings/' || i || '.jpg',
+               'user' || {skewed(size['hosts'], 'i', 16, 3)},
+               (ARRAY[{', '.join(str(lat) for _, _, lat, _ in CITIES)}])[c]
+                   + ({rand('i', 17)} - 0.5) * 0.4,
+               (ARRAY[{', '.join(str(lng) for _, _, _, lng in CITIES)}])[c]
+                   + ({rand('i', 18)} - 0.5) * 0.4,
+               'done'
+        FROM (SELECT i, {city_index} AS c
+              FROM generate_series(:start, :stop) AS i) AS numbered
+    """, size['listings'], {}, 'listings')
+
+    # Bookings are generated per listing: listing l gets k(l) of them, with
+    # k skewed so a few listings are booked far more than average. A
+    # listing's n-th booking sits in its own week, so none overlap.
+    per_listing = size['bookings'] / size['listings']
+    _insert(f"""
+        INSERT INTO bookings (username, property_id, check_in_date,
+                              check_out_date, booking_price_per_night)
+        SELECT 'user' || {skewed(size['users'], 'l::bigint * 100000 + n', 20, 1)},
+               l,
+               DATE '2024-01-01'
+                   + (n * 7 + floor({rand('l::bigint * 100000 + n', 21)} * 3))::int,
+               DATE '2024-01-01'
+                   + (n * 7 + 3 + floor({rand('l::bigint * 100000 + n', 22)} * 4))::int,
+               (40 + 460 * power({rand('l', 15)}, 2))::int
+        FROM generate_series(:start, :stop) AS l,
+             generate_series(
+                 0, round(:per_listing * 5 * power({rand('l', 23)}, 4))::int - 1
+             ) AS n
+    """, size['listings'], {'per_listing': per_listing}, 'bookings')
+
+    _insert(f"""
+        INSERT INTO messages (from_username, property_id, body, sent_at_date)
+        SELECT 'user' || {skewed(size['users'], 'i', 30, 1)},
+               {skewed(size['listings'], 'i', 31, 2)},
+               'Is the place available ' || {pick(DETAILS, 'i', 32)} || '?',
+               TIMESTAMP '2024-01-01' + i * INTERVAL '37 seconds'
+        FROM generate_series(:start, :stop) AS i
+    """, size['messages'], {}, 'messages')
+
+    db.session.execute(text("ANALYZE"))
+    db.session.commit()
+
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--listings', type=int, default=10_000)
+    parser.add_argument('--users', type=int)
+    parser.add_argument('--hosts', type=int)
+    parser.add_argument('--bookings', type=int)
+    parser.add_argument('--messages', type=int)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    size = generate_dataset(args.listings, args.users, args.hosts,
+                            args.bookings, args.messages)
+    print(f"generated {size} in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Time deleting a listing with many messages, row by row vs set-based.
+
+    python -m benchmarks.delete_bench --messages 100000
+
+"orm" is how DELETE /listings/<id> used to work: load every message and
+session.delete() each one, then the listing. "set" is the route as it is
+now, a single DELETE with the messages and bookings removed by the
+foreign keys' ON DELETE CASCADE.
+"""
+
+import argparse
+import time
+
+from flask_jwt_extended import create_access_token
+from sqlalchemy import text
+
+from benchmarks import use_bench_database
+
+use_bench_database()
+
+from app import app  # noqa: E402
+from benchmarks.listings import seed_listings, BENCH_HOST  # noqa: E402
+from models import db, Listing  # noqa: E402
+
+
+def seed_listing(messages):
+    """A fresh listing with `messages` messages; returns its id."""
+
+    seed_listings(1)
+    id = db.session.execute(text("SELECT max(id) FROM listings")).scalar()
+
+    db.session.execute(text("""
+        INSERT INTO messages (from_username, property_id, body, sent_at_date)
+        SELECT :username, :id, 'Is it free that weekend? #' || i,
+               now() - i * interval '1 minute'
+        FROM generate_series(1, :messages) AS i
+    """), {'username': BENCH_HOST, 'id': id, 'messages': messages})
+    db.session.commit()
+
+    return id
+
+
+def delete_orm(id):
+    listing = db.session.get(Listing, id)
+
+    for message in listing.messages:
+        db.session.delete(message)
+
+    db.session.delete(listing)
+    db.session.commit()
+
+
+def delete_set(id):
+    with app.test_request_context():
+        token = create_access_token(identity={'username': BENCH_HOST},
+                                    additional_claims={'ver': 0})
+
+    with app.test_client() as client:
+        resp = client.delete(f"/listings/{id}",
+                             headers={'Authorization': f"Bearer {token}"})
+        assert resp.status_code == 200, resp.json
+
+
+MODES = {'orm': delete_orm, 'set': delete_set}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=100_000)
+    parser.add_argument('--modes', nargs='+', choices=MODES,
+                        default=list(MODES))
+    args = parser.parse_args()
+
+    app.config['RESPONSE_CACHE_ENABLED'] = False
+
+    for mode in args.modes:
+        id = seed_listing(args.messages)
+        db.session.expunge_all()
+
+        started = time.perf_counter()
+        MODES[mode](id)
+        elapsed = time.perf_counter() - started
+
+        print(f"{mode:<4} deleted a listing with {args.messages} messages "
+              f"in {elapsed * 1000:9.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+"""Drive the Flask app's endpoints against a synthetic dataset and report
+p50/p95/p99 latency and throughput per endpoint.
+
+    python -m benchmarks.endpoint_bench --listings 100000 --save-baseline main
+    python -m benchmarks.endpoint_bench --skip-seed --compare main
+
+Requests go through the app's test client, in process, so numbers cover
+routing, queries and serialization but not a real HTTP server. S3 and the
+geocoder are replaced by local stubs. The response cache is off unless
+--cache is given, so every request reaches the database.
+
+Baselines are saved as JSON under benchmarks/baselines/. --compare exits
+with status 1 if any endpoint's p95 got slower than --tolerance allows.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from benchmarks import use_bench_database
+
+use_bench_database()
+
+from PIL import Image  # noqa: E402
+from sqlalchemy import func  # noqa: E402
+
+from app import app, geocode_worker  # noqa: E402
+from awsUpload import s3_uploader  # noqa: E402
+from benchmarks.dataset import CITIES, PASSWORD, generate_dataset  # noqa: E402
+from benchmarks.timing import latency_stats, summarize  # noqa: E402
+from geoCode import GeoCoder  # noqa: E402
+from models import db, Listing, User  # noqa: E402
+from pagination import encode_cursor  # noqa: E402
+
+BASELINE_DIR = os.path.join(os.path.dirname(__file__), 'baselines')
+
+SEARCH_TERMS = ['cabin', 'beach house', 'hot tub', 'downtown', 'cozy loft',
+                'chalet denver', 'wineries']
+
+# name, and a function (rng, size) -> (method, url, test client kwargs).
+Scenario = namedtuple('Scenario', ['name', 'request'])
+
+
+class StubS3:
+    """S3 client stand-in that accepts and drops uploads."""
+
+    def upload_fileobj(self, fileobj, bucket, key, ExtraArgs=None,
+                       Callback=None, Config=None):
+        while chunk := fileobj.read(64 * 1024):
+            if Callback:
+                Callback(len(chunk))
+
+
+class StubLocation:
+    def __init__(self, latitude, longitude):
+        self.latitude = latitude
+        self.longitude = longitude
+
+
+class StubGeocoder:
+    """Geocoder stand-in: every address is somewhere in San Francisco."""
+
+    def geocode(self, address):
+        rng = random.Random(address)
+        return StubLocation(37.7 + rng.random() * 0.1,
+                            -122.5 + rng.random() * 0.1)
+
+
+def small_photo():
+    out = BytesIO()
+    Image.effect_noise((640, 480), 64).convert('RGB').save(out, 'JPEG')
+    return out.getvalue()
+
+
+PHOTO = small_photo()
+
+
+def _listing_id(rng, size):
+    # Traffic favours popular (low id) listings, like the dataset does.
+    return 1 + int(size['listings'] * rng.random() ** 2)
+
+
+def _city(rng):
+    return CITIES[int(len(CITIES) * rng.random() ** 2)]
+
+
+def _map_search(rng, size):
+    _, _, lat, lng = _city(rng)
+    bbox = f"{lng - 0.1:.3f},{lat - 0.1:.3f},{lng + 0.1:.3f},{lat + 0.1:.3f}"
+    return 'GET', f"/listings?bbox={bbox}&max_price=150", {}
+
+
+def _create_listing(rng, size):
+    n = rng.randrange(10 ** 9)
+    form = {
+        'title': 'Bench listing',
+        'details': 'Created by the endpoint benchmark',
+        'street': f"{n} Bench Blvd",
+        'city': 'San Francisco',
+        'state': 'CA',
+        'zip': '94110',
+        'country': 'USA',
+        'price_per_night': '120',
+        'username': f"user{1 + rng.randrange(size['hosts'])}",
+        'image': (BytesIO(PHOTO), 'photo.jpg', 'image/jpeg'),
+    }
+    return 'POST', '/listings', {'data': form,
+                                 'content_type': 'multipart/form-data'}
+
+
+SCENARIOS = [
+    Scenario('GET /listings', lambda rng, size: (
+        'GET', '/listings?limit=20', {})),
+    Scenario('GET /listings (deep page)', lambda rng, size: (
+        'GET', '/listings?limit=20&cursor='
+        + encode_cursor({'id': rng.randrange(size['listings'])}), {})),
+    Scenario('GET /listings?q=', lambda rng, size: (
+        'GET', f"/listings?q={rng.choice(SEARCH_TERMS)}", {})),
+    Scenario('GET /listings?bbox=&max_price=', _map_search),
+    Scenario('GET /listings?available_from=', lambda rng, size: (
+        'GET', '/listings?available_from=2024-01-08&available_to=2024-01-12',
+        {})),
+    Scenario('GET /listings/nearby', lambda rng, size: (
+        'GET', '/listings/nearby?lat={2}&lng={3}&radius_km=5'.format(
+            *_city(rng)), {})),
+    Scenario('GET /listings/<id>', lambda rng, size: (
+        'GET', f"/listings/{_listing_id(rng, size)}", {})),
+    Scenario('GET /users/<username>', lambda rng, size: (
+        'GET', f"/users/user{rng.randrange(size['hosts'], size['users']) + 1}",
+        {})),
+    Scenario('GET /users/<host>', lambda rng, size: (
+        'GET', f"/users/user{2 + rng.randrange(max(1, size['hosts'] - 1))}",
+        {})),
+    Scenario('POST /auth/login', lambda rng, size: (
+        'POST', '/auth/login',
+        {'json': {'username': f"user{1 + rng.randrange(size['users'])}",
+                  'password': PASSWORD}})),
+    Scenario('POST /listings', _create_listing),
+]
+
+
+def current_size():
+    """Row counts of the dataset already in the database."""
+
+    return {
+        'listings': db.session.query(func.max(Listing.id)).scalar() or 0,
+        'users': User.query.count(),
+        'hosts': User.query.filter_by(is_host=True).count(),
+    }
+
+
+def run_scenario(scenario, size, requests, concurrency, seed):
+    """Issue `requests` requests from `concurrency` threads.
+
+    Returns (latencies in ms, requests per second, error count).
+    """
+
+    rng = random.Random(f"{seed}:{scenario.name}")
+    calls = [scenario.request(rng, size) for _ in range(requests)]
+    latencies = []
+    errors = []
+
+    def call(request):
+        method, url, kwargs = request
+        with app.test_client() as client:
+            started = time.perf_counter()
+            resp = client.open(url, method=method, **kwargs)
+            latencies.append((time.perf_counter() - started) * 1000)
+        if resp.status_code >= 400:
+            errors.append(resp.status_code)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(call, calls))
+    elapsed = time.perf_counter() - started
+
+    return latencies, requests / elapsed, len(errors)
+
+
+def compare(results, baseline, tolerance):
+    """Print p95 and throughput against a baseline; True if any p95
+    regressed by more than `tolerance` (a fraction)."""
+
+    regressed = False
+
+    for name, result in results.items():
+        before = baseline['scenarios'].get(name)
+        if before is None:
+            print(f"{name:<40} (not in baseline)")
+            continue
+
+        change = result['p95'] / before['p95'] - 1 if before['p95'] else 0
+        flag = ''
+        if change > tolerance:
+            flag = '  REGRESSION'
+            regressed = True
+
+        print(f"{name:<40} p95 {before['p95']:9.2f} -> {result['p95']:9.2f}ms "
+              f"({change:+.0%})  rps {before['rps']:8.1f} -> "
+              f"{result['rps']:8.1f}{flag}")
+
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--listings', type=int, default=100_000)
+    parser.add_argument('--skip-seed', action='store_true')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='Requests per endpoint.')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--only', nargs='+', metavar='NAME',
+                        help='Run endpoints whose name contains NAME.')
+    parser.add_argument('--cache', action='store_true',
+                        help='Leave the response cache on.')
+    parser.add_argument('--save-baseline', metavar='NAME')
+    parser.add_argument('--compare', metavar='NAME')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed p95 slowdown vs the baseline.')
+    args = parser.parse_args()
+
+    app.config['RESPONSE_CACHE_ENABLED'] = args.cache
+    s3_uploader._client = StubS3()
+    geocode_worker.geo_coder = GeoCoder(geocoder=StubGeocoder())
+
+    if not args.skip_seed:
+        print(f"generating dataset with {args.listings} listings...")
+        generate_dataset(args.listings)
+
+    size = current_size()
+    print(f"dataset: {size}, {args.requests} requests per endpoint, "
+          f"concurrency {args.concurrency}\n")
+
+    results = {}
+
+    for scenario in SCENARIOS:
+        if args.only and not any(name in scenario.name for name in args.only):
+            continue
+
+        latencies, rps, errors = run_scenario(
+            scenario, size, args.requests, args.concurrency, args.seed)
+        results[scenario.name] = {**latency_stats(latencies),
+                                  'rps': round(rps, 1), 'errors': errors}
+        print(f"{summarize(scenario.name, latencies)}  "
+              f"{rps:8.1f} req/s  errors={errors}")
+
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        path = os.path.join(BASELINE_DIR, f"{args.save_baseline}.json")
+        with open(path, 'w') as f:
+            json.dump({'size': size, 'requests': args.requests,
+                       'concurrency': args.concurrency,
+                       'scenarios': results}, f, indent=2, sort_keys=True)
+        print(f"\nsaved baseline {path}")
+
+    if args.compare:
+        path = os.path.join(BASELINE_DIR, f"{args.compare}.json")
+        with open(path) as f:
+            baseline = json.load(f)
+        print(f"\ncompared with {path} (dataset {baseline['size']}):")
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
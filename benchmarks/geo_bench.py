@@ -0,0 +1,71 @@
+"""Latency of nearby (radius) and bbox listing search at several scales.
+
+    python -m benchmarks.geo_bench --scales 100000 1000000
+
+Each query also runs with index scans disabled, to show what the
+(latitude, longitude) index saves over a sequential scan.
+"""
+
+import argparse
+import random
+
+from benchmarks import use_bench_database
+
+use_bench_database()
+
+from sqlalchemy import text  # noqa: E402
+
+from app import app  # noqa: E402,F401
+from benchmarks.listings import seed_listings  # noqa: E402
+from benchmarks.timing import summarize, time_calls  # noqa: E402
+from models import db, Listing, LISTING_SUMMARY_COLUMNS  # noqa: E402
+from search import nearby_listings, within_bbox  # noqa: E402
+
+
+def random_center(rng):
+    # Same area benchmarks.listings spreads listings over.
+    return 25 + rng.random() * 24, -124 + rng.random() * 57
+
+
+def run(name, fn, repeat):
+    print(summarize(name, time_calls(fn, repeat)))
+
+    db.session.execute(text("SET enable_indexscan = off"))
+    db.session.execute(text("SET enable_bitmapscan = off"))
+    print(summarize(name + " (seq scan)", time_calls(fn, repeat)))
+    db.session.execute(text("RESET enable_indexscan"))
+    db.session.execute(text("RESET enable_bitmapscan"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--scales', type=int, nargs='+',
+                        default=[100_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args()
+
+    for rows in args.scales:
+        print(f"\nseeding {rows} listings...")
+        seed_listings(rows)
+        rng = random.Random(rows)
+
+        for radius_km in (5, 25, 100):
+            lat, lng = random_center(rng)
+            run(f"nearby {radius_km}km, first {args.limit}",
+                lambda: nearby_listings(
+                    db.session.query(*LISTING_SUMMARY_COLUMNS),
+                    lat, lng, radius_km, args.limit),
+                args.repeat)
+
+        lat, lng = random_center(rng)
+        run(f"bbox 1x1 degree, first {args.limit}",
+            lambda: (within_bbox(Listing.query, lng, lat, lng + 1, lat + 1)
+                     .order_by(Listing.id)
+                     .limit(args.limit)
+                     .all()),
+            args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Image pipeline throughput: images/second, total and per core.
+
+    python -m benchmarks.image_bench --images 48 --workers 1 2 4
+
+Renders every variant of a synthetic 12MP phone-sized JPEG in a process
+pool, like the pipeline does; no S3 or database involved.
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from PIL import Image
+
+from imagePipeline import render_variants
+
+
+def synthetic_photo(width=4032, height=3024):
+    """A JPEG with enough detail that encoders can't take shortcuts."""
+
+    noise = Image.effect_noise((width, height), 64).convert('RGB')
+    gradient = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    out = BytesIO()
+    Image.blend(noise, gradient, 0.5).save(out, 'JPEG', quality=90)
+    return out.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--images', type=int, default=48)
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=sorted({1, os.cpu_count()}))
+    args = parser.parse_args()
+
+    photo = synthetic_photo()
+    print(f"source: {len(photo) / 1024 / 1024:.1f}MB JPEG, "
+          f"{args.images} images per run")
+
+    for workers in args.workers:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # Warm the workers up so process start-up isn't measured.
+            list(pool.map(render_variants, [photo] * workers))
+
+            started = time.perf_counter()
+            list(pool.map(render_variants, [photo] * args.images))
+            elapsed = time.perf_counter() - started
+
+        rate = args.images / elapsed
+        print(f"workers={workers:<3} {rate:7.2f} images/s  "
+              f"{rate / workers:6.2f} images/s/core")
+
+
+if __name__ == '__main__':
+    main()
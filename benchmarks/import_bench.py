@@ -0,0 +1,77 @@
+"""Measure bulk import throughput (rows/s) for CSV and NDJSON, excluding
+geocoding: every generated row carries its coordinates.
+
+    python -m benchmarks.import_bench --rows 100000
+"""
+
+import argparse
+import csv
+import io
+import json
+import random
+import time
+
+from benchmarks import use_bench_database
+
+use_bench_database()
+
+from app import app  # noqa: E402,F401
+from benchmarks.listings import (  # noqa: E402
+    seed_listings, ADJECTIVES, DETAILS, NOUNS, PLACES, BENCH_HOST)
+from listingImport import import_listings  # noqa: E402
+
+FIELDS = ('title', 'details', 'street', 'city', 'state', 'zip', 'country',
+          'price_per_night', 'username', 'latitude', 'longitude')
+
+
+def generate_records(rows, rng):
+    for i in range(rows):
+        city, state = PLACES[i % len(PLACES)]
+        yield {
+            'title': f"{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)}",
+            'details': f"A place {rng.choice(DETAILS)}",
+            'street': f"{i} Import Ave",
+            'city': city,
+            'state': state,
+            'zip': 10000 + i % 90000,
+            'country': 'USA',
+            'price_per_night': 50 + i % 450,
+            'username': BENCH_HOST,
+            'latitude': 25 + rng.random() * 24,
+            'longitude': -124 + rng.random() * 57,
+        }
+
+
+def as_csv(records):
+    out = io.StringIO()
+    writer = csv.DictWriter(out, FIELDS)
+    writer.writeheader()
+    writer.writerows(records)
+    return out.getvalue()
+
+
+def as_ndjson(records):
+    return ''.join(json.dumps(record) + '\n' for record in records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=100_000)
+    args = parser.parse_args()
+
+    for format, encode in (('csv', as_csv), ('ndjson', as_ndjson)):
+        # Start from an empty listings table each time.
+        seed_listings(0)
+        body = encode(generate_records(args.rows, random.Random(args.rows)))
+
+        started = time.perf_counter()
+        report = import_listings(io.StringIO(body), format)
+        elapsed = time.perf_counter() - started
+
+        print(f"{format:<8} {report.imported} rows in {elapsed:6.2f}s "
+              f"= {report.imported / elapsed:9.0f} rows/s "
+              f"({len(report.errors)} errors)")
+
+
+if __name__ == '__main__':
+    main()
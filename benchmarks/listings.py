@@ -0,0 +1,69 @@
+from sqlalchemy import text
+
+from models import db
+
+BENCH_HOST = 'benchhost'
+
+ADJECTIVES = ['Cozy', 'Rustic', 'Modern', 'Sunny', 'Quiet', 'Spacious',
+              'Charming', 'Luxury', 'Tiny', 'Historic']
+NOUNS = ['Cabin', 'Loft', 'Cottage', 'Bungalow', 'Villa', 'Studio',
+         'Beach House', 'Farmhouse', 'Chalet', 'Apartment']
+PLACES = [('San Francisco', 'CA'), ('Los Angeles', 'CA'), ('Napa', 'CA'),
+          ('South Lake Tahoe', 'NV'), ('Portland', 'OR'), ('Seattle', 'WA'),
+          ('Austin', 'TX'), ('Denver', 'CO'), ('Chicago', 'IL'),
+          ('New York', 'NY')]
+DETAILS = ['close to the beach', 'surrounded by pine trees',
+           'walking distance to downtown', 'with a hot tub and mountain views',
+           'in a quiet residential neighborhood', 'next to wineries',
+           'with a fully equipped kitchen', 'perfect for a weekend getaway']
+
+
+def _sql_array(values):
+    return "ARRAY[" + ", ".join("'" + v.replace("'", "''") + "'"
+                                for v in values) + "]"
+
+
+def seed_listings(rows):
+    """Recreate the schema and insert `rows` synthetic listings in SQL.
+
+    Rows are generated server-side with generate_series, so seeding a
+    million listings takes seconds rather than an ORM round trip per row.
+    """
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.execute(text(
+        "INSERT INTO users (username, first_name, last_name, email, password,"
+        " is_host) VALUES (:username, 'Bench', 'Host', 'bench@example.com',"
+        " 'x', true)"), {'username': BENCH_HOST})
+
+    cities = _sql_array([city for city, _ in PLACES])
+    states = _sql_array([state for _, state in PLACES])
+
+    db.session.execute(text(f"""
+        INSERT INTO listings (title, details, street, city, state, zip,
+                              country, price_per_night, image_url, username,
+                              latitude, longitude, geocode_status)
+        SELECT
+            ({_sql_array(ADJECTIVES)})[1 + i % {len(ADJECTIVES)}] || ' ' ||
+                ({_sql_array(NOUNS)})[1 + (i / 7) % {len(NOUNS)}],
+            'A place ' ||
+                ({_sql_array(DETAILS)})[1 + (i / 3) % {len(DETAILS)}],
+            i || ' Bench St',
+            ({cities})[1 + (i / 11) % {len(PLACES)}],
+            ({states})[1 + (i / 11) % {len(PLACES)}],
+            10000 + i % 90000,
+            'USA',
+            50 + i % 450,
+            'https://example.com/' || i || '.jpg',
+            :username,
+            25 + random() * 24,
+            -124 + random() * 57,
+            'done'
+        FROM generate_series(1, :rows) AS i
+    """), {'rows': rows, 'username': BENCH_HOST})
+
+    db.session.commit()
+    db.session.execute(text("ANALYZE"))
+    db.session.commit()
@@ -0,0 +1,88 @@
+"""Login throughput, and cheap-read latency during a login burst, with
+bcrypt inline on request threads vs on the bounded password pool.
+
+    python -m benchmarks.login_bench --clients 16 --logins 200
+"""
+
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import use_bench_database
+
+use_bench_database()
+
+from app import app  # noqa: E402
+from benchmarks.timing import summarize  # noqa: E402
+from models import db, User  # noqa: E402
+from passwords import password_hasher  # noqa: E402
+
+
+def login(client):
+    resp = client.post('/auth/login',
+                       json={'username': 'benchuser', 'password': 'secret'})
+    return resp.status_code
+
+
+def run(clients, logins):
+    """Fire `logins` logins from `clients` threads while timing cheap reads."""
+
+    reads = []
+    statuses = []
+    burst_over = threading.Event()
+
+    def read_loop():
+        with app.test_client() as client:
+            while not burst_over.is_set():
+                started = time.perf_counter()
+                client.get('/listings?limit=1')
+                reads.append((time.perf_counter() - started) * 1000)
+
+    def one_login(_):
+        with app.test_client() as client:
+            statuses.append(login(client))
+
+    reader = threading.Thread(target=read_loop)
+    reader.start()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(one_login, range(logins)))
+    elapsed = time.perf_counter() - started
+
+    burst_over.set()
+    reader.join()
+
+    ok = statuses.count(200)
+    shed = statuses.count(503)
+    return ok / elapsed, shed, reads
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--rounds', type=int, default=12)
+    args = parser.parse_args()
+
+    db.drop_all()
+    db.create_all()
+    password_hasher.configure(rounds=args.rounds, workers=0, max_queue=0)
+    User.signup('benchuser', 'Bench', 'User', 'bench@example.com', 'secret',
+                False)
+
+    pool_workers = app.config['PASSWORD_WORKERS']
+    modes = [('inline', 0, 0),
+             (f'pool({pool_workers})', pool_workers, app.config['PASSWORD_MAX_QUEUE'])]
+
+    for name, workers, max_queue in modes:
+        password_hasher.configure(rounds=args.rounds, workers=workers,
+                                  max_queue=max_queue)
+        rate, shed, reads = run(args.clients, args.logins)
+        print(f"{name:<10} {rate:7.1f} logins/s  {shed} shed with 503")
+        print(summarize(f"  GET /listings during burst ({name})", reads))
+
+
+if __name__ == '__main__':
+    main()
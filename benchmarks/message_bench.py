@@ -0,0 +1,118 @@
+"""Concurrent POST /messages throughput under the message order locks.
+
+    python -m benchmarks.message_bench --concurrency 16 --messages 2000
+
+Each of `concurrency` threads posts messages through the app. "shared"
+puts every message on one listing, so they all queue on its stream lock;
+"spread" gives each thread a listing (and host) of its own, so they share
+no stream. --global-lock takes one lock for every message, as
+create_message used to, for comparison. Keep DB_POOL_SIZE at least
+`concurrency` so posts don't queue on the connection pool instead.
+"""
+
+import argparse
+import threading
+import time
+
+from sqlalchemy import text
+
+from benchmarks import use_bench_database
+from benchmarks.timing import latency_stats
+
+use_bench_database()
+
+import app as app_module  # noqa: E402
+from app import app  # noqa: E402
+from benchmarks.listings import seed_listings  # noqa: E402
+from messageStream import LISTING_ORDER_LOCK  # noqa: E402
+from models import db  # noqa: E402
+
+
+def seed_hosts(count):
+    """`count` listings, each with its own host; returns [(id, host)]."""
+
+    seed_listings(count)
+
+    db.session.execute(text("""
+        INSERT INTO users (username, first_name, last_name, email, password,
+                           is_host)
+        SELECT 'host' || id, 'Bench', 'Host', 'host' || id || '@example.com',
+               'x', true
+        FROM listings
+    """))
+    db.session.execute(text("UPDATE listings SET username = 'host' || id"))
+    db.session.commit()
+
+    return [tuple(row) for row in db.session.execute(
+        text("SELECT id, username FROM listings ORDER BY id"))]
+
+
+def lock_globally(property_id, from_username, host):
+    db.session.execute(text("SELECT pg_advisory_xact_lock(:id)"),
+                       {'id': LISTING_ORDER_LOCK})
+
+
+def run(targets, messages):
+    """Post `messages` messages, thread i to targets[i]; returns (seconds,
+    latency samples in ms)."""
+
+    per_thread = messages // len(targets)
+    samples = []
+    start = threading.Barrier(len(targets) + 1)
+
+    def post(property_id, username):
+        latencies = []
+        with app.test_client() as client:
+            start.wait()
+            for n in range(per_thread):
+                started = time.perf_counter()
+                resp = client.post("/messages", json={
+                    'body': f"Still free? #{n}", 'property_id': property_id,
+                    'from_username': username})
+                latencies.append((time.perf_counter() - started) * 1000)
+                assert resp.status_code == 201, resp.json
+        samples.extend(latencies)
+
+    threads = [threading.Thread(target=post, args=target)
+               for target in targets]
+    for thread in threads:
+        thread.start()
+
+    start.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+
+    return time.perf_counter() - started, samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--global-lock', action='store_true')
+    args = parser.parse_args()
+
+    app.config['RESPONSE_CACHE_ENABLED'] = False
+
+    if args.global_lock:
+        app_module.lock_message_order = lock_globally
+
+    with app.app_context():
+        listings = seed_hosts(args.concurrency)
+
+    layouts = {
+        'shared': [listings[0]] * args.concurrency,
+        'spread': listings,
+    }
+
+    for name, targets in layouts.items():
+        elapsed, samples = run(targets, args.messages)
+        stats = latency_stats(samples)
+        print(f"{name:<6} {len(samples) / elapsed:8.0f} msg/s  "
+              f"p50={stats['p50']:7.2f}ms p95={stats['p95']:7.2f}ms "
+              f"p99={stats['p99']:7.2f}ms  n={stats['n']}")
+
+
+if __name__ == '__main__':
+    main()
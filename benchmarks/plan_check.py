@@ -0,0 +1,211 @@
+"""EXPLAIN every query the read routes run against a large dataset, and
+fail on sequential scans or plan cost regressions.
+
+    python -m benchmarks.plan_check --listings 100000 --save-baseline main
+    python -m benchmarks.plan_check --skip-seed --compare main
+
+The schema is built by the migrations, like a deployed database. Each
+route is requested once through the test client; every SELECT it runs is
+then EXPLAINed with the same parameters. A route fails if a plan scans a
+table sequentially, unless ALLOWED_SEQ_SCANS expects it, or if its total
+estimated cost grew by more than --tolerance over the baseline.
+
+Baselines are saved as JSON under benchmarks/baselines/, next to the
+endpoint_bench ones. Exits with status 1 on any failure.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+from benchmarks import use_bench_database
+
+use_bench_database()
+
+from flask_jwt_extended import create_access_token  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+
+from app import app  # noqa: E402
+from benchmarks.dataset import generate_dataset  # noqa: E402
+from benchmarks.endpoint_bench import BASELINE_DIR, current_size  # noqa: E402
+from models import db  # noqa: E402
+from pagination import encode_cursor  # noqa: E402
+from schemaMigrations import schema_migrations, upgrade  # noqa: E402
+
+
+def host_headers():
+    with app.test_request_context():
+        token = create_access_token(identity={'username': 'user1'},
+                                    additional_claims={'ver': 0})
+    return {'Authorization': f"Bearer {token}"}
+
+
+# name -> (url, test client kwargs); user1 is the busiest host and the
+# last user a guest.
+def routes(size):
+    guest = f"user{size['users']}"
+    middle = size['listings'] // 2
+
+    return {
+        'GET /listings': ('/listings?limit=20', {}),
+        'GET /listings (deep page)': (
+            '/listings?limit=20&cursor=' + encode_cursor({'id': middle}), {}),
+        'GET /listings?q=': ('/listings?q=cabin', {}),
+        'GET /listings?bbox=&max_price=': (
+            '/listings?bbox=-122.52,37.70,-122.35,37.85&max_price=150', {}),
+        'GET /listings?available_from=': (
+            '/listings?available_from=2024-01-08&available_to=2024-01-12', {}),
+        'GET /listings/nearby': (
+            '/listings/nearby?lat=37.7749&lng=-122.4194&radius_km=5', {}),
+        'GET /listings/<id>': (f'/listings/{middle}', {}),
+        'GET /listings/<id>/messages': ('/listings/1/messages', {}),
+        'GET /listings?ids=': (f'/listings?ids=1,{middle},{middle + 1}', {}),
+        'GET /users/<guest>': (f'/users/{guest}', {}),
+        'GET /users/<host>': ('/users/user2', {}),
+        'GET /users/<host>?include=': (
+            '/users/user2?fields=username&include=listings.bookings,'
+            'sent_messages', {}),
+        'GET /users/<host>/messages': (
+            '/users/user1/messages', {'headers': host_headers()}),
+        'GET /messages/<id>': ('/messages/1', {}),
+        'GET /bookings?ids=': ('/bookings?ids=1,2,3', {}),
+    }
+
+
+# Routes whose plans may scan these tables, because Postgres rightly
+# prefers a scan at this scale.
+ALLOWED_SEQ_SCANS = {
+    # One IN list with every listing of a big host (2000 at 100k listings)
+    # reads a sizable share of bookings; a scan is cheaper than the index.
+    'GET /users/<host>?include=': {'bookings'},
+}
+
+
+def capture_selects(url, kwargs):
+    """Request `url`; returns the (statement, parameters) of its SELECTs."""
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, *args):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        with app.test_client() as client:
+            resp = client.get(url, **kwargs)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+
+    if resp.status_code != 200:
+        raise RuntimeError(f"{url} returned {resp.status_code}")
+
+    return statements
+
+
+def explain(statement, parameters):
+    """The JSON plan of a statement, as Postgres would run it."""
+
+    connection = db.engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + statement, parameters)
+            return cursor.fetchone()[0][0]['Plan']
+    finally:
+        connection.close()
+
+
+def seq_scans(plan):
+    """Tables a plan reads with a sequential scan."""
+
+    found = set()
+
+    if plan['Node Type'] == 'Seq Scan':
+        found.add(plan['Relation Name'])
+
+    for child in plan.get('Plans', ()):
+        found |= seq_scans(child)
+
+    return found
+
+
+def check_route(url, kwargs):
+    plans = [explain(statement, parameters)
+             for statement, parameters in capture_selects(url, kwargs)]
+
+    return {
+        'queries': len(plans),
+        'cost': round(sum(plan['Total Cost'] for plan in plans), 2),
+        'seq_scans': sorted(set().union(*map(seq_scans, plans))),
+    }
+
+
+def migrate():
+    """Build the schema from scratch with the migrations."""
+
+    schema_migrations.drop(db.engine, checkfirst=True)
+    upgrade(db.engine)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--listings', type=int, default=100_000)
+    parser.add_argument('--skip-seed', action='store_true')
+    parser.add_argument('--save-baseline', metavar='NAME')
+    parser.add_argument('--compare', metavar='NAME')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed growth in estimated cost.')
+    args = parser.parse_args()
+
+    app.config['RESPONSE_CACHE_ENABLED'] = False
+
+    if not args.skip_seed:
+        print(f"generating dataset with {args.listings} listings...")
+        db.session.close()
+        generate_dataset(args.listings, create_schema=migrate)
+
+    size = current_size()
+    baseline = None
+
+    if args.compare:
+        with open(os.path.join(BASELINE_DIR,
+                               f"plans-{args.compare}.json")) as f:
+            baseline = json.load(f)['routes']
+
+    results = {}
+    failed = False
+
+    for name, (url, kwargs) in routes(size).items():
+        result = results[name] = check_route(url, kwargs)
+        problems = []
+
+        unexpected = set(result['seq_scans']) - ALLOWED_SEQ_SCANS.get(
+            name, set())
+        if unexpected:
+            problems.append(f"seq scan on {', '.join(sorted(unexpected))}")
+
+        before = baseline and baseline.get(name)
+        if before and result['cost'] > before['cost'] * (1 + args.tolerance):
+            problems.append(f"cost {before['cost']} -> {result['cost']}")
+
+        failed = failed or bool(problems)
+        print(f"{name:<40} {result['queries']:2d} queries  "
+              f"cost {result['cost']:12.2f}"
+              f"{'  FAIL: ' + '; '.join(problems) if problems else ''}")
+
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        path = os.path.join(BASELINE_DIR, f"plans-{args.save_baseline}.json")
+        with open(path, 'w') as f:
+            json.dump({'size': size, 'routes': results}, f, indent=2,
+                      sort_keys=True)
+        print(f"\nsaved baseline {path}")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
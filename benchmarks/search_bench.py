@@ -0,0 +1,65 @@
+"""Compare listing search latency: old LIKE scan vs ranked full-text search.
+
+    python -m benchmarks.search_bench --rows 1000000
+"""
+
+import argparse
+
+from benchmarks import use_bench_database
+
+use_bench_database()
+
+from sqlalchemy import func  # noqa: E402
+
+from app import app  # noqa: E402,F401
+from benchmarks.listings import seed_listings  # noqa: E402
+from benchmarks.timing import summarize, time_calls  # noqa: E402
+from models import db, Listing, LISTING_SUMMARY_COLUMNS  # noqa: E402
+from search import search_listings  # noqa: E402
+
+TERMS = ['cabin', 'beach house', 'tahoe', 'hot tub', 'chalet denver']
+
+
+def like_all(term):
+    """The old /listings?q= path: unindexed LIKE, every match returned."""
+
+    return (Listing.query
+            .filter(func.lower(Listing.title).contains(term.lower()))
+            .all())
+
+
+def like_page(term, limit):
+    return (Listing.query
+            .filter(func.lower(Listing.title).contains(term.lower()))
+            .order_by(Listing.id)
+            .limit(limit)
+            .all())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--skip-seed', action='store_true')
+    args = parser.parse_args()
+
+    if not args.skip_seed:
+        print(f"seeding {args.rows} listings...")
+        seed_listings(args.rows)
+
+    for term in TERMS:
+        print(f"\nq={term!r}")
+        print(summarize("LIKE, all matches (old)",
+                        time_calls(lambda: like_all(term), args.repeat)))
+        print(summarize(f"LIKE, first {args.limit}",
+                        time_calls(lambda: like_page(term, args.limit),
+                                   args.repeat)))
+        print(summarize(f"full-text ranked, first {args.limit}",
+                        time_calls(lambda: search_listings(
+                            db.session.query(*LISTING_SUMMARY_COLUMNS),
+                            term, args.limit), args.repeat)))
+
+
+if __name__ == '__main__':
+    main()
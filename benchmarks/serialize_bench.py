@@ -0,0 +1,65 @@
+"""Compare serialization cost per 10k listings: hydrated ORM entities vs
+column projections, and Flask's default JSON provider vs orjson.
+
+    python -m benchmarks.serialize_bench --rows 10000
+"""
+
+import argparse
+
+from benchmarks import use_bench_database
+
+use_bench_database()
+
+from flask.json.provider import DefaultJSONProvider  # noqa: E402
+
+from app import app  # noqa: E402
+from benchmarks.listings import seed_listings  # noqa: E402
+from benchmarks.timing import summarize, time_calls  # noqa: E402
+from jsonProvider import OrjsonProvider  # noqa: E402
+from models import db, Listing, LISTING_SUMMARY_COLUMNS  # noqa: E402
+
+
+def from_entities(rows):
+    db.session.expunge_all()
+    return [listing.serialize_summary()
+            for listing in Listing.query.order_by(Listing.id).limit(rows)]
+
+
+def from_projection(rows):
+    return [Listing.summary_from_row(row)
+            for row in (db.session.query(*LISTING_SUMMARY_COLUMNS)
+                        .order_by(Listing.id)
+                        .limit(rows))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=10_000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--skip-seed', action='store_true')
+    args = parser.parse_args()
+
+    if not args.skip_seed:
+        print(f"seeding {args.rows} listings...")
+        seed_listings(args.rows)
+
+    print(f"\nquery + serialize {args.rows} listings")
+    print(summarize("ORM entities, serialize_summary()",
+                    time_calls(lambda: from_entities(args.rows),
+                               args.repeat)))
+    print(summarize("column projection",
+                    time_calls(lambda: from_projection(args.rows),
+                               args.repeat)))
+
+    payload = {'listings': from_projection(args.rows), 'next': None}
+
+    print(f"\nencode {args.rows} listings")
+    for name, provider in [("Flask default JSON", DefaultJSONProvider(app)),
+                           ("orjson", OrjsonProvider(app))]:
+        print(summarize(name,
+                        time_calls(lambda: provider.dumps(payload),
+                                   args.repeat)))
+
+
+if __name__ == '__main__':
+    main()
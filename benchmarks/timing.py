@@ -0,0 +1,43 @@
+import statistics
+import time
+
+
+def percentile(samples, pct):
+    """Return the pct-th percentile (0-100) of samples."""
+
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, round(pct / 100 * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def time_calls(fn, repeat):
+    """Call fn() `repeat` times and return each call's latency in ms."""
+
+    samples = []
+
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+
+    return samples
+
+
+def latency_stats(samples):
+    """p50/p95/p99 (ms) and count of latency samples, as a dict."""
+
+    return {
+        'p50': round(statistics.median(samples), 3),
+        'p95': round(percentile(samples, 95), 3),
+        'p99': round(percentile(samples, 99), 3),
+        'n': len(samples),
+    }
+
+
+def summarize(name, samples):
+    """Format latency samples (ms) as a one-line report."""
+
+    stats = latency_stats(samples)
+    return (f"{name:<40} p50={stats['p50']:9.2f}ms "
+            f"p95={stats['p95']:9.2f}ms "
+            f"p99={stats['p99']:9.2f}ms  n={stats['n']}")
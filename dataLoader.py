@@ -0,0 +1,107 @@
+from collections import defaultdict
+
+from flask import g
+from sqlalchemy import inspect
+
+from models import db, Listing, User, LISTING_DETAIL_PLAN, USER_DETAIL_PLAN
+
+# Most keys one batch request may ask for, per model.
+MAX_BATCH_KEYS = 100
+
+# Loader options for the relationships each model's serialize() walks.
+LOADING_PLANS = {
+    Listing: LISTING_DETAIL_PLAN,
+    User: USER_DETAIL_PLAN,
+}
+
+
+def parse_keys(value, convert=str):
+    """Split a comma-separated query param into unique keys, in order.
+
+    Raises ValueError if a key doesn't convert or there are more than
+    MAX_BATCH_KEYS of them.
+    """
+
+    keys = list(dict.fromkeys(
+        convert(key.strip()) for key in value.split(',') if key.strip()))
+
+    if len(keys) > MAX_BATCH_KEYS:
+        raise ValueError(f"at most {MAX_BATCH_KEYS} keys per request")
+
+    return keys
+
+
+class DataLoader:
+    """Coalesce primary key lookups into one IN query per model.
+
+    want() only queues keys. The first get_many() of a model then loads
+    every key queued for it so far in a single query, with its loading
+    plan, so a composite request asking for listings, bookings and users
+    runs one query per model however the keys are spread. Results,
+    misses included, are remembered for the rest of the request, so
+    repeated keys are fetched once.
+    """
+
+    def __init__(self, plans=LOADING_PLANS):
+        self.plans = plans
+        self._columns = {}
+        self._pending = defaultdict(set)
+        self._loaded = defaultdict(dict)
+
+    def select(self, model, columns):
+        """Load `model` as rows of just `columns`, which must include its
+        primary key, instead of entities with their loading plan."""
+
+        self._columns[model] = columns
+
+    def want(self, model, keys):
+        """Queue `keys` of `model` for the next load of that model."""
+
+        loaded = self._loaded[model]
+        self._pending[model].update(key for key in keys if key not in loaded)
+
+    def get_many(self, model, keys):
+        """The rows of `model` for `keys`, in order; None where missing."""
+
+        self.want(model, keys)
+        self._dispatch(model)
+
+        loaded = self._loaded[model]
+        return [loaded[key] for key in keys]
+
+    def _dispatch(self, model):
+        keys = self._pending.pop(model, None)
+        if not keys:
+            return
+
+        primary_key = inspect(model).primary_key[0]
+
+        if model in self._columns:
+            query = db.session.query(*self._columns[model])
+        else:
+            query = model.query.options(*self.plans.get(model, ()))
+
+        rows = query.filter(primary_key.in_(keys)).all()
+
+        loaded = self._loaded[model]
+        loaded.update((getattr(row, primary_key.key), row) for row in rows)
+        for key in keys:
+            loaded.setdefault(key, None)
+
+
+def request_loader():
+    """The DataLoader of the current request."""
+
+    if 'loader' not in g:
+        g.loader = DataLoader()
+
+    return g.loader
+
+
+def init_loader(app):
+    """Forget each request's loader when it ends: `g` outlives requests
+    that share an already pushed app context."""
+
+    @app.teardown_request
+    def drop_loader(exc):
+        g.pop('loader', None)
@@ -0,0 +1,119 @@
+import os
+import time
+
+from sqlalchemy import exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
+
+from metrics import metrics
+from models import db
+
+metrics.describe('db_pool_checkouts_total', 'Connections checked out of the pool.')
+metrics.describe('db_pool_wait_seconds_total',
+                 'Time spent getting a connection from the pool, including '
+                 'waiting for a free one and opening new ones.')
+metrics.describe('db_pool_timeouts_total',
+                 'Checkouts that gave up after DB_POOL_TIMEOUT seconds.')
+
+# Driver options that turn off client-side prepared statement caches, which
+# break under pgbouncer's transaction pooling: the next statement may run on
+# a server connection that never saw the PREPARE. psycopg2 never prepares
+# statements, so it needs nothing.
+PGBOUNCER_CONNECT_ARGS = {
+    'asyncpg': {'statement_cache_size': 0,
+                'prepared_statement_cache_size': 0},
+    'psycopg': {'prepare_threshold': None},
+}
+
+
+def _flag(value):
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+class _TimedCheckout:
+    """Pool mixin that counts checkouts, time spent waiting and timeouts."""
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            metrics.inc('db_pool_timeouts_total')
+            raise
+        finally:
+            metrics.inc('db_pool_checkouts_total')
+            metrics.inc('db_pool_wait_seconds_total',
+                        time.perf_counter() - started)
+
+
+class TimedQueuePool(_TimedCheckout, QueuePool):
+    pass
+
+
+class TimedAsyncQueuePool(_TimedCheckout, AsyncAdaptedQueuePool):
+    """TimedQueuePool for asyncio engines (e.g. postgresql+asyncpg)."""
+
+
+def engine_options(database_url, environ=os.environ):
+    """SQLALCHEMY_ENGINE_OPTIONS for `database_url`, from the environment.
+
+        DB_POOL_SIZE=5          connections kept open per worker process
+        DB_MAX_OVERFLOW=10      extra connections allowed under bursts
+        DB_POOL_TIMEOUT=30      seconds to wait for a connection, then fail
+        DB_POOL_RECYCLE=1800    reopen connections older than this (seconds)
+        DB_POOL_PRE_PING=true   test connections on checkout, so ones killed
+                                by a failover are replaced, not handed out
+        DB_POOL=queue           "null" opens a connection per checkout
+        DB_PGBOUNCER=false      true when connecting through pgbouncer in
+                                transaction pooling mode
+
+    Behind pgbouncer the pooling already happens there, so DB_POOL defaults
+    to "null" and driver prepared-statement caches are turned off. Async
+    drivers get the asyncio flavour of the queue pool.
+    """
+
+    url = make_url(database_url)
+    pgbouncer = _flag(environ.get('DB_PGBOUNCER', 'false'))
+    pool = environ.get('DB_POOL', 'null' if pgbouncer else 'queue').lower()
+
+    if pool == 'null':
+        options = {'poolclass': NullPool}
+    elif pool == 'queue':
+        options = {
+            'poolclass': (TimedAsyncQueuePool if url.get_dialect().is_async
+                          else TimedQueuePool),
+            'pool_size': int(environ.get('DB_POOL_SIZE', 5)),
+            'max_overflow': int(environ.get('DB_MAX_OVERFLOW', 10)),
+            'pool_timeout': float(environ.get('DB_POOL_TIMEOUT', 30)),
+            'pool_recycle': int(environ.get('DB_POOL_RECYCLE', 1800)),
+            'pool_use_lifo': True,
+        }
+    else:
+        raise ValueError(f"DB_POOL must be 'queue' or 'null', not {pool!r}")
+
+    options['pool_pre_ping'] = _flag(environ.get('DB_POOL_PRE_PING', 'true'))
+
+    if pgbouncer:
+        connect_args = PGBOUNCER_CONNECT_ARGS.get(url.get_driver_name())
+        if connect_args:
+            options['connect_args'] = dict(connect_args)
+
+    return options
+
+
+def init_pool_metrics(app):
+    """Export the app's connection pool state as gauges on /metrics."""
+
+    with app.app_context():
+        engine = db.engine
+
+    if not isinstance(engine.pool, QueuePool):
+        return
+
+    # Read engine.pool on every render: dispose() swaps in a new pool.
+    metrics.gauge('db_pool_size', lambda: engine.pool.size())
+    metrics.gauge('db_pool_checked_out', lambda: engine.pool.checkedout())
+    metrics.gauge('db_pool_checked_in', lambda: engine.pool.checkedin())
+    # overflow() counts up from -pool_size; only report connections
+    # actually opened beyond the pool.
+    metrics.gauge('db_pool_overflow', lambda: max(0, engine.pool.overflow()))
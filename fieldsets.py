@@ -0,0 +1,264 @@
+"""Sparse fieldsets and opt-in expansions for read routes.
+
+    GET /listings/7?fields=id,title,price_per_night
+    GET /users/alice?fields=username&include=listings.bookings&fields[bookings]=check_in_date
+
+`fields` lists the primary resource's fields and `fields[<type>]` those of
+a type wherever it appears (types: listings, bookings, users, messages).
+`include` lists relations to embed, dotted for nested ones. When either is
+given, only what was asked for is selected and returned: the primary rows
+come from a projection of just the needed columns, and each included
+relation is loaded with one IN query selecting only its own fields.
+"""
+
+from collections import namedtuple
+from operator import attrgetter
+
+from sqlalchemy import inspect
+
+from models import db, Listing, User, Booking, Message, image_srcset
+
+# The columns a field reads, and how to read it off a row.
+Field = namedtuple('Field', ['columns', 'get'])
+
+# A relationship attribute and the resource type it leads to.
+Relation = namedtuple('Relation', ['attr', 'type'])
+
+
+class FieldsetError(ValueError):
+    """Raised for unknown fields or includes."""
+
+
+def _columns(*names):
+    return {name: Field((name,), attrgetter(name)) for name in names}
+
+
+class Resource:
+    """What a model exposes: its fields and includable relations."""
+
+    def __init__(self, model, fields, relations=None):
+        self.model = model
+        self.fields = fields
+        self.relations = relations or {}
+        self.primary_key = inspect(model).primary_key[0].key
+
+
+RESOURCES = {
+    'listings': Resource(
+        Listing,
+        {**_columns('id', 'title', 'details', 'street', 'city', 'state',
+                    'zip', 'country', 'price_per_night', 'image_url',
+                    'username', 'latitude', 'longitude', 'geocode_status'),
+         'image_srcset': Field(('image_variants',),
+                               lambda row: image_srcset(row.image_variants))},
+        {'bookings': Relation('bookings', 'bookings'),
+         'host': Relation('host', 'users')}),
+    'bookings': Resource(
+        Booking,
+        _columns('id', 'username', 'property_id', 'check_in_date',
+                 'check_out_date', 'booking_price_per_night'),
+        {'listing': Relation('property', 'listings'),
+         'guest': Relation('guest', 'users')}),
+    'users': Resource(
+        User,
+        _columns('username', 'first_name', 'last_name', 'email', 'is_host'),
+        {'listings': Relation('listing', 'listings'),
+         'bookings': Relation('booking', 'bookings'),
+         'sent_messages': Relation('sent_messages', 'messages')}),
+    'messages': Resource(
+        Message,
+        {**_columns('id', 'body', 'property_id', 'sent_at_date'),
+         'from_user': Field(('from_username',), attrgetter('from_username'))},
+        {'listing': Relation('listing', 'listings'),
+         'from_user': Relation('from_user', 'users')}),
+}
+
+# Fields of the compact listing summaries on list pages.
+LISTING_SUMMARY_FIELDS = ('id', 'title', 'city', 'state', 'country',
+                          'price_per_night', 'image_url', 'image_srcset',
+                          'username', 'latitude', 'longitude',
+                          'geocode_status')
+
+
+def _split(value):
+    return [name.strip() for name in value.split(',') if name.strip()]
+
+
+def _include_tree(value):
+    """"listings.bookings,sent_messages" -> {listings: {bookings: {}}, ...}"""
+
+    tree = {}
+
+    for path in _split(value):
+        node = tree
+        for name in path.split('.'):
+            node = node.setdefault(name, {})
+
+    return tree
+
+
+class Fieldset:
+    """The fields and includes to serialize for one resource type."""
+
+    def __init__(self, type, fields, includes):
+        self.type = type
+        self.resource = RESOURCES[type]
+        self.fields = fields
+        self.includes = includes
+
+    def columns(self, *extra):
+        """Columns to select: the primary key, those the fields read, the
+        keys included relations join on, and `extra` attributes."""
+
+        resource = self.resource
+        mapper = inspect(resource.model)
+        names = [resource.primary_key]
+
+        for name in self.fields:
+            names.extend(resource.fields[name].columns)
+
+        for name in self.includes:
+            relationship = mapper.relationships[resource.relations[name].attr]
+            names.extend(local.key for local, _
+                         in relationship.local_remote_pairs)
+
+        names.extend(attribute.key for attribute in extra)
+
+        return [getattr(resource.model, name) for name in dict.fromkeys(names)]
+
+    def serialize(self, row):
+        """Serialize one row. Includes need serialize_all()."""
+
+        return {name: self.resource.fields[name].get(row)
+                for name in self.fields}
+
+    def serialize_all(self, rows):
+        """Serialize rows selected with columns(), loading each included
+        relation for all of them with one query."""
+
+        included = {name: self._load(name, rows) for name in self.includes}
+        serialized = []
+
+        for row in rows:
+            data = self.serialize(row)
+
+            for name, (key, many, children) in included.items():
+                found = children.get(getattr(row, key), [])
+                data[name] = found if many else next(iter(found), None)
+
+            serialized.append(data)
+
+        return serialized
+
+    def _load(self, name, rows):
+        """Load relation `name` of `rows`.
+
+        Returns (the rows' key attribute, whether it's a collection,
+        {key value: [serialized children]}).
+        """
+
+        child = self.includes[name]
+        relationship = (inspect(self.resource.model)
+                        .relationships[self.resource.relations[name].attr])
+        (local, remote), = relationship.local_remote_pairs
+
+        keys = {getattr(row, local.key) for row in rows} - {None}
+        children = {}
+
+        if keys:
+            foreign = getattr(child.resource.model, remote.key)
+            child_rows = (db.session.query(*child.columns(foreign))
+                          .filter(foreign.in_(keys))
+                          .order_by(getattr(child.resource.model,
+                                            child.resource.primary_key))
+                          .all())
+
+            for child_row, data in zip(child_rows,
+                                       child.serialize_all(child_rows)):
+                children.setdefault(getattr(child_row, remote.key),
+                                    []).append(data)
+
+        return local.key, relationship.uselist, children
+
+
+def _fields_param(args, type, typed):
+    if not typed and 'fields' in args:
+        return args['fields']
+    return args.get(f'fields[{type}]')
+
+
+def _build(args, type, fields, tree):
+    resource = RESOURCES[type]
+
+    unknown = [name for name in fields if name not in resource.fields]
+    if unknown:
+        raise FieldsetError(f"Unknown {type} fields: {', '.join(unknown)}")
+
+    includes = {}
+
+    for name, subtree in tree.items():
+        if name not in resource.relations:
+            raise FieldsetError(f"Can't include {name} in {type}")
+
+        child_type = resource.relations[name].type
+        child_fields = _fields_param(args, child_type, typed=True)
+        includes[name] = _build(
+            args, child_type,
+            _split(child_fields) if child_fields is not None
+            else list(RESOURCES[child_type].fields),
+            subtree)
+
+    return Fieldset(type, fields, includes)
+
+
+def parse_fieldset(args, type, default_fields=None, typed=False):
+    """The Fieldset for resource `type` asked for by `args`, or None if the
+    request has neither fields nor include params.
+
+    `default_fields` apply when no fields are given for `type` (all of them
+    if None). With `typed`, as in responses mixing several types, only
+    fields[<type>] and include[<type>] are read. Raises FieldsetError.
+    """
+
+    include_param = f'include[{type}]' if typed else 'include'
+
+    if typed:
+        # Another kind's params leave this one's full serialization alone.
+        asked = include_param in args or f'fields[{type}]' in args
+    else:
+        asked = include_param in args or any(
+            key == 'fields' or key.startswith('fields[') for key in args)
+
+    if not asked:
+        return None
+
+    fields = _fields_param(args, type, typed)
+
+    if fields is not None:
+        fields = _split(fields)
+    elif default_fields is not None:
+        fields = list(default_fields)
+    else:
+        fields = list(RESOURCES[type].fields)
+
+    return _build(args, type, fields,
+                  _include_tree(args.get(include_param, '')))
+
+
+def included_types(args, type):
+    """The resource types `args`' include param embeds in a `type`
+    response, at any depth. Unknown names are skipped; parse_fieldset
+    rejects them."""
+
+    types = set()
+
+    def walk(type, tree):
+        relations = RESOURCES[type].relations
+        for name, subtree in tree.items():
+            if name in relations:
+                types.add(relations[name].type)
+                walk(relations[name].type, subtree)
+
+    walk(type, _include_tree(args.get('include', '')))
+
+    return types
@@ -1,7 +1,195 @@
+import logging
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+from geopy.exc import GeopyError
 from geopy.geocoders import Nominatim
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+
+from cache import LRUCache, MISSING
+from metrics import metrics
+from models import db, GeocodeCache
+
+logger = logging.getLogger(__name__)
+
+metrics.describe('geocode_cache_hits_total',
+                 'Geocode lookups answered from a cache layer.')
+metrics.describe('geocode_cache_misses_total',
+                 'Geocode lookups that went to the geocoder.')
+metrics.describe('geocode_failures_total',
+                 'Geocoder calls that errored or found nothing.')
+
+# Spelled-out words mapped to the abbreviation, so "123 Main Street" and
+# "123 main st." share one cache entry.
+ABBREVIATIONS = {
+    'street': 'st', 'avenue': 'ave', 'boulevard': 'blvd', 'road': 'rd',
+    'drive': 'dr', 'lane': 'ln', 'court': 'ct', 'place': 'pl',
+    'terrace': 'ter', 'highway': 'hwy', 'parkway': 'pkwy', 'north': 'n',
+    'south': 's', 'east': 'e', 'west': 'w', 'suite': 'ste',
+    'apartment': 'apt',
+}
+
+_PUNCTUATION = re.compile(r"[.,#;:]+")
+_WHITESPACE = re.compile(r"\s+")
+
+
+class GeocodeUnavailable(Exception):
+    """The geocoder errored (timeout, rate limit, ...); worth retrying."""
+
+
+class RateLimiter:
+    """Thread-safe limiter allowing at most `rate` calls per second."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next_call = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until the caller may make its call."""
+
+        with self._lock:
+            now = time.monotonic()
+            wait_for = self._next_call - now
+            self._next_call = max(now, self._next_call) + self.interval
+
+        if wait_for > 0:
+            time.sleep(wait_for)
+
+
+def normalize_address(address):
+    """Canonical form of an address for use as a cache key."""
+
+    address = _PUNCTUATION.sub(' ', address.lower())
+    words = [ABBREVIATIONS.get(word, word)
+             for word in _WHITESPACE.split(address.strip())]
+    return ' '.join(words)[:255]
+
+
+class GeoCoder:
+    """Geocoder with an in-process LRU and a durable Postgres cache.
+
+    Lookups go LRU -> geocode_cache table -> `geocoder`. Found addresses are
+    kept for `ttl`; addresses the geocoder cannot resolve are cached as
+    negative entries for `negative_ttl`. Geocoder errors (timeouts, rate
+    limits) are not cached; they raise GeocodeUnavailable so the caller can
+    retry.
+
+    `geocoder` is anything with a geopy-style geocode(address) method, so
+    tests can pass a local stub. Defaults to one shared Nominatim client.
+    Calls that reach it are paced by `rate_limiter`, if given.
+    """
+
+    def __init__(self, geocoder=None, lru_size=4096,
+                 ttl=timedelta(days=90), negative_ttl=timedelta(hours=6),
+                 rate_limiter=None):
+        self._geocoder = geocoder
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.rate_limiter = rate_limiter
+        self.lru = LRUCache(lru_size, ttl.total_seconds())
+
+    @property
+    def geocoder(self):
+        if self._geocoder is None:
+            self._geocoder = Nominatim(user_agent="sharebnb")
+        return self._geocoder
+
+    def geocode(self, address):
+        """Return {"latitude", "longitude"} for `address`, or None if the
+        geocoder cannot find it.
+
+        Raises GeocodeUnavailable if the geocoder errors.
+        """
+
+        key = normalize_address(address)
+
+        coordinates = self.lru.get(key)
+        if coordinates is not MISSING:
+            metrics.inc('geocode_cache_hits_total', layer='memory')
+            return coordinates
+
+        # Like _store, use a short-lived connection rather than the caller's
+        # session, so no transaction stays open across the remote call.
+        with db.engine.connect() as conn:
+            row = conn.execute(
+                select(GeocodeCache.latitude,
+                       GeocodeCache.longitude,
+                       GeocodeCache.expires_at)
+                .where(GeocodeCache.address == key,
+                       GeocodeCache.expires_at > datetime.utcnow())
+            ).first()
+
+        if row is not None:
+            metrics.inc('geocode_cache_hits_total', layer='db')
+            coordinates = _coordinates(row.latitude, row.longitude)
+            self.lru.set(key, coordinates, self._lru_ttl(row.expires_at))
+            return coordinates
+
+        metrics.inc('geocode_cache_misses_total')
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.wait()
+
+        try:
+            location = self.geocoder.geocode(address)
+        except GeopyError as e:
+            logger.warning("geocoding %r failed: %s", address, e)
+            metrics.inc('geocode_failures_total', reason='error')
+            raise GeocodeUnavailable(address) from e
+
+        if location is None:
+            metrics.inc('geocode_failures_total', reason='not_found')
+            coordinates = None
+            ttl = self.negative_ttl
+        else:
+            coordinates = _coordinates(location.latitude, location.longitude)
+            ttl = self.ttl
+
+        self._store(key, coordinates, datetime.utcnow() + ttl)
+        self.lru.set(key, coordinates, ttl.total_seconds())
+
+        return coordinates
+
+    def _store(self, key, coordinates, expires_at):
+        """Upsert the durable entry outside the caller's ORM transaction."""
+
+        values = {
+            'address': key,
+            'latitude': coordinates and coordinates['latitude'],
+            'longitude': coordinates and coordinates['longitude'],
+            'expires_at': expires_at,
+        }
+
+        stmt = insert(GeocodeCache).values(**values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[GeocodeCache.address], set_=values)
+
+        with db.engine.begin() as conn:
+            conn.execute(stmt)
+
+    @staticmethod
+    def _lru_ttl(expires_at):
+        return max((expires_at - datetime.utcnow()).total_seconds(), 0)
+
+
+def _coordinates(latitude, longitude):
+    if latitude is None or longitude is None:
+        return None
+    return {"latitude": latitude, "longitude": longitude}
+
+
+# Nominatim's usage policy allows one request per second per application.
+geo_coder = GeoCoder(rate_limiter=RateLimiter(1.0))
+
 
 def getGeoCode(address):
-    geolocator = Nominatim(user_agent="sharebnb")
-    location = geolocator.geocode(address)
+    """Return {"latitude", "longitude"} for `address`, or None if unknown.
+
+    Raises GeocodeUnavailable if the geocoder errors.
+    """
 
-    return {"latitude": location.latitude, "longitude": location.longitude}
\ No newline at end of file
+    return geo_coder.geocode(address)
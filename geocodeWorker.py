@@ -0,0 +1,189 @@
+import logging
+import queue
+import threading
+import time
+
+import click
+from sqlalchemy import bindparam, update
+
+from geoCode import geo_coder, GeocodeUnavailable
+from metrics import metrics
+from responseCache import response_cache
+from models import db, Listing, GEOCODE_DONE, GEOCODE_FAILED
+from models import GEOCODE_PENDING
+
+logger = logging.getLogger(__name__)
+
+metrics.describe('geocode_listings_total',
+                 'Listings resolved by the geocode worker, by outcome.')
+
+
+class GeocodeWorker:
+    """Background pool that fills in Listing coordinates.
+
+    Routes commit listings as pending and submit() their ids. Worker threads
+    pull up to GEOCODE_BATCH_SIZE ids at a time, geocode each address through
+    the shared, rate-limited geo_coder (retrying errors with backoff up to
+    GEOCODE_MAX_ATTEMPTS times), then write the whole batch in one UPDATE.
+
+    Threads start on the first submit(). Under TESTING they never start;
+    call drain() to process the queue in the calling thread.
+    """
+
+    def __init__(self, app=None, geo_coder=geo_coder):
+        self.geo_coder = geo_coder
+        self.queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('GEOCODE_WORKERS', 2)
+        app.config.setdefault('GEOCODE_BATCH_SIZE', 20)
+        app.config.setdefault('GEOCODE_MAX_ATTEMPTS', 3)
+        app.config.setdefault('GEOCODE_RETRY_DELAY', 2.0)
+
+        self.app = app
+        metrics.gauge('geocode_queue_depth', self.queue.qsize)
+
+        app.cli.add_command(self._backfill_command())
+
+    def submit(self, listing_id):
+        """Queue a listing to be geocoded."""
+
+        self.queue.put(listing_id)
+
+        if not self.app.config.get('TESTING'):
+            self._start()
+
+    def drain(self):
+        """Geocode everything queued so far in the calling thread."""
+
+        while True:
+            batch = self._take_batch(block=False)
+            if not batch:
+                return
+            self.process_batch(batch)
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+
+            for n in range(self.app.config['GEOCODE_WORKERS']):
+                thread = threading.Thread(
+                    target=self._run, name=f'geocode-worker-{n}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            batch = self._take_batch(block=True)
+            try:
+                self.process_batch(batch)
+            except Exception:
+                logger.exception("geocoding batch %s failed", batch)
+
+    def _take_batch(self, block):
+        """Take up to GEOCODE_BATCH_SIZE ids, waiting for the first if block."""
+
+        batch = []
+
+        try:
+            batch.append(self.queue.get(block=block))
+            while len(batch) < self.app.config['GEOCODE_BATCH_SIZE']:
+                batch.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        return batch
+
+    def process_batch(self, listing_ids):
+        """Geocode the given listings and store their coordinates."""
+
+        with self.app.app_context():
+            addresses = (db.session.query(
+                            Listing.id, Listing.street, Listing.city)
+                         .filter(Listing.id.in_(listing_ids))
+                         .all())
+            # Don't hold a connection open while waiting on the geocoder.
+            db.session.close()
+
+            results = [dict(self._resolve(id, f"{street} {city}"),
+                            b_id=id, b_street=street, b_city=city)
+                       for id, street, city in addresses]
+
+            if results:
+                # Only where the address is still the one geocoded: one
+                # edited meanwhile was resubmitted, and its newer result
+                # mustn't be overwritten by this stale one.
+                listings = Listing.__table__
+                db.session.execute(
+                    update(listings)
+                    .where(listings.c.id == bindparam('b_id'),
+                           listings.c.street == bindparam('b_street'),
+                           listings.c.city == bindparam('b_city')),
+                    [{key: value for key, value in result.items()
+                      if key != 'id'} for result in results])
+                db.session.commit()
+                response_cache.invalidate(
+                    'listings', *(f"listing:{result['id']}" for result in results))
+
+    def _resolve(self, listing_id, address):
+        """Geocode one address; returns the Listing UPDATE parameters."""
+
+        attempts = self.app.config['GEOCODE_MAX_ATTEMPTS']
+        delay = self.app.config['GEOCODE_RETRY_DELAY']
+        coordinates = None
+
+        for attempt in range(1, attempts + 1):
+            try:
+                coordinates = self.geo_coder.geocode(address)
+                break
+            except GeocodeUnavailable:
+                if attempt < attempts:
+                    time.sleep(delay * 2 ** (attempt - 1))
+
+        if coordinates is None:
+            metrics.inc('geocode_listings_total', outcome=GEOCODE_FAILED)
+            return {'id': listing_id, 'latitude': None, 'longitude': None,
+                    'geocode_status': GEOCODE_FAILED}
+
+        metrics.inc('geocode_listings_total', outcome=GEOCODE_DONE)
+        return {'id': listing_id, **coordinates,
+                'geocode_status': GEOCODE_DONE}
+
+    def _backfill_command(self):
+        worker = self
+
+        @click.command('geocode-backfill')
+        @click.option('--all', 'everything', is_flag=True,
+                      help='Re-geocode every listing, not just unresolved ones.')
+        @click.option('--batch-size', default=100, show_default=True)
+        def geocode_backfill(everything, batch_size):
+            """Geocode pending and failed listings in batches."""
+
+            statuses = ([GEOCODE_PENDING, GEOCODE_FAILED, GEOCODE_DONE]
+                        if everything else [GEOCODE_PENDING, GEOCODE_FAILED])
+            last_id = 0
+            done = 0
+
+            while True:
+                ids = [id for id, in (db.session.query(Listing.id)
+                                      .filter(Listing.id > last_id,
+                                              Listing.geocode_status.in_(statuses))
+                                      .order_by(Listing.id)
+                                      .limit(batch_size))]
+                db.session.close()
+
+                if not ids:
+                    break
+
+                worker.process_batch(ids)
+                last_id = ids[-1]
+                done += len(ids)
+                click.echo(f"geocoded {done} listings")
+
+        return geocode_backfill
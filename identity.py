@@ -0,0 +1,53 @@
+from collections import namedtuple
+
+from cache import LRUCache, MISSING
+from metrics import metrics
+from models import db, User
+
+metrics.describe('identity_cache_hits_total',
+                 'JWT identity lookups answered from the identity cache.')
+metrics.describe('identity_cache_misses_total',
+                 'JWT identity lookups that queried the users table.')
+
+# What authenticated routes need to know about the caller, without a
+# User instance (and its lazy relationships) attached to the session.
+Principal = namedtuple('Principal', ['username', 'is_host', 'token_version'])
+
+
+class IdentityCache:
+    """Bounded TTL cache of token identity -> Principal.
+
+    Keyed by (username, token version), so tokens issued before a user's
+    token_version changed stop resolving. Routes that change or delete a
+    user call invalidate(). Other processes only notice after `ttl`
+    seconds, so keep it short.
+    """
+
+    def __init__(self, maxsize=10_000, ttl=60):
+        self.lru = LRUCache(maxsize, ttl)
+
+    def lookup(self, username, token_version):
+        """Return the Principal for a token, or None if it is no longer valid."""
+
+        key = (username, token_version)
+        principal = self.lru.get(key)
+
+        if principal is not MISSING:
+            metrics.inc('identity_cache_hits_total')
+            return principal
+
+        metrics.inc('identity_cache_misses_total')
+
+        row = (db.session.query(User.username, User.is_host, User.token_version)
+               .filter_by(username=username)
+               .one_or_none())
+
+        if row is None or row.token_version != token_version:
+            return None
+
+        principal = Principal(*row)
+        self.lru.set(key, principal)
+        return principal
+
+    def invalidate(self, username, token_version):
+        self.lru.delete((username, token_version))
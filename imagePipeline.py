@@ -0,0 +1,264 @@
+import ipaddress
+import logging
+import os
+import socket
+import threading
+import uuid
+from http.client import HTTPSConnection
+from urllib.parse import urlsplit
+from urllib.request import (HTTPRedirectHandler, HTTPSHandler, ProxyHandler,
+                            build_opener)
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image, ImageOps
+from sqlalchemy import update
+
+from awsUpload import s3_uploader, AMAZON_BASE_URL
+from metrics import metrics
+from responseCache import response_cache
+from models import db, Listing
+
+logger = logging.getLogger(__name__)
+
+metrics.describe('image_variants_total', 'Listing images processed, by outcome.')
+
+# Variant widths in px, largest first: each is resized from the previous one.
+VARIANT_WIDTHS = (1600, 800, 320)
+
+# (format, file extension, content type, save options)
+VARIANT_FORMATS = (
+    ('WEBP', 'webp', 'image/webp', {'quality': 80, 'method': 4}),
+    ('JPEG', 'jpg', 'image/jpeg',
+     {'quality': 82, 'optimize': True, 'progressive': True}),
+)
+
+# Largest remote image submit_url() will download.
+MAX_FETCH_BYTES = 20 * 1024 * 1024
+
+
+def public_address(host, port):
+    """Resolve `host` to a socket address to connect to.
+
+    Raises ValueError unless every address it resolves to is public, so an
+    imported image URL can't reach loopback, private, link-local (cloud
+    metadata) or reserved addresses.
+    """
+
+    try:
+        resolved = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        raise ValueError(f"can't resolve {host}: {e}") from e
+
+    for *_, sockaddr in resolved:
+        address = ipaddress.ip_address(sockaddr[0])
+        if not address.is_global or address.is_multicast:
+            raise ValueError(f"{host} resolves to non-public {address}")
+
+    return resolved[0][4]
+
+
+class PublicHTTPSConnection(HTTPSConnection):
+    """An HTTPS connection that only connects to the public address its
+    host was checked to resolve to, so DNS can't change it in between."""
+
+    def connect(self):
+        self.sock = socket.create_connection(
+            public_address(self.host, self.port)[:2], self.timeout)
+        self.sock = self._context.wrap_socket(self.sock,
+                                              server_hostname=self.host)
+
+
+class PublicHTTPSHandler(HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(PublicHTTPSConnection, req)
+
+
+class HTTPSRedirectHandler(HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        if urlsplit(newurl).scheme != 'https':
+            raise ValueError(f"redirected to a non-https url: {newurl}")
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+# No proxies: requests must go straight to the checked address. Redirects
+# are followed through the same checks.
+_opener = build_opener(ProxyHandler({}), PublicHTTPSHandler,
+                       HTTPSRedirectHandler)
+
+
+def fetch_image(url, timeout=10):
+    """Download an image over https from a public address; returns its
+    bytes."""
+
+    if urlsplit(url).scheme != 'https':
+        raise ValueError(f"not an https url: {url}")
+
+    with _opener.open(url, timeout=timeout) as response:
+        data = response.read(MAX_FETCH_BYTES + 1)
+
+    if len(data) > MAX_FETCH_BYTES:
+        raise ValueError(f"image larger than {MAX_FETCH_BYTES} bytes: {url}")
+
+    return data
+
+
+def render_variants(data):
+    """Decode an image once and encode every variant.
+
+    Runs in a worker process. Returns {(extension, width): bytes}, keyed by
+    each variant's actual width. Images are never upscaled, so a small
+    original yields fewer, smaller variants.
+    """
+
+    with Image.open(BytesIO(data)) as image:
+        # Let the JPEG decoder skip detail we'd throw away anyway.
+        image.draft('RGB', (VARIANT_WIDTHS[0], VARIANT_WIDTHS[0]))
+        image = ImageOps.exif_transpose(image).convert('RGB')
+
+    variants = {}
+
+    for width in VARIANT_WIDTHS:
+        if image.width > width:
+            height = round(image.height * width / image.width)
+            image = image.resize((width, height), Image.LANCZOS)
+        elif any(encoded == image.width for _, encoded in variants):
+            continue
+
+        for format, extension, _, options in VARIANT_FORMATS:
+            out = BytesIO()
+            image.save(out, format, **options)
+            variants[(extension, image.width)] = out.getvalue()
+
+    return variants
+
+
+class ImagePipeline:
+    """Turn uploaded listing photos into resized, re-encoded variants.
+
+    Decoding and encoding run in a process pool (IMAGE_WORKERS processes,
+    one per core by default), off the request thread. A small thread pool
+    then uploads the variants through awsUpload and stores their URLs in
+    Listing.image_variants. Under TESTING everything runs inline.
+
+    submit_url() does the same for an image that is still at a remote URL
+    (bulk imports), downloading it on the upload threads. wait() blocks
+    until every submitted image is done, for short-lived CLI processes.
+    """
+
+    def __init__(self, app=None, uploader=s3_uploader, fetch=fetch_image):
+        self.uploader = uploader
+        self.fetch = fetch
+        self._processes = None
+        self._uploads = None
+        self._pending = 0
+        self._idle = threading.Condition()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('IMAGE_WORKERS', os.cpu_count())
+        self.app = app
+
+    def submit(self, listing_id, data, image_url):
+        """Build variants of image bytes `data`, the listing's `image_url`."""
+
+        if self.app.config.get('TESTING'):
+            self._store(listing_id, image_url, render_variants(data))
+            return
+
+        self._start_job()
+        self._render(listing_id, image_url, data)
+
+    def submit_url(self, listing_id, url):
+        """Download the image at `url` and build variants for a listing."""
+
+        if self.app.config.get('TESTING'):
+            self._store(listing_id, url, render_variants(self.fetch(url)))
+            return
+
+        self._start_job()
+        self._uploads.submit(self._download, listing_id, url)
+
+    def wait(self):
+        """Block until every submitted image has been processed."""
+
+        with self._idle:
+            self._idle.wait_for(lambda: self._pending == 0)
+
+    def _start_job(self):
+        with self._idle:
+            if self._processes is None:
+                self._processes = ProcessPoolExecutor(
+                    max_workers=self.app.config['IMAGE_WORKERS'])
+                self._uploads = ThreadPoolExecutor(
+                    max_workers=4, thread_name_prefix='image-upload')
+
+            self._pending += 1
+
+    def _end_job(self):
+        with self._idle:
+            self._pending -= 1
+            self._idle.notify_all()
+
+    def _render(self, listing_id, image_url, data):
+        future = self._processes.submit(render_variants, data)
+        future.add_done_callback(
+            lambda f: self._uploads.submit(self._finish, listing_id,
+                                           image_url, f))
+
+    def _download(self, listing_id, url):
+        try:
+            data = self.fetch(url)
+        except Exception:
+            metrics.inc('image_variants_total', outcome='error')
+            logger.exception("fetching image for listing %s failed", listing_id)
+            self._end_job()
+            return
+
+        self._render(listing_id, url, data)
+
+    def _finish(self, listing_id, image_url, future):
+        try:
+            self._store(listing_id, image_url, future.result())
+        except Exception:
+            metrics.inc('image_variants_total', outcome='error')
+            logger.exception("image variants for listing %s failed", listing_id)
+        finally:
+            self._end_job()
+
+    def _store(self, listing_id, image_url, variants):
+        """Upload variants rendered from `image_url` and record their URLs
+        on the listing, unless its image was replaced meanwhile."""
+
+        base = uuid.uuid4().hex
+        content_types = {extension: content_type
+                         for _, extension, content_type, _ in VARIANT_FORMATS}
+        urls = {}
+
+        for (extension, width), data in variants.items():
+            key = f"{base}-{width}.{extension}"
+
+            if not self.uploader.upload(BytesIO(data), key,
+                                        content_type=content_types[extension]):
+                metrics.inc('image_variants_total', outcome='error')
+                return
+
+            urls.setdefault(content_types[extension], {})[str(width)] = (
+                f"{AMAZON_BASE_URL}/{key}")
+
+        with self.app.app_context():
+            # A newer image's variants may already be stored; don't
+            # overwrite them with this older one's.
+            stored = db.session.execute(
+                update(Listing)
+                .where(Listing.id == listing_id,
+                       Listing.image_url == image_url)
+                .values(image_variants=urls)).rowcount
+            db.session.commit()
+
+        if stored:
+            response_cache.invalidate(f'listing:{listing_id}', 'listings')
+
+        metrics.inc('image_variants_total', outcome='ok')
@@ -0,0 +1,58 @@
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson.
+
+    orjson encodes dicts, lists, dates and datetimes natively (dates as
+    ISO 8601, e.g. "2023-06-01") and writes bytes straight into the
+    response, without building an intermediate str. Types it doesn't know
+    fall back to the provider's `default`. Parsing request bodies also goes
+    through orjson.
+
+    Keys are left in insertion order unless `sort_keys` is set, on the
+    provider or per dumps() call. dumps() arguments orjson has no option
+    for, like `separators`, are handed to the json module instead.
+    """
+
+    options = orjson.OPT_NON_STR_KEYS if orjson else 0
+    sort_keys = False
+
+    def _options(self, sort_keys):
+        return self.options | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+
+    def dumps(self, obj, **kwargs):
+        sort_keys = kwargs.pop('sort_keys', self.sort_keys)
+
+        if kwargs:
+            return super().dumps(obj, sort_keys=sort_keys, **kwargs)
+
+        return orjson.dumps(obj, default=self.default,
+                            option=self._options(sort_keys)).decode('UTF-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        option = self._options(self.sort_keys)
+
+        # Readable output in debug mode, like Flask's own provider.
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            option |= orjson.OPT_INDENT_2
+
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=option),
+            mimetype=self.mimetype)
+
+
+def init_json(app):
+    """Use orjson for JSON responses when it is installed."""
+
+    if orjson is not None:
+        app.json = OrjsonProvider(app)
@@ -0,0 +1,396 @@
+import csv
+import io
+import json
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from sqlalchemy import text
+
+from awsUpload import AMAZON_BASE_URL
+from geoCode import normalize_address
+from metrics import metrics
+from models import db, Listing, DEFAULT_IMAGE_URL, GEOCODE_PENDING
+from responseCache import response_cache
+
+metrics.describe('listing_import_rows_total',
+                 'Rows read by bulk listing imports, by outcome.')
+
+IMPORT_FORMATS = ('csv', 'ndjson')
+
+# Rows per COPY + merge. Each batch is one transaction.
+IMPORT_BATCH_SIZE = 20_000
+
+REQUIRED_FIELDS = ('title', 'details', 'street', 'city', 'state', 'zip',
+                   'country', 'price_per_night', 'username')
+INTEGER_FIELDS = ('zip', 'price_per_night')
+TEXT_FIELDS = tuple(field for field in REQUIRED_FIELDS + ('image_url',)
+                    if field not in INTEGER_FIELDS)
+
+# Largest value of the integer (int4) columns; COPY rejects the whole batch
+# over one bigger value, so records are checked first.
+MAX_INTEGER = 2**31 - 1
+
+# Column lengths, looked up once rather than per record.
+MAX_LENGTHS = {field: Listing.__table__.c[field].type.length
+               for field in TEXT_FIELDS}
+
+# Columns of the staging table, in COPY order. `seq` is the record's
+# row number in the input; `address` is the geocode cache key.
+STAGING_COLUMNS = ('seq', 'title', 'details', 'street', 'city', 'state',
+                   'zip', 'country', 'price_per_night', 'image_url',
+                   'username', 'latitude', 'longitude', 'address')
+
+CREATE_STAGING = text("""
+    CREATE TEMP TABLE listing_import (
+        seq integer PRIMARY KEY,
+        title text NOT NULL,
+        details text NOT NULL,
+        street text NOT NULL,
+        city text NOT NULL,
+        state text NOT NULL,
+        zip integer NOT NULL,
+        country text NOT NULL,
+        price_per_night integer NOT NULL,
+        image_url text NOT NULL,
+        username text NOT NULL,
+        latitude double precision,
+        longitude double precision,
+        address text NOT NULL
+    ) ON COMMIT DROP
+""")
+
+COPY_STAGING = (f"COPY listing_import ({', '.join(STAGING_COLUMNS)}) "
+                "FROM STDIN WITH (FORMAT csv)")
+
+# One statement per batch: keep the first row for each (street, city) whose
+# host exists, fill missing coordinates from the geocode cache, insert, and
+# report every staged row's outcome. Rows colliding with an existing listing
+# (or an earlier row) are skipped by ON CONFLICT and come back without an id.
+MERGE_STAGING = text("""
+    WITH chosen AS (
+        SELECT DISTINCT ON (s.street, s.city)
+               s.*,
+               coalesce(s.latitude, gc.latitude) AS lat,
+               coalesce(s.longitude, gc.longitude) AS lng
+        FROM listing_import s
+        JOIN users u ON u.username = s.username
+        LEFT JOIN geocode_cache gc
+               ON s.latitude IS NULL
+              AND gc.address = s.address
+              AND gc.expires_at > now()
+        ORDER BY s.street, s.city, s.seq
+    ), merged AS (
+        INSERT INTO listings (title, details, street, city, state, zip,
+                              country, price_per_night, image_url, username,
+                              latitude, longitude, geocode_status)
+        SELECT title, details, street, city, state, zip,
+               country, price_per_night, image_url, username,
+               lat, lng,
+               CASE WHEN lat IS NULL THEN 'pending' ELSE 'done' END
+        FROM chosen
+        ORDER BY seq
+        ON CONFLICT (street, city) DO NOTHING
+        RETURNING id, street, city, geocode_status
+    )
+    SELECT s.seq, s.image_url, m.id, m.geocode_status,
+           u.username IS NOT NULL AS known_user
+    FROM listing_import s
+    LEFT JOIN users u ON u.username = s.username
+    LEFT JOIN chosen c ON c.seq = s.seq
+    LEFT JOIN merged m ON m.street = c.street AND m.city = c.city
+    ORDER BY s.seq
+""")
+
+
+class ImportReport:
+    """Outcome of a bulk import.
+
+    `errors` is a list of {"row", "message"} for every record that was not
+    imported; `pending` and `images` list the (row, listing id[, url]) of
+    imported listings still needing coordinates or image variants.
+    """
+
+    def __init__(self):
+        self.imported = 0
+        self.geocoded = 0
+        self.pending = []
+        self.images = []
+        self.errors = []
+
+    def error(self, row, message):
+        self.errors.append({'row': row, 'message': message})
+
+    def serialize(self):
+        """Serialize to dictionary."""
+
+        return {
+            'imported': self.imported,
+            'geocoded': self.geocoded,
+            'pending_geocode': len(self.pending),
+            'images': len(self.images),
+            'errors': self.errors,
+        }
+
+
+def read_records(stream, format):
+    """Yield (row, record or None, error) from a text stream of CSV (with a
+    header) or NDJSON. Rows count records from 1; blank NDJSON lines are
+    skipped.
+    """
+
+    if format == 'csv':
+        for row, record in enumerate(csv.DictReader(stream), start=1):
+            if None in record:
+                yield row, None, "too many fields"
+            else:
+                yield row, record, None
+        return
+
+    row = 0
+    for line in stream:
+        if not line.strip():
+            continue
+        row += 1
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield row, None, "invalid JSON"
+            continue
+        if isinstance(record, dict):
+            yield row, record, None
+        else:
+            yield row, None, "expected a JSON object"
+
+
+def clean_record(record, username=None):
+    """Validate a raw record against the listings columns.
+
+    Returns (values, None) with values in STAGING_COLUMNS order (minus `seq`),
+    or (None, message) describing the first problem found.
+    """
+
+    if username is not None:
+        record = {**record, 'username': username}
+
+    values = {}
+
+    for field in REQUIRED_FIELDS:
+        value = record.get(field)
+        if isinstance(value, str):
+            value = value.strip()
+        if value is None or value == '':
+            return None, f"{field} is required"
+        values[field] = value
+
+    for field in INTEGER_FIELDS:
+        try:
+            values[field] = int(values[field])
+        except (TypeError, ValueError):
+            return None, f"{field} must be an integer"
+        if values[field] < 0:
+            return None, f"{field} must not be negative"
+        if values[field] > MAX_INTEGER:
+            return None, f"{field} must be at most {MAX_INTEGER}"
+
+    values['image_url'] = (str(record.get('image_url') or '').strip()
+                           or DEFAULT_IMAGE_URL)
+
+    for field in TEXT_FIELDS:
+        values[field] = str(values[field])
+        length = MAX_LENGTHS[field]
+        if length and len(values[field]) > length:
+            return None, f"{field} is longer than {length} characters"
+        # Postgres text can't hold NUL; COPY would fail the batch.
+        if '\x00' in values[field]:
+            return None, f"{field} must not contain NUL characters"
+
+    latitude, longitude = record.get('latitude'), record.get('longitude')
+    if latitude in (None, '') and longitude in (None, ''):
+        values['latitude'] = values['longitude'] = None
+    else:
+        try:
+            latitude, longitude = float(latitude), float(longitude)
+        except (TypeError, ValueError):
+            return None, "latitude and longitude must both be numbers"
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180
+                and math.isfinite(latitude) and math.isfinite(longitude)):
+            return None, "latitude or longitude out of range"
+        values['latitude'], values['longitude'] = latitude, longitude
+
+    values['address'] = normalize_address(
+        f"{values['street']} {values['city']}")
+
+    return [values[column] for column in STAGING_COLUMNS[1:]], None
+
+
+def import_listings(stream, format, username=None,
+                    batch_size=IMPORT_BATCH_SIZE):
+    """Bulk-insert listings from a CSV or NDJSON text stream.
+
+    Records are validated in Python, COPYed into a temporary staging table
+    batch_size at a time, then merged into listings with a single
+    INSERT ... SELECT per batch. Each batch is merged on a helper thread
+    while the next one is validated. Bad records are reported in the
+    returned ImportReport rather than failing the batch. If `username` is
+    given every listing belongs to that host.
+    """
+
+    if format not in IMPORT_FORMATS:
+        raise ValueError(f"unsupported format: {format}")
+
+    report = ImportReport()
+    engine = db.engine
+    batch = []
+    merging = None
+
+    with ThreadPoolExecutor(max_workers=1,
+                            thread_name_prefix='listing-import') as merger:
+        for row, record, error in read_records(stream, format):
+            if error is None:
+                values, error = clean_record(record, username)
+
+            if error is not None:
+                report.error(row, error)
+                continue
+
+            batch.append([row, *values])
+            if len(batch) >= batch_size:
+                # One merge at a time, so batches land in input order.
+                if merging is not None:
+                    merging.result()
+                merging = merger.submit(_merge_batch, engine, batch, report)
+                batch = []
+
+        if merging is not None:
+            merging.result()
+
+        if batch:
+            _merge_batch(engine, batch, report)
+
+    if report.imported:
+        response_cache.invalidate('listings')
+
+    metrics.inc('listing_import_rows_total', report.imported, outcome='imported')
+    metrics.inc('listing_import_rows_total', len(report.errors), outcome='error')
+
+    report.errors.sort(key=lambda error: error['row'])
+    return report
+
+
+def _merge_batch(engine, batch, report):
+    """COPY one batch into staging and merge it into listings."""
+
+    buffer = io.StringIO()
+    # COPY's csv format reads unquoted empty fields as NULL.
+    csv.writer(buffer).writerows(batch)
+    buffer.seek(0)
+
+    with engine.begin() as conn:
+        conn.execute(CREATE_STAGING)
+        conn.connection.cursor().copy_expert(COPY_STAGING, buffer)
+        results = conn.execute(MERGE_STAGING).all()
+
+    for row, image_url, id, geocode_status, known_user in results:
+        if not known_user:
+            report.error(row, "unknown username")
+        elif id is None:
+            report.error(row, "a listing at this street and city already exists")
+        else:
+            report.imported += 1
+            if geocode_status == GEOCODE_PENDING:
+                report.pending.append((row, id))
+            else:
+                report.geocoded += 1
+            if image_url != DEFAULT_IMAGE_URL and not image_url.startswith(
+                    AMAZON_BASE_URL):
+                report.images.append((row, id, image_url))
+
+
+class ListingImporter:
+    """Bulk listing import, plus the follow-up work for imported rows.
+
+    Imported listings without coordinates are handed to `geocode_worker`,
+    which resolves them in batches; those whose image_url points elsewhere
+    have the image pulled into `image_pipeline`. Also registers
+    `flask import-listings`.
+    """
+
+    def __init__(self, app=None, geocode_worker=None, image_pipeline=None):
+        self.geocode_worker = geocode_worker
+        self.image_pipeline = image_pipeline
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('IMPORT_BATCH_SIZE', IMPORT_BATCH_SIZE)
+
+        self.app = app
+        app.cli.add_command(self._import_command())
+
+    def run(self, stream, format, username=None):
+        """Import listings and queue their geocoding and images."""
+
+        report = import_listings(
+            stream, format, username=username,
+            batch_size=self.app.config['IMPORT_BATCH_SIZE'])
+
+        for _, id in report.pending:
+            self.geocode_worker.submit(id)
+
+        for _, id, url in report.images:
+            self.image_pipeline.submit_url(id, url)
+
+        return report
+
+    def _import_command(self):
+        importer = self
+
+        @click.command('import-listings')
+        @click.argument('file', type=click.File('r', encoding='utf-8'))
+        @click.option('--format', type=click.Choice(IMPORT_FORMATS),
+                      help='Defaults to the file extension.')
+        @click.option('--username', help='Import every listing for this host.')
+        @click.option('--batch-size', default=IMPORT_BATCH_SIZE,
+                      show_default=True)
+        @click.option('--geocode/--no-geocode', default=False,
+                      help='Resolve coordinates now rather than leaving them '
+                           'to flask geocode-backfill.')
+        @click.option('--images/--no-images', default=True, show_default=True,
+                      help='Download remote images and build variants.')
+        def import_listings_command(file, format, username, batch_size,
+                                    geocode, images):
+            """Bulk-import listings from a CSV or NDJSON FILE."""
+
+            if format is None:
+                format = 'ndjson' if file.name.endswith(
+                    ('.ndjson', '.jsonl')) else 'csv'
+
+            report = import_listings(file, format, username=username,
+                                     batch_size=batch_size)
+
+            for error in report.errors:
+                click.echo(f"row {error['row']}: {error['message']}", err=True)
+
+            click.echo(f"imported {report.imported} listings "
+                       f"({report.geocoded} with coordinates), "
+                       f"{len(report.errors)} errors")
+
+            if geocode:
+                ids = [id for _, id in report.pending]
+                size = importer.app.config['GEOCODE_BATCH_SIZE']
+                for start in range(0, len(ids), size):
+                    importer.geocode_worker.process_batch(ids[start:start + size])
+                click.echo(f"geocoded {len(ids)} listings")
+            elif report.pending:
+                click.echo(f"{len(report.pending)} listings need geocoding; "
+                           "run flask geocode-backfill")
+
+            if images and report.images:
+                click.echo(f"processing {len(report.images)} images...")
+                for _, id, url in report.images:
+                    importer.image_pipeline.submit_url(id, url)
+                importer.image_pipeline.wait()
+
+        return import_listings_command
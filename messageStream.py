@@ -0,0 +1,382 @@
+import logging
+import os
+import queue
+import select
+import threading
+import time
+import zlib
+
+import psycopg2
+from flask import Response
+from sqlalchemy import or_, text
+
+from metrics import metrics
+from models import db, Listing, Message, MESSAGE_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+metrics.describe('message_stream_subscribers', 'Open message streams.')
+metrics.describe('message_stream_events_total',
+                 'Message events queued for stream subscribers.')
+metrics.describe('message_stream_overflows_total',
+                 'Stream subscribers dropped for falling a full buffer '
+                 'behind.')
+
+# NOTIFY channel carrying the ids of newly committed messages.
+CHANNEL = 'messages'
+
+# Advisory lock namespaces (the first key of pg_advisory_xact_lock(int,
+# int)) ordering the message inserts of one listing's or one user's stream.
+LISTING_ORDER_LOCK = 7_351_203
+USER_ORDER_LOCK = 7_351_204
+
+# Rows per query when replaying messages a reconnecting client missed.
+REPLAY_BATCH_SIZE = 500
+
+# How long browsers wait before reconnecting a dropped stream (ms).
+RETRY_MS = 1000
+
+# Seconds between checks that the listener connection is still alive.
+POLL_TIMEOUT = 5.0
+RECONNECT_DELAY = 1.0
+
+
+def user_lock_key(username):
+    """The int4 second key of `username`'s order lock. Collisions only make
+    two users' messages wait on each other."""
+
+    return zlib.crc32(username.encode()) - 2**31
+
+
+def message_order_locks(property_id, from_username, host):
+    """The (namespace, key) order locks of a message's streams, in the
+    order they must be taken."""
+
+    locks = {(LISTING_ORDER_LOCK, property_id)}
+    locks.update((USER_ORDER_LOCK, user_lock_key(username))
+                 for username in (from_username, host) if username)
+
+    return sorted(locks)
+
+
+def lock_message_order(property_id, from_username, host):
+    """Take the order locks of every stream a message appears on (its
+    listing's, its sender's and its host's) until this transaction ends.
+
+    Call right before inserting the message and commit right after. Two
+    messages on a common stream then take their ids and commit one at a
+    time, so each stream sees ids in commit order and can resume after the
+    last id it sent: no message with a lower id can commit later. Messages
+    sharing no stream don't wait on each other. Within one stream inserts
+    are serial, capping it at roughly one message per commit round trip
+    (see benchmarks/message_bench.py).
+    """
+
+    locks = message_order_locks(property_id, from_username, host)
+    # One statement, evaluated left to right: every insert takes its locks
+    # in the same order, so two can't deadlock.
+    calls = ', '.join(f"pg_advisory_xact_lock(:namespace{i}, :key{i})"
+                      for i in range(len(locks)))
+    params = {}
+    for i, (namespace, key) in enumerate(locks):
+        params[f'namespace{i}'] = namespace
+        params[f'key{i}'] = key
+
+    db.session.execute(text(f"SELECT {calls}"), params)
+
+
+def notify_message(message_id):
+    """NOTIFY stream listeners of a message when this transaction commits."""
+
+    db.session.execute(text("SELECT pg_notify(:channel, :payload)"),
+                       {'channel': CHANNEL, 'payload': str(message_id)})
+
+
+def in_conversations_of(username):
+    """Filter for messages `username` sent or received on a listing they
+    host."""
+
+    hosted = (db.session.query(Listing.id)
+              .filter(Listing.username == username)
+              .scalar_subquery())
+
+    return or_(Message.from_username == username,
+               Message.property_id.in_(hosted))
+
+
+def conversations_of(query, username):
+    """`query` filtered like in_conversations_of(), as two queries that
+    don't overlap: the messages `username` sent, and the rest of those on
+    listings they host. For paginate_union_by_keys."""
+
+    hosted = (db.session.query(Listing.id)
+              .filter(Listing.username == username)
+              .scalar_subquery())
+
+    return [query.filter(Message.from_username == username),
+            query.filter(Message.property_id.in_(hosted),
+                         Message.from_username != username)]
+
+
+class Subscription:
+    """One stream client's bounded buffer of (message id, event) pairs."""
+
+    def __init__(self, key, buffer_size):
+        self.key = key
+        self.events = queue.Queue(maxsize=buffer_size)
+        self.closed = False
+
+    def push(self, message_id, event):
+        """Buffer an event. Returns False if the buffer is full."""
+
+        try:
+            self.events.put_nowait((message_id, event))
+        except queue.Full:
+            return False
+
+        return True
+
+
+class MessageStream:
+    """Fan new messages out to Server-Sent Event streams.
+
+    create_message calls lock_message_order() and notify_message(), so
+    Postgres NOTIFYs the id on commit, in id order for each stream. Each
+    process holds a single LISTEN connection, opened on the first
+    subscribe(): its thread loads each batch of new messages once and
+    queues the encoded events for every matching subscriber, keyed by
+    ('listing', id) or ('user', username).
+
+    Each open stream holds one WSGI worker thread for its whole life, so a
+    worker serves at most as many streams as it has threads, minus those
+    needed for ordinary requests.
+
+    Buffers hold MESSAGE_STREAM_BUFFER events. A client that falls that far
+    behind is disconnected rather than slowing everyone else down; it
+    reconnects with the last event id it saw and replays what it missed
+    from the database. LISTEN_DATABASE_URL points the listener straight at
+    Postgres when the app goes through pgbouncer, which can't LISTEN in
+    transaction pooling mode.
+    """
+
+    def __init__(self, app=None):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._listening = threading.Event()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('MESSAGE_STREAM_BUFFER', 100)
+        app.config.setdefault('MESSAGE_STREAM_HEARTBEAT', 15.0)
+        app.config.setdefault('LISTEN_DATABASE_URL',
+                              os.environ.get('LISTEN_DATABASE_URL'))
+
+        self.app = app
+        metrics.gauge('message_stream_subscribers', self.subscriber_count)
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subs) for subs in self._subscribers.values())
+
+    def subscribe(self, key):
+        """Start buffering events for `key`; returns the Subscription."""
+
+        self._start()
+
+        subscription = Subscription(
+            key, self.app.config['MESSAGE_STREAM_BUFFER'])
+
+        with self._lock:
+            self._subscribers.setdefault(key, set()).add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subs = self._subscribers.get(subscription.key, set())
+            subs.discard(subscription)
+            if not subs:
+                self._subscribers.pop(subscription.key, None)
+
+    def publish(self, rows):
+        """Queue message rows, each with its listing's `host`, for every
+        subscriber of the listing, the sender or the host."""
+
+        for row in rows:
+            event = self.encode(row)
+            keys = {('listing', row.property_id),
+                    ('user', row.from_username),
+                    ('user', row.host)}
+
+            with self._lock:
+                subscribers = [sub for key in keys
+                               for sub in self._subscribers.get(key, ())]
+
+            for subscription in subscribers:
+                if subscription.push(row.id, event):
+                    metrics.inc('message_stream_events_total')
+                else:
+                    self._drop(subscription)
+                    metrics.inc('message_stream_overflows_total')
+
+    def encode(self, row):
+        """A message row as one SSE event, with its id for resuming."""
+
+        data = self.app.json.dumps(Message.from_row(row))
+        return f"id: {row.id}\nevent: message\ndata: {data}\n\n"
+
+    def response(self, key, last_id=None):
+        """A text/event-stream Response for `key`, replaying messages after
+        `last_id` first when a client reconnects."""
+
+        return Response(self.stream(key, last_id),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache',
+                                 'X-Accel-Buffering': 'no'})
+
+    def stream(self, key, last_id=None):
+        """Generate the event stream for `key`, until the client goes away
+        or is dropped for falling behind."""
+
+        # Subscribe before replaying, so nothing committed in between is
+        # missed; events already replayed are skipped below.
+        subscription = self.subscribe(key)
+        heartbeat = self.app.config['MESSAGE_STREAM_HEARTBEAT']
+
+        try:
+            yield f"retry: {RETRY_MS}\n\n"
+
+            if last_id is not None:
+                for row in self.missed(key, last_id):
+                    last_id = row.id
+                    yield self.encode(row)
+
+            while not subscription.closed:
+                try:
+                    message_id, event = subscription.events.get(
+                        timeout=heartbeat)
+                except queue.Empty:
+                    # Keeps proxies from timing the stream out, and finds
+                    # clients that went away.
+                    yield ": keepalive\n\n"
+                    continue
+
+                if last_id is None or message_id > last_id:
+                    yield event
+        finally:
+            self.unsubscribe(subscription)
+
+    def missed(self, key, after_id):
+        """Yield `key`'s messages with ids above `after_id`, in id order."""
+
+        kind, value = key
+
+        while True:
+            # A context per batch, never held across a yield: the
+            # connection goes back to the pool while the client reads.
+            with self.app.app_context():
+                if kind == 'listing':
+                    condition = Message.property_id == value
+                else:
+                    condition = in_conversations_of(value)
+
+                rows = (db.session.query(*MESSAGE_COLUMNS)
+                        .filter(condition, Message.id > after_id)
+                        .order_by(Message.id)
+                        .limit(REPLAY_BATCH_SIZE)
+                        .all())
+
+            yield from rows
+
+            if len(rows) < REPLAY_BATCH_SIZE:
+                return
+
+            after_id = rows[-1].id
+
+    def _drop(self, subscription):
+        subscription.closed = True
+        self.unsubscribe(subscription)
+
+    def _drop_all(self):
+        with self._lock:
+            subscriptions = [sub for subs in self._subscribers.values()
+                             for sub in subs]
+            self._subscribers.clear()
+
+        for subscription in subscriptions:
+            subscription.closed = True
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._listen_forever, name='message-listener',
+                    daemon=True)
+                self._thread.start()
+
+        # Events are only delivered once LISTEN is in place.
+        self._listening.wait(timeout=POLL_TIMEOUT)
+
+    def _connect(self):
+        url = self.app.config['LISTEN_DATABASE_URL']
+
+        if url:
+            connection = psycopg2.connect(url)
+        else:
+            # A connection of the app's own, taken out of the pool for good.
+            with self.app.app_context():
+                pooled = db.engine.raw_connection()
+            connection = pooled.driver_connection
+            pooled.detach()
+
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {CHANNEL}")
+
+        return connection
+
+    def _listen_forever(self):
+        while True:
+            connection = None
+
+            try:
+                connection = self._connect()
+                self._listening.set()
+                self._listen(connection)
+            except Exception:
+                logger.exception("message listener failed, reconnecting")
+            finally:
+                self._listening.clear()
+                if connection is not None:
+                    connection.close()
+
+            # Anything sent while disconnected was lost: drop every stream,
+            # so clients reconnect and replay from the database.
+            self._drop_all()
+            time.sleep(RECONNECT_DELAY)
+
+    def _listen(self, connection):
+        while True:
+            if not select.select([connection], [], [], POLL_TIMEOUT)[0]:
+                continue
+
+            connection.poll()
+            ids = [int(notify.payload) for notify in connection.notifies]
+            connection.notifies.clear()
+
+            if ids and self.subscriber_count():
+                self._deliver(ids)
+
+    def _deliver(self, message_ids):
+        with self.app.app_context():
+            rows = (db.session.query(*MESSAGE_COLUMNS,
+                                     Listing.username.label('host'))
+                    .join(Listing, Listing.id == Message.property_id)
+                    .filter(Message.id.in_(message_ids))
+                    .order_by(Message.id)
+                    .all())
+
+        self.publish(rows)
@@ -0,0 +1,64 @@
+import threading
+
+
+class Metrics:
+    """Process-wide counters and gauges, rendered in Prometheus text format.
+
+    Counters are incremented in place; gauges are callbacks read at render
+    time, so they always report the current value.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._help = {}
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def value(self, name, **labels):
+        """Return a counter's current value (0 if never incremented)."""
+
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def gauge(self, name, callback, **labels):
+        """Register `callback()` as the value of gauge `name`."""
+
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = callback
+
+    def render(self):
+        lines = []
+        described = set()
+
+        # Copy under the lock: another thread adding a series mid-iteration
+        # would raise "dictionary changed size". Gauges run after, unlocked.
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items(), key=lambda item: item[0])
+
+        samples = ([(key, value, 'counter') for key, value in counters]
+                   + [(key, callback(), 'gauge') for key, callback in gauges])
+
+        for (name, labels), value, kind in samples:
+            if name not in described:
+                described.add(name)
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+            label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+            label_text = f"{{{label_text}}}" if label_text else ''
+            lines.append(f"{name}{label_text} {value}")
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
@@ -0,0 +1,7 @@
+"""Create the tables that don't exist yet, as db.create_all() would."""
+
+from models import db
+
+
+def upgrade(connection):
+    db.metadata.create_all(connection, checkfirst=True)
@@ -0,0 +1,27 @@
+"""Index the foreign keys relationship loads and conversations filter on.
+
+Databases created before these indexes were in the models scan whole
+tables for a user's listings and bookings, a listing's bookings and
+messages, and a user's sent messages. Built concurrently, so the tables
+stay writable meanwhile.
+"""
+
+from schemaMigrations import create_index_concurrently
+
+TRANSACTIONAL = False
+
+INDEXES = [
+    ('ix_listings_username', 'listings', ['username']),
+    ('ix_bookings_username', 'bookings', ['username']),
+    ('ix_bookings_property_id_dates', 'bookings',
+     ['property_id', 'check_in_date', 'check_out_date']),
+    ('ix_messages_property_id_sent_at_date_id', 'messages',
+     ['property_id', 'sent_at_date', 'id']),
+    ('ix_messages_from_username_property_id_sent_at_date_id', 'messages',
+     ['from_username', 'property_id', 'sent_at_date', 'id']),
+]
+
+
+def upgrade(connection):
+    for name, table, columns in INDEXES:
+        create_index_concurrently(connection, name, table, columns)
@@ -0,0 +1,41 @@
+"""Add the columns the models gained after the first schema.
+
+users.token_version revokes a user's access tokens. Listings gained
+geocode_status and nullable coordinates (geocoding moved to a background
+worker), image_variants, and the generated search_vector for full-text
+search. Existing listings all have coordinates, so they are marked done.
+
+Adding search_vector computes it for every row, rewriting the listings
+table under an exclusive lock.
+"""
+
+from sqlalchemy import text
+
+STATEMENTS = [
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS token_version integer "
+    "NOT NULL DEFAULT 0",
+
+    "ALTER TABLE listings ADD COLUMN IF NOT EXISTS geocode_status "
+    "varchar(10) NOT NULL DEFAULT 'done'",
+    # New rows get theirs from the app, as in the models.
+    "ALTER TABLE listings ALTER COLUMN geocode_status DROP DEFAULT",
+
+    "ALTER TABLE listings ALTER COLUMN latitude DROP NOT NULL",
+    "ALTER TABLE listings ALTER COLUMN longitude DROP NOT NULL",
+
+    "ALTER TABLE listings ADD COLUMN IF NOT EXISTS image_variants jsonb",
+
+    """
+    ALTER TABLE listings ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', title), 'A') ||
+        setweight(to_tsvector('english', city || ' ' || state), 'B') ||
+        setweight(to_tsvector('english', details), 'C')
+    ) STORED
+    """,
+]
+
+
+def upgrade(connection):
+    for statement in STATEMENTS:
+        connection.execute(text(statement))
@@ -0,0 +1,33 @@
+"""Index the listing columns search and geocoding filter on.
+
+Full-text search reads ix_listings_search_vector, map searches
+ix_listings_latitude_longitude, and the geocode backfill the small partial
+ix_listings_geocode_unresolved. Typo-tolerant title search uses a trigram
+index, where the server has the pg_trgm extension. Built concurrently, so
+listings stay writable meanwhile.
+"""
+
+from sqlalchemy import text
+
+from schemaMigrations import create_index_concurrently
+
+TRANSACTIONAL = False
+
+
+def upgrade(connection):
+    create_index_concurrently(connection, 'ix_listings_search_vector',
+                              'listings', ['search_vector'], using='gin')
+    create_index_concurrently(connection, 'ix_listings_latitude_longitude',
+                              'listings', ['latitude', 'longitude'])
+    create_index_concurrently(
+        connection, 'ix_listings_geocode_unresolved', 'listings', ['id'],
+        where="geocode_status IN ('pending', 'failed')")
+
+    # pg_trgm ships with Postgres contrib, which not every server has.
+    if connection.execute(text(
+            "SELECT EXISTS (SELECT FROM pg_available_extensions "
+            "WHERE name = 'pg_trgm')")).scalar():
+        connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        create_index_concurrently(connection, 'ix_listings_title_trgm',
+                                  'listings', ['title gin_trgm_ops'],
+                                  using='gin')
@@ -0,0 +1,6 @@
+"""Schema migrations, applied in order by schemaMigrations.upgrade().
+
+0001_baseline creates whatever tables don't exist yet from the current
+models, so later migrations must be safe to run against a schema that
+already has their change (IF NOT EXISTS, create_index_concurrently()).
+"""
@@ -1,13 +1,67 @@
+from flask import g, has_app_context
 from flask_sqlalchemy import SQLAlchemy
-from flask_bcrypt import Bcrypt
+from flask_sqlalchemy.session import Session
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR
+from sqlalchemy.orm import configure_mappers, deferred, selectinload
 from datetime import datetime
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from passwords import password_hasher
+
+
+
+class RoutingSession(Session):
+    """Session that runs a request's reads on the engine in `g.db_engine`
+    (a read replica, see readReplicas.py) when one is set. Flushes always
+    go to the primary."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_app_context():
+            engine = g.get('db_engine')
+            if engine is not None:
+                return engine
+
+        return super().get_bind(mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 DEFAULT_IMAGE_URL = (
     "https://www.keywestnavalhousing.com/media/com_posthousing/images/nophoto.png")
 
+# Listing.geocode_status values.
+GEOCODE_PENDING = 'pending'
+GEOCODE_DONE = 'done'
+GEOCODE_FAILED = 'failed'
+
+
+def image_srcset(image_variants):
+    """Turn Listing.image_variants into srcset strings per content type, e.g.
+    {"image/webp": "https://.../a-320.webp 320w, https://.../a-800.webp 800w"}
+    or None if there are no variants yet.
+    """
+
+    if not image_variants:
+        return None
+
+    return {
+        content_type: ', '.join(
+            f"{url} {width}w"
+            for width, url in sorted(urls.items(), key=lambda u: int(u[0])))
+        for content_type, urls in image_variants.items()
+    }
+
+
+def _default_geocode_status(context):
+    """Listings created with coordinates are already geocoded."""
+
+    params = context.get_current_parameters()
+
+    if params.get('latitude') is not None and params.get('longitude') is not None:
+        return GEOCODE_DONE
+
+    return GEOCODE_PENDING
+
 
 class User(db.Model):
     """User in the shareBnb."""
@@ -46,9 +100,22 @@ class User(db.Model):
         default=False,
     )
 
-    listing = db.relationship('Listing', backref='host')
+    # Sent as the "ver" claim of access tokens. Bump it to revoke every
+    # token issued to this user.
+    token_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
 
-    booking = db.relationship('Booking', backref="guest")
+    # Deleting a user deletes their rows through the foreign keys' ON DELETE
+    # CASCADE; passive_deletes keeps the ORM from loading them first.
+    listing = db.relationship('Listing', backref='host',
+                              cascade='all, delete', passive_deletes=True)
+
+    booking = db.relationship('Booking', backref="guest",
+                              cascade='all, delete', passive_deletes=True)
 
     @classmethod
     def signup(cls, username, first_name, last_name, email, password, is_host):
@@ -56,7 +123,7 @@ class User(db.Model):
 
         Hashes password and adds user to session.
         """
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = password_hasher.hash(password)
 
         user = User(
             username=username,
@@ -82,13 +149,20 @@ class User(db.Model):
 
         If this can't find matching user (or if password is wrong), returns
         False.
+
+        Raises PasswordPoolSaturated if the password workers are all busy.
         """
 
         user = cls.query.filter_by(username=username).one_or_none()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = password_hasher.verify(user.password, password)
             if is_auth:
+                # The cost factor changed since this hash was made; now is
+                # the only time we have the password to upgrade it.
+                if password_hasher.needs_rehash(user.password):
+                    user.password = password_hasher.hash(password)
+                    db.session.commit()
                 return user
 
         return False
@@ -114,6 +188,20 @@ class Listing(db.Model):
 
     __table_args__=(
         db.UniqueConstraint("street", "city"),
+        db.Index(
+            'ix_listings_search_vector',
+            'search_vector',
+            postgresql_using='gin'),
+        db.Index('ix_listings_latitude_longitude', 'latitude', 'longitude'),
+        # A host's listings, e.g. to find the conversations they take part in.
+        db.Index('ix_listings_username', 'username'),
+        # Small partial index so the geocode backfill finds unresolved rows
+        # without scanning the table.
+        db.Index(
+            'ix_listings_geocode_unresolved',
+            'id',
+            postgresql_where=db.text(
+                "geocode_status IN ('pending', 'failed')")),
     )
 
     id = db.Column(
@@ -142,14 +230,21 @@ class Listing(db.Model):
         nullable=False
     )
 
+    # Null until the background geocoder resolves the address.
     longitude = db.Column(
         db.Float,
-        nullable=False
+        nullable=True
     )
 
     latitude = db.Column(
         db.Float,
-        nullable=False
+        nullable=True
+    )
+
+    geocode_status = db.Column(
+        db.String(10),
+        nullable=False,
+        default=_default_geocode_status,
     )
 
     state = db.Column(
@@ -178,14 +273,41 @@ class Listing(db.Model):
         default=DEFAULT_IMAGE_URL,
     )
 
+    # Resized copies of the image: {content type: {width: url}}. Null until
+    # the image pipeline has produced them.
+    image_variants = db.Column(
+        JSONB,
+        nullable=True,
+    )
+
     username = db.Column(
         db.String(30),
         db.ForeignKey('users.username', ondelete='CASCADE'),
         nullable=False,
     )
 
+    # Weighted full-text document over title, place and details, maintained
+    # by Postgres itself. Deferred so it is never shipped back with a row.
+    search_vector = deferred(db.Column(
+        TSVECTOR,
+        db.Computed(
+            "setweight(to_tsvector('english', title), 'A') || "
+            "setweight(to_tsvector('english', city || ' ' || state), 'B') || "
+            "setweight(to_tsvector('english', details), 'C')",
+            persisted=True),
+    ))
+
+    def image_srcset(self):
+        """Variant URLs as srcset strings per content type."""
+
+        return image_srcset(self.image_variants)
+
     def serialize(self):
-        """Serialize to dictionary."""
+        """Serialize to dictionary.
+
+        Messages are left out: a busy listing has too many to ship on every
+        view. They are paged from GET /listings/<id>/messages.
+        """
 
         return {
             'id': self.id,
@@ -198,18 +320,67 @@ class Listing(db.Model):
             'country': self.country,
             'price_per_night': self.price_per_night,
             'image_url': self.image_url,
+            'image_srcset': self.image_srcset(),
             'username': self.username,
             'latitude': self.latitude,
             'longitude': self.longitude,
-            'messages': [m.serialize() for m in self.messages],
+            'geocode_status': self.geocode_status,
             'bookings': [b.serialize() for b in self.bookings]
         }
 
+    def serialize_summary(self):
+        """Serialize to a compact dictionary for list views.
+
+        Leaves out details and the nested messages/bookings, so it never
+        touches a relationship.
+        """
+
+        return Listing.summary_from_row(self)
+
+    @staticmethod
+    def summary_from_row(row):
+        """serialize_summary() of a listing or of a row selected with
+        LISTING_SUMMARY_COLUMNS, the only attributes it reads."""
+
+        return {
+            'id': row.id,
+            'title': row.title,
+            'city': row.city,
+            'state': row.state,
+            'country': row.country,
+            'price_per_night': row.price_per_night,
+            'image_url': row.image_url,
+            'image_srcset': image_srcset(row.image_variants),
+            'username': row.username,
+            'latitude': row.latitude,
+            'longitude': row.longitude,
+            'geocode_status': row.geocode_status,
+        }
+
+    @staticmethod
+    def nearby_from_row(row, distance_km):
+        """Serialize for nearby search: the summary plus distance in km."""
+
+        return {**Listing.summary_from_row(row),
+                'distance_km': round(distance_km, 3)}
+
 
 class Booking(db.Model):
 
     __tablename__= 'bookings'
 
+    __table_args__=(
+        # Serves availability search: for each listing, probe its bookings
+        # by date without touching the heap.
+        db.Index(
+            'ix_bookings_property_id_dates',
+            'property_id',
+            'check_in_date',
+            'check_out_date'),
+        # A guest's bookings (User.booking).
+        db.Index('ix_bookings_username', 'username'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -243,24 +414,47 @@ class Booking(db.Model):
         nullable=False
     )
 
-    property = db.relationship('Listing', backref='bookings')
+    property = db.relationship('Listing', backref=db.backref(
+        'bookings', cascade='all, delete', passive_deletes=True))
 
     def serialize(self):
         """Serialize to dictionary."""
 
+        return Booking.from_row(self)
+
+    @staticmethod
+    def from_row(row):
+        """serialize() of a booking or of a row of BOOKING_COLUMNS."""
+
         return {
-            'id': self.id,
-            'username': self.username,
-            'property_id': self.property_id,
-            'check_in_date': self.check_in_date,
-            'check_out_date': self.check_out_date,
-            'booking_price_per_night': self.booking_price_per_night,
+            'id': row.id,
+            'username': row.username,
+            'property_id': row.property_id,
+            'check_in_date': row.check_in_date,
+            'check_out_date': row.check_out_date,
+            'booking_price_per_night': row.booking_price_per_night,
         }
 
 class Message(db.Model):
 
     __tablename__= 'messages'
 
+    __table_args__=(
+        # Keyset order of a listing's conversation, and of a user's
+        # conversations (grouped by listing) for the messages they sent.
+        db.Index(
+            'ix_messages_property_id_sent_at_date_id',
+            'property_id',
+            'sent_at_date',
+            'id'),
+        db.Index(
+            'ix_messages_from_username_property_id_sent_at_date_id',
+            'from_username',
+            'property_id',
+            'sent_at_date',
+            'id'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -287,23 +481,134 @@ class Message(db.Model):
     sent_at_date = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.now()
+        default=datetime.now
     )
 
-    from_user = db.relationship('User', backref="sent_messages")
-    listing = db.relationship('Listing', backref="messages")
+    from_user = db.relationship('User', backref=db.backref(
+        'sent_messages', cascade='all, delete', passive_deletes=True))
+    listing = db.relationship('Listing', backref=db.backref(
+        'messages', cascade='all, delete', passive_deletes=True))
 
 
     def serialize(self):
         """Serialize to dictionary."""
 
+        return Message.from_row(self)
+
+    @staticmethod
+    def from_row(row):
+        """serialize() of a message or of a row of MESSAGE_COLUMNS."""
+
         return {
-            "id": self.id,
-            "body": self.body,
-            "from_user": self.from_user.username,
-            "sent_at_date": self.sent_at_date,
+            "id": row.id,
+            "body": row.body,
+            "from_user": row.from_username,
+            "property_id": row.property_id,
+            "sent_at_date": row.sent_at_date,
         }
 
+class GeocodeCache(db.Model):
+    """Durable cache of normalized address -> coordinates.
+
+    A row with null latitude/longitude records that the geocoder could not
+    resolve the address (a negative entry).
+    """
+
+    __tablename__= 'geocode_cache'
+
+    address = db.Column(
+        db.String(255),
+        primary_key=True
+    )
+
+    latitude = db.Column(
+        db.Float,
+        nullable=True
+    )
+
+    longitude = db.Column(
+        db.Float,
+        nullable=True
+    )
+
+    expires_at = db.Column(
+        db.DateTime,
+        nullable=False
+    )
+
+
+# Trigram index on titles for typo-tolerant search. pg_trgm ships with
+# Postgres contrib, which not every server has, so only add it when available.
+event.listen(Listing.__table__, 'after_create', DDL("""
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm')
+    THEN
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE INDEX IF NOT EXISTS ix_listings_title_trgm
+            ON listings USING gin (title gin_trgm_ops);
+    END IF;
+END $$
+""").execute_if(dialect='postgresql'))
+
+# Backref attributes (Listing.messages, User.sent_messages, ...) only exist
+# once the mappers are configured, and the loading plans below need them.
+configure_mappers()
+
+##############################################################################
+# Loading plans: loader options for exactly the relationships each
+# serialize() walks, so a route loads a whole object graph in a fixed number
+# of SELECTs instead of one lazy load per row.
+
+LISTING_DETAIL_PLAN = (
+    selectinload(Listing.bookings),
+)
+
+USER_DETAIL_PLAN = (
+    selectinload(User.listing).selectinload(Listing.bookings),
+    selectinload(User.booking),
+    selectinload(User.sent_messages),
+)
+
+##############################################################################
+# Column projections: exactly the columns a flat serializer reads. List
+# routes select these instead of whole entities, skipping ORM hydration and
+# identity-map bookkeeping. The models' row serializers only use attribute
+# access, so they take the resulting rows as-is, e.g. Booking.from_row(row).
+
+LISTING_SUMMARY_COLUMNS = (
+    Listing.id,
+    Listing.title,
+    Listing.city,
+    Listing.state,
+    Listing.country,
+    Listing.price_per_night,
+    Listing.image_url,
+    Listing.image_variants,
+    Listing.username,
+    Listing.latitude,
+    Listing.longitude,
+    Listing.geocode_status,
+)
+
+BOOKING_COLUMNS = (
+    Booking.id,
+    Booking.username,
+    Booking.property_id,
+    Booking.check_in_date,
+    Booking.check_out_date,
+    Booking.booking_price_per_night,
+)
+
+MESSAGE_COLUMNS = (
+    Message.id,
+    Message.body,
+    Message.from_username,
+    Message.property_id,
+    Message.sent_at_date,
+)
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
     You should call this in your Flask app.
@@ -0,0 +1,144 @@
+import base64
+import json
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+class InvalidCursor(ValueError):
+    """Raised when a client sends a cursor we did not hand out."""
+
+
+def encode_cursor(position):
+    """Encode a keyset position (dict of sort key values) as an opaque string."""
+
+    raw = json.dumps(position, separators=(',', ':')).encode('UTF-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor made by encode_cursor back into a dict.
+
+    Raises InvalidCursor if the cursor is malformed.
+    """
+
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        position = json.loads(base64.urlsafe_b64decode(padded))
+    except (ValueError, TypeError):
+        raise InvalidCursor(cursor)
+
+    if not isinstance(position, dict):
+        raise InvalidCursor(cursor)
+
+    return position
+
+
+def get_page_size(args):
+    """Read `limit` from the query string, clamped to [1, MAX_PAGE_SIZE]."""
+
+    try:
+        limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        limit = DEFAULT_PAGE_SIZE
+
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def paginate_by_id(query, id_column, limit, cursor=None):
+    """Return one page of `query` ordered by `id_column`, plus the next cursor.
+
+    Fetches limit + 1 rows so we know whether another page exists without a
+    COUNT(*). Returns (rows, next_cursor); next_cursor is None on the last page.
+    """
+
+    if cursor:
+        position = decode_cursor(cursor)
+        try:
+            after_id = int(position['id'])
+        except (KeyError, TypeError, ValueError):
+            raise InvalidCursor(cursor)
+        query = query.filter(id_column > after_id)
+
+    rows = query.order_by(id_column).limit(limit + 1).all()
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, encode_cursor({'id': rows[-1].id})
+
+    return rows, None
+
+
+def _cursor_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _column_value(column, value):
+    python_type = column.type.python_type
+
+    if python_type is datetime:
+        return datetime.fromisoformat(value)
+
+    return python_type(value)
+
+
+def paginate_by_keys(query, columns, limit, cursor=None):
+    """Like paginate_by_id, but ordered by several `columns` ascending.
+
+    The columns together must be unique (end with the primary key), and
+    each row must carry them as attributes (e.g. a projection including
+    them). The position is compared as one row value, so an index on the
+    same columns serves both the filter and the ordering.
+    """
+
+    rows = (_after_keys(query, columns, cursor)
+            .order_by(*columns).limit(limit + 1).all())
+
+    return _keys_page(rows, columns, limit)
+
+
+def paginate_union_by_keys(queries, columns, limit, cursor=None):
+    """paginate_by_keys over the UNION ALL of `queries`, which must not
+    share rows.
+
+    Each query is filtered, ordered and limited on its own before the
+    union, so each walks its own index in key order; the outer query only
+    merges a few pages. An OR of their filters would instead leave the
+    planner to scan and sort every matching row.
+    """
+
+    pages = [_after_keys(query, columns, cursor)
+             .order_by(*columns).limit(limit + 1)
+             for query in queries]
+
+    rows = (pages[0].union_all(*pages[1:])
+            .order_by(*columns).limit(limit + 1).all())
+
+    return _keys_page(rows, columns, limit)
+
+
+def _after_keys(query, columns, cursor):
+    if not cursor:
+        return query
+
+    position = decode_cursor(cursor)
+    try:
+        after = [_column_value(column, position[column.key])
+                 for column in columns]
+    except (KeyError, TypeError, ValueError):
+        raise InvalidCursor(cursor)
+
+    return query.filter(tuple_(*columns) > tuple_(*after))
+
+
+def _keys_page(rows, columns, limit):
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, encode_cursor({
+            column.key: _cursor_value(getattr(rows[-1], column.key))
+            for column in columns})
+
+    return rows, None
@@ -0,0 +1,103 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+from metrics import metrics
+
+metrics.describe('password_pool_rejected_total',
+                 'Password hash/verify calls refused because the pool was full.')
+
+
+class PasswordPoolSaturated(Exception):
+    """Every password worker is busy and the wait queue is full."""
+
+
+class PasswordHasher:
+    """bcrypt hashing and verification on a bounded worker pool.
+
+    bcrypt releases the GIL while it works, so a thread pool keeps password
+    work to PASSWORD_WORKERS cores, leaving the rest for cheap requests.
+    At most PASSWORD_MAX_QUEUE calls may wait for a worker; beyond that
+    calls raise PasswordPoolSaturated straight away rather than piling up.
+    PASSWORD_WORKERS = 0 hashes inline on the calling thread.
+
+    BCRYPT_LOG_ROUNDS sets the cost factor for new hashes; needs_rehash()
+    spots hashes made with a different one.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        metrics.gauge('password_pool_in_flight', lambda: self._in_flight)
+
+        workers = max(1, os.cpu_count() // 2)
+        self.configure(rounds=12, workers=workers, max_queue=4 * workers)
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BCRYPT_LOG_ROUNDS', self.rounds)
+        app.config.setdefault('PASSWORD_WORKERS', self.workers)
+        app.config.setdefault('PASSWORD_MAX_QUEUE', self.max_queue)
+
+        self.configure(rounds=app.config['BCRYPT_LOG_ROUNDS'],
+                       workers=app.config['PASSWORD_WORKERS'],
+                       max_queue=app.config['PASSWORD_MAX_QUEUE'])
+
+    def configure(self, rounds, workers, max_queue):
+        self.rounds = rounds
+        self.workers = workers
+        self.max_queue = max_queue
+        old = getattr(self, '_pool', None)
+        # Threads are only started on first use.
+        self._pool = (ThreadPoolExecutor(max_workers=workers,
+                                         thread_name_prefix='bcrypt')
+                      if workers else None)
+
+        # Let the old pool's threads exit once their hashes finish.
+        if old is not None:
+            old.shutdown(wait=False)
+
+    def _run(self, fn, *args):
+        if self._pool is None:
+            return fn(*args)
+
+        with self._lock:
+            if self._in_flight >= self.workers + self.max_queue:
+                metrics.inc('password_pool_rejected_total')
+                raise PasswordPoolSaturated()
+            self._in_flight += 1
+
+        try:
+            return self._pool.submit(fn, *args).result()
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def hash(self, password):
+        """Return a bcrypt hash (str) of `password` at the current cost."""
+
+        hashed = self._run(bcrypt.hashpw, password.encode('UTF-8'),
+                           bcrypt.gensalt(self.rounds))
+        return hashed.decode('UTF-8')
+
+    def verify(self, hashed, password):
+        """Return True if `password` matches the bcrypt hash `hashed`."""
+
+        return self._run(bcrypt.checkpw, password.encode('UTF-8'),
+                         hashed.encode('UTF-8'))
+
+    def needs_rehash(self, hashed):
+        """True if `hashed` was made with a different cost factor."""
+
+        # bcrypt hashes look like $2b$12$<salt+hash>; the 12 is the cost.
+        try:
+            return int(hashed.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+
+password_hasher = PasswordHasher()
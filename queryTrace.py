@@ -0,0 +1,121 @@
+import json
+import logging
+import random
+import re
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('sharebnb.sql')
+
+SLOWEST_KEPT = 3
+
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|%s|\?|(?<!:):\w+")
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_sql(statement):
+    """Reduce a statement to its shape so equal queries group together.
+
+    Literals and bind placeholders become `?`, IN lists collapse to `(...)`
+    and whitespace is squashed.
+    """
+
+    statement = _STRING.sub('?', statement)
+    statement = _PLACEHOLDER.sub('?', statement)
+    statement = _NUMBER.sub('?', statement)
+    statement = _IN_LIST.sub('(...)', statement)
+    return _WHITESPACE.sub(' ', statement).strip()
+
+
+class QueryTracer:
+    """Record query count, DB time and slowest statements per Flask request.
+
+    Adds a Server-Timing header to every response and logs a sampled,
+    structured record of requests that ran slow statements.
+
+    Config:
+        SQL_TRACE_SLOW_MS: statements at or above this many ms are slow.
+        SQL_TRACE_SAMPLE_RATE: fraction of slow requests that get logged.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SQL_TRACE_SLOW_MS', 100)
+        app.config.setdefault('SQL_TRACE_SAMPLE_RATE', 0.1)
+
+        self.slow_ms = float(app.config['SQL_TRACE_SLOW_MS'])
+        self.sample_rate = float(app.config['SQL_TRACE_SAMPLE_RATE'])
+
+        # Listen on the Engine class so every engine (and bind) is traced.
+        event.listen(Engine, 'before_cursor_execute', self._before_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_execute)
+        event.listen(Engine, 'handle_error', self._failed_execute)
+
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+
+    def _start_request(self):
+        g.sql_trace = {'count': 0, 'total_ms': 0.0, 'slowest': []}
+
+    def _before_execute(self, conn, cursor, statement, parameters, context,
+                        executemany):
+        conn.info.setdefault('sql_trace_start', []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        started = conn.info['sql_trace_start'].pop()
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        if not has_request_context() or 'sql_trace' not in g:
+            return
+
+        trace = g.sql_trace
+        trace['count'] += 1
+        trace['total_ms'] += elapsed_ms
+
+        slowest = trace['slowest']
+        if len(slowest) < SLOWEST_KEPT or elapsed_ms > slowest[-1][0]:
+            slowest.append((elapsed_ms, statement))
+            slowest.sort(key=lambda entry: entry[0], reverse=True)
+            del slowest[SLOWEST_KEPT:]
+
+    def _failed_execute(self, context):
+        # A failed statement never reaches _after_execute; drop its start so
+        # later statements on this pooled connection pair with their own.
+        starts = (context.connection.info.get('sql_trace_start')
+                  if context.connection is not None else None)
+        if starts:
+            starts.pop()
+
+    def _finish_request(self, response):
+        trace = g.pop('sql_trace', None)
+
+        if trace is None:
+            return response
+
+        response.headers.add(
+            'Server-Timing',
+            f'db;dur={trace["total_ms"]:.2f};desc="{trace["count"]} queries"')
+
+        slow = [(ms, sql) for ms, sql in trace['slowest'] if ms >= self.slow_ms]
+
+        if slow and random.random() < self.sample_rate:
+            logger.warning(json.dumps({
+                'event': 'slow_queries',
+                'endpoint': request.endpoint,
+                'query_count': trace['count'],
+                'db_ms': round(trace['total_ms'], 2),
+                'slow': [{'ms': round(ms, 2), 'sql': normalize_sql(sql)}
+                         for ms, sql in slow],
+            }))
+
+        return response
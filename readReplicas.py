@@ -0,0 +1,269 @@
+import itertools
+import logging
+import math
+import os
+import threading
+import time
+
+from flask import g, request
+from flask_jwt_extended import decode_token
+from flask_jwt_extended.exceptions import JWTExtendedException
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from jwt import PyJWTError
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import DBAPIError
+
+from cache import LRUCache
+from dbPool import engine_options
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+metrics.describe('db_replica_reads_total',
+                 'Requests whose reads were sent to a replica.')
+metrics.describe('db_replica_primary_reads_total',
+                 'Read requests sent to the primary, by reason.')
+metrics.describe('db_replica_lag_seconds',
+                 'Replication lag at the last health check (-1 if down).')
+metrics.describe('db_replica_healthy',
+                 'Whether a replica is taking reads (1) or not (0).')
+
+SAFE_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+# Seconds a replica is behind the primary; 0 when it has replayed all it
+# received, or when it isn't a standby at all. NULL when it isn't streaming
+# WAL from the primary: having replayed all it received then says nothing
+# about how far behind it is. The status is only visible to roles with
+# pg_monitor (or pg_read_all_stats); without it a replica never checks
+# out healthy.
+LAG_SQL = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN NOT EXISTS (SELECT FROM pg_stat_wal_receiver
+                         WHERE status = 'streaming') THEN NULL
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+""")
+
+# Cookie keeping a client's reads on the primary after it writes.
+STICKY_COOKIE = 'read_primary'
+
+
+class Replica:
+    """A read replica's engine and its state at the last health check."""
+
+    def __init__(self, name, engine):
+        self.name = name
+        self.engine = engine
+        self.lag = None
+        self.healthy = False
+
+
+class ReplicaRouter:
+    """Send read-only requests to read replicas, and the rest to the primary.
+
+    DATABASE_REPLICA_URLS lists the replicas, comma-separated. GET and HEAD
+    requests read from a healthy replica, round robin; RoutingSession runs
+    their statements on it. A background thread checks every replica each
+    REPLICA_CHECK_INTERVAL seconds, and one that can't be reached or is more
+    than REPLICA_MAX_LAG seconds behind takes no reads until it catches up.
+    With none healthy, reads fall back to the primary.
+
+    After a successful write, that client's reads stay on the primary for
+    REPLICA_STICKY_SECONDS, so they see their own writes. Keep it above
+    REPLICA_MAX_LAG: after that long every replica still taking reads has
+    the write too. The response sets a signed, timestamped cookie, so the
+    client sticks whichever worker process serves its next reads; clients
+    that don't keep cookies stick by user (or address, without an access
+    token) in this process only. Sticky reads also skip the response
+    cache, whose invalidations other processes don't see.
+    """
+
+    def __init__(self, app=None):
+        self.replicas = []
+        self._next = itertools.count()
+        self._thread = None
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('DATABASE_REPLICA_URLS',
+                              os.environ.get('DATABASE_REPLICA_URLS', ''))
+        app.config.setdefault('REPLICA_MAX_LAG', float(
+            os.environ.get('REPLICA_MAX_LAG', 2)))
+        app.config.setdefault('REPLICA_STICKY_SECONDS', float(
+            os.environ.get('REPLICA_STICKY_SECONDS', 5)))
+        app.config.setdefault('REPLICA_CHECK_INTERVAL', float(
+            os.environ.get('REPLICA_CHECK_INTERVAL', 5)))
+
+        self.app = app
+        self.sticky = LRUCache(100_000, app.config['REPLICA_STICKY_SECONDS'])
+
+        for url in app.config['DATABASE_REPLICA_URLS'].split(','):
+            if url.strip():
+                self.add(url.strip().replace('postgres://', 'postgresql://'))
+
+        app.before_request(self._route)
+        app.after_request(self._stick)
+        app.teardown_request(self._release)
+
+    def add(self, url):
+        """Start sending reads to the replica at `url` once it checks out
+        healthy."""
+
+        replica = Replica(f"replica{len(self.replicas)}",
+                          create_engine(url, **engine_options(url)))
+        self.replicas.append(replica)
+
+        metrics.gauge('db_replica_lag_seconds',
+                      lambda: -1 if replica.lag is None else replica.lag,
+                      replica=replica.name)
+        metrics.gauge('db_replica_healthy', lambda: int(replica.healthy),
+                      replica=replica.name)
+
+        return replica
+
+    def check(self):
+        """Measure every replica's lag and mark whether it takes reads."""
+
+        max_lag = self.app.config['REPLICA_MAX_LAG']
+
+        for replica in self.replicas:
+            try:
+                with replica.engine.connect() as connection:
+                    lag = connection.execute(LAG_SQL).scalar()
+            except DBAPIError:
+                logger.warning("replica %s is unreachable", replica.name,
+                               exc_info=True)
+                lag = None
+            else:
+                if lag is None:
+                    logger.warning("replica %s is not streaming WAL",
+                                   replica.name)
+
+            replica.lag = None if lag is None else float(lag)
+            replica.healthy = lag is not None and lag <= max_lag
+
+    def choose(self):
+        """A healthy replica's engine, taking turns; None if there's none."""
+
+        healthy = [replica for replica in self.replicas if replica.healthy]
+
+        if not healthy:
+            return None
+
+        return healthy[next(self._next) % len(healthy)].engine
+
+    def client_key(self):
+        """Who a request is from: the user of its access token if it has a
+        valid one, else the client address."""
+
+        header = request.headers.get('Authorization', '')
+
+        if header.startswith('Bearer '):
+            try:
+                return decode_token(header[len('Bearer '):])['sub']['username']
+            except (JWTExtendedException, PyJWTError, KeyError, TypeError):
+                pass
+
+        return request.remote_addr
+
+    def wrote_recently(self):
+        """Whether this request's client made a write within
+        REPLICA_STICKY_SECONDS."""
+
+        cookie = request.cookies.get(STICKY_COOKIE)
+
+        if cookie:
+            try:
+                self._signer().loads(
+                    cookie, max_age=self.app.config['REPLICA_STICKY_SECONDS'])
+                return True
+            except BadSignature:
+                pass
+
+        return bool(len(self.sticky) and self.sticky.get(self.client_key(),
+                                                         None))
+
+    def _signer(self):
+        return URLSafeTimedSerializer(
+            self.app.config.get('SECRET_KEY')
+            or self.app.config['JWT_SECRET_KEY'],
+            salt=STICKY_COOKIE)
+
+    def _route(self):
+        g.db_engine = None
+        g.read_own_writes = False
+
+        if not self.replicas or request.method not in SAFE_METHODS:
+            return
+
+        self._start()
+
+        if self.wrote_recently():
+            g.read_own_writes = True
+            metrics.inc('db_replica_primary_reads_total', reason='sticky')
+            return
+
+        g.db_engine = self.choose()
+
+        if g.db_engine is None:
+            metrics.inc('db_replica_primary_reads_total', reason='unhealthy')
+        else:
+            metrics.inc('db_replica_reads_total')
+
+    def _stick(self, response):
+        if (self.replicas and request.method not in SAFE_METHODS
+                and response.status_code < 400):
+            self.sticky.set(self.client_key(), True)
+            # The signature's timestamp is the deadline's start; any
+            # worker checks it with the shared secret.
+            response.set_cookie(
+                STICKY_COOKIE, self._signer().dumps(1),
+                max_age=math.ceil(self.app.config['REPLICA_STICKY_SECONDS']),
+                httponly=True, samesite='Lax')
+
+        return response
+
+    def _release(self, exc):
+        engine = g.pop('db_engine', None)
+        g.pop('read_own_writes', None)
+
+        # Don't wait for the next check to stop using a replica that failed.
+        if engine is not None and isinstance(exc, DBAPIError):
+            for replica in self.replicas:
+                if replica.engine is engine:
+                    replica.healthy = False
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._check_forever, name='replica-checker',
+                    daemon=True)
+                self._thread.start()
+
+    def _check_forever(self):
+        while True:
+            try:
+                self.check()
+            except Exception:
+                logger.exception("replica health check failed")
+
+            time.sleep(self.app.config['REPLICA_CHECK_INTERVAL'])
+
+
+def use_primary():
+    """Run the rest of this request's statements on the primary."""
+
+    g.db_engine = None
+
+
+def reads_own_writes():
+    """Whether this request is from a client that just wrote, and must see
+    the write."""
+
+    return g.get('read_own_writes', False)
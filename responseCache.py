@@ -0,0 +1,209 @@
+import hashlib
+import threading
+import time
+from collections import namedtuple
+from functools import wraps
+
+from flask import current_app, g, request, Response
+from werkzeug.http import http_date
+
+from cache import LRUCache, MISSING
+from fieldsets import included_types
+from metrics import metrics
+from readReplicas import reads_own_writes, use_primary
+
+metrics.describe('response_cache_hits_total', 'Cached GET responses served.')
+metrics.describe('response_cache_misses_total',
+                 'Cacheable GET responses that had to be rendered.')
+metrics.describe('response_cache_not_modified_total',
+                 'Conditional GETs answered with 304 Not Modified.')
+metrics.describe('response_cache_saved_db_ms_total',
+                 'DB time (ms) the cached responses originally cost.')
+
+CachedResponse = namedtuple('CachedResponse', [
+    'body', 'mimetype', 'etag', 'last_modified', 'generations', 'db_ms'])
+
+
+class ResponseCache:
+    """Cache rendered GET responses, with ETags and tag-based invalidation.
+
+    Views opt in with @response_cache.cached(tags=...), where `tags` maps
+    the view's arguments to the resources the response depends on
+    (e.g. {"listing:3"}). Writes call invalidate("listing:3"), which bumps
+    that tag's generation; entries cached under an older generation are
+    treated as misses. Nothing has to be found or deleted, so invalidation
+    is O(1) and works with any store.
+
+    Every cached view's response carries an ETag and Last-Modified, and
+    conditional GETs whose If-None-Match still matches get a bodyless 304.
+    If-Modified-Since alone never does: Last-Modified has one-second
+    resolution, so a write in the same second as the cached render would
+    look unmodified.
+
+    `store` is anything with LRUCache's get/set; by default an in-process
+    LRU of RESPONSE_CACHE_SIZE entries that expire after RESPONSE_CACHE_TTL
+    seconds. The TTL bounds how stale a response can be in other worker
+    processes, which don't see this process's invalidations.
+
+    Misses on tags invalidated within the last REPLICA_MAX_LAG seconds are
+    rendered from the primary, so a lagging read replica can't put a page
+    from before the write back in the cache. Other processes don't know of
+    the write, so theirs may, for up to the TTL as above; the writer itself
+    still sees it, as its sticky reads (see ReplicaRouter) skip the cache.
+    """
+
+    def __init__(self, app=None, store=None):
+        self.store = store
+        self._generations = {}
+        self._invalidated_at = {}
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RESPONSE_CACHE_ENABLED', True)
+        app.config.setdefault('RESPONSE_CACHE_SIZE', 10_000)
+        app.config.setdefault('RESPONSE_CACHE_TTL', 30)
+
+        if self.store is None:
+            self.store = LRUCache(app.config['RESPONSE_CACHE_SIZE'],
+                                  app.config['RESPONSE_CACHE_TTL'])
+
+        metrics.gauge('response_cache_hit_ratio', self.hit_ratio)
+
+    def hit_ratio(self):
+        hits = metrics.value('response_cache_hits_total')
+        total = hits + metrics.value('response_cache_misses_total')
+        return round(hits / total, 4) if total else 0
+
+    def invalidate(self, *tags):
+        """Mark every response depending on any of `tags` as stale."""
+
+        now = time.monotonic()
+
+        with self._lock:
+            for tag in tags:
+                self._generations[tag] = self._generations.get(tag, 0) + 1
+                self._invalidated_at[tag] = now
+
+    def _invalidated_within(self, tags, seconds):
+        since = time.monotonic() - seconds
+        return any(self._invalidated_at.get(tag, since) > since
+                   for tag in tags)
+
+    def _current(self, tags):
+        return tuple(sorted((tag, self._generations.get(tag, 0))
+                            for tag in tags))
+
+    def cached(self, tags):
+        """Decorate a GET view; `tags(**view_args)` returns its tags."""
+
+        def decorator(view):
+            @wraps(view)
+            def wrapper(**view_args):
+                if not current_app.config['RESPONSE_CACHE_ENABLED']:
+                    return view(**view_args)
+
+                key = request.full_path
+                # Read generations before rendering: a write that lands
+                # mid-render leaves this entry already stale.
+                view_tags = tags(**view_args)
+                generations = self._current(view_tags)
+                # A client that just wrote may have hit another process,
+                # whose invalidation this one never saw.
+                entry = (MISSING if reads_own_writes()
+                         else self.store.get(key))
+
+                if entry is not MISSING and entry.generations == generations:
+                    metrics.inc('response_cache_hits_total')
+                    metrics.inc('response_cache_saved_db_ms_total', entry.db_ms)
+                    return self._respond(entry)
+
+                metrics.inc('response_cache_misses_total')
+
+                if self._invalidated_within(
+                        view_tags, current_app.config.get('REPLICA_MAX_LAG', 0)):
+                    use_primary()
+
+                trace = g.get('sql_trace')
+                db_ms_before = trace['total_ms'] if trace else 0
+
+                response = current_app.make_response(view(**view_args))
+
+                if response.status_code != 200:
+                    return response
+
+                body = response.get_data()
+                entry = CachedResponse(
+                    body=body,
+                    mimetype=response.mimetype,
+                    etag=hashlib.blake2b(body, digest_size=16).hexdigest(),
+                    last_modified=int(time.time()),
+                    generations=generations,
+                    db_ms=(trace['total_ms'] - db_ms_before) if trace else 0)
+                self.store.set(key, entry)
+
+                return self._respond(entry)
+
+            return wrapper
+
+        return decorator
+
+    def _respond(self, entry):
+        if self._not_modified(entry):
+            metrics.inc('response_cache_not_modified_total')
+            response = Response(status=304)
+        else:
+            response = Response(entry.body, mimetype=entry.mimetype)
+
+        response.set_etag(entry.etag)
+        response.headers['Last-Modified'] = http_date(entry.last_modified)
+        # Clients may keep a copy but must revalidate it (cheaply, via 304).
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    def _not_modified(self, entry):
+        return bool(request.if_none_match
+                    and request.if_none_match.contains(entry.etag))
+
+
+response_cache = ResponseCache()
+
+
+def included_tags(type):
+    """Tags of the rows the request's ?include= embeds in a `type` response.
+
+    Embedded rows are tagged by their type (e.g. "users" for
+    include=host), so writes to any row of that type invalidate them.
+    """
+
+    return included_types(request.args, type)
+
+
+def listing_tags(id):
+    """Tags of a response that renders listing `id` in full."""
+
+    return {f'listing:{id}', *included_tags('listings')}
+
+
+def listings_tags():
+    """Tags of a listing list response.
+
+    Pages depend on listings and, through availability search (and the
+    bookings in full=true and ids= responses), on bookings.
+    """
+
+    return {'listings', 'bookings', *included_tags('listings')}
+
+
+def nearby_tags():
+    """Tags of a page of nearby listings."""
+
+    return {'listings', *included_tags('listings')}
+
+
+def messages_tags(id):
+    """Tags of a page of listing `id`'s messages."""
+
+    return {f'messages:{id}', 'messages', *included_tags('messages')}
@@ -0,0 +1,160 @@
+"""Versioned schema migrations.
+
+Migrations are the modules in migrations/, named NNNN_description.py and
+applied in version order. Each defines upgrade(connection); ones that
+can't run inside a transaction, like CREATE INDEX CONCURRENTLY, set
+TRANSACTIONAL = False and run on an autocommit connection. Applied
+versions are recorded in schema_migrations.
+
+    flask db-upgrade        apply pending migrations
+    flask db-status         list migrations and whether they're applied
+"""
+
+import importlib
+import os
+import re
+from collections import namedtuple
+
+import click
+from sqlalchemy import (Column, DateTime, Integer, MetaData, String, Table,
+                        func, select, text)
+
+from models import db
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), 'migrations')
+
+# Held while migrating, so two deploys can't apply the same migration.
+ADVISORY_LOCK_ID = 7_351_202
+
+schema_migrations = Table(
+    'schema_migrations', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('name', String(100), nullable=False),
+    Column('applied_at', DateTime(timezone=True), nullable=False,
+           server_default=func.now()),
+)
+
+Migration = namedtuple('Migration', ['version', 'name', 'module'])
+
+
+def available_migrations():
+    """Every migration in migrations/, oldest first."""
+
+    found = []
+
+    for filename in os.listdir(MIGRATIONS_DIR):
+        match = re.fullmatch(r'(\d{4})_(\w+)\.py', filename)
+        if match:
+            module = importlib.import_module(f'migrations.{filename[:-3]}')
+            found.append(Migration(int(match[1]), match[2], module))
+
+    return sorted(found)
+
+
+def applied_versions(connection):
+    schema_migrations.create(connection, checkfirst=True)
+    return set(connection.scalars(select(schema_migrations.c.version)))
+
+
+def _record(connection, migration):
+    connection.execute(schema_migrations.insert().values(
+        version=migration.version, name=migration.name))
+
+
+def upgrade(engine, echo=print):
+    """Apply pending migrations in order. Returns the versions applied."""
+
+    applied = []
+
+    with engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT') as lock:
+        lock.execute(text("SELECT pg_advisory_lock(:id)"),
+                     {'id': ADVISORY_LOCK_ID})
+        try:
+            with engine.begin() as connection:
+                done = applied_versions(connection)
+
+            for migration in available_migrations():
+                if migration.version in done:
+                    continue
+
+                echo(f"applying {migration.version:04d}_{migration.name}")
+
+                if getattr(migration.module, 'TRANSACTIONAL', True):
+                    with engine.begin() as connection:
+                        migration.module.upgrade(connection)
+                        _record(connection, migration)
+                else:
+                    with engine.connect().execution_options(
+                            isolation_level='AUTOCOMMIT') as connection:
+                        migration.module.upgrade(connection)
+                        _record(connection, migration)
+
+                applied.append(migration.version)
+        finally:
+            lock.execute(text("SELECT pg_advisory_unlock(:id)"),
+                         {'id': ADVISORY_LOCK_ID})
+
+    return applied
+
+
+def stamp(engine):
+    """Mark every migration applied, for a schema made by db.create_all()."""
+
+    with engine.begin() as connection:
+        done = applied_versions(connection)
+
+        for migration in available_migrations():
+            if migration.version not in done:
+                _record(connection, migration)
+
+
+def create_index_concurrently(connection, name, table, columns, using=None,
+                              where=None):
+    """CREATE INDEX CONCURRENTLY, on an autocommit `connection`, without
+    blocking writes to `table`.
+
+    A concurrent build that fails (e.g. it was cancelled) leaves an invalid
+    index behind, which IF NOT EXISTS alone would then keep forever; it is
+    dropped and rebuilt instead.
+    """
+
+    valid = connection.execute(text("""
+        SELECT i.indisvalid
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = :name
+    """), {'name': name}).scalar()
+
+    if valid:
+        return
+
+    if valid is not None:
+        connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+    connection.execute(text(
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table}"
+        f"{f' USING {using}' if using else ''} ({', '.join(columns)})"
+        f"{f' WHERE {where}' if where else ''}"))
+
+
+def init_migrations(app):
+    """Add the db-upgrade and db-status commands to `app`'s CLI."""
+
+    @app.cli.command('db-upgrade')
+    def db_upgrade():
+        """Apply pending schema migrations."""
+
+        applied = upgrade(db.engine, echo=click.echo)
+        click.echo(f"applied {len(applied)} migrations")
+
+    @app.cli.command('db-status')
+    def db_status():
+        """List schema migrations and whether each is applied."""
+
+        with db.engine.begin() as connection:
+            done = applied_versions(connection)
+
+        for migration in available_migrations():
+            state = 'applied' if migration.version in done else 'pending'
+            click.echo(f"{migration.version:04d}_{migration.name}  {state}")
@@ -0,0 +1,226 @@
+import math
+
+from sqlalchemy import and_, cast, func, or_, text
+from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION
+
+from models import db, Listing, Booking
+from pagination import decode_cursor, encode_cursor, InvalidCursor
+
+SEARCH_CONFIG = 'english'
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE_LAT = 111.045
+MAX_RADIUS_KM = 500
+
+_has_trigram = None
+
+
+def has_trigram():
+    """Return True if the pg_trgm extension is installed (checked once)."""
+
+    global _has_trigram
+
+    if _has_trigram is None:
+        _has_trigram = db.session.execute(text(
+            "SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')"
+        )).scalar()
+
+    return _has_trigram
+
+
+def _ranked_page(query, score, limit, mode, position, descending=True):
+    """Keyset-paginate `query` by (score, id).
+
+    Scores sort high to low unless `descending` is False; ties break on id.
+    `query` selects columns including Listing.id (e.g. LISTING_SUMMARY_COLUMNS);
+    each returned row also carries the score as `row.score`.
+    Returns (rows, next_cursor).
+    """
+
+    # ts_rank and similarity return real; a real read back into a Python
+    # float does not compare equal to itself in SQL, so work in doubles.
+    score = cast(score, DOUBLE_PRECISION)
+
+    if position:
+        try:
+            after_score = float(position['score'])
+            after_id = int(position['id'])
+        except (KeyError, TypeError, ValueError):
+            raise InvalidCursor(position)
+
+        past_score = (score < after_score if descending
+                      else score > after_score)
+        query = query.filter(or_(
+            past_score,
+            and_(score == after_score, Listing.id > after_id)))
+
+    rows = (query
+            .add_columns(score.label('score'))
+            .order_by(score.desc() if descending else score, Listing.id)
+            .limit(limit + 1)
+            .all())
+
+    next_cursor = None
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(
+            {'mode': mode, 'score': rows[-1].score, 'id': rows[-1].id})
+
+    return rows, next_cursor
+
+
+def search_listings(query, term, limit, cursor=None):
+    """Full-text search `query` (a query over listings columns) for `term`.
+
+    Matches title, city, state and details through the search_vector GIN
+    index and orders by relevance. When nothing matches and pg_trgm is
+    available, falls back to titles that are similar to `term`, so typos
+    still find something.
+
+    Returns (rows, next_cursor).
+    """
+
+    position = decode_cursor(cursor) if cursor else None
+    mode = position.get('mode', 'fts') if position else 'fts'
+
+    if mode == 'fts':
+        tsquery = func.websearch_to_tsquery(SEARCH_CONFIG, term)
+        rank = func.ts_rank_cd(Listing.search_vector, tsquery)
+
+        rows, next_cursor = _ranked_page(
+            query.filter(Listing.search_vector.op('@@')(tsquery)),
+            rank, limit, 'fts', position)
+
+        if rows or position or not has_trigram():
+            return rows, next_cursor
+
+    elif mode != 'trigram':
+        raise InvalidCursor(cursor)
+
+    similarity = func.similarity(Listing.title, term)
+
+    # `%` is pg_trgm's similarity operator; unlike comparing similarity()
+    # directly, it can use the ix_listings_title_trgm index.
+    rows, next_cursor = _ranked_page(
+        query.filter(Listing.title.op('%')(term)),
+        similarity, limit, 'trigram', position)
+
+    return rows, next_cursor
+
+
+def distance_km(lat, lng):
+    """SQL expression: great-circle (haversine) distance to a listing, in km."""
+
+    dlat = func.radians(Listing.latitude - lat)
+    dlng = func.radians(Listing.longitude - lng)
+
+    a = (func.power(func.sin(dlat / 2), 2)
+         + func.cos(math.radians(lat))
+         * func.cos(func.radians(Listing.latitude))
+         * func.power(func.sin(dlng / 2), 2))
+
+    return 2 * EARTH_RADIUS_KM * func.asin(func.least(1.0, func.sqrt(a)))
+
+
+def parse_bbox(value):
+    """Parse "min_lng,min_lat,max_lng,max_lat" into four floats.
+
+    Raises ValueError if the box is malformed or out of range.
+    """
+
+    min_lng, min_lat, max_lng, max_lat = (float(part)
+                                          for part in value.split(','))
+
+    if not (-180 <= min_lng <= 180 and -180 <= max_lng <= 180
+            and -90 <= min_lat <= max_lat <= 90):
+        raise ValueError(value)
+
+    return min_lng, min_lat, max_lng, max_lat
+
+
+def within_bbox(query, min_lng, min_lat, max_lng, max_lat):
+    """Filter `query` to listings inside a bounding box.
+
+    A box whose min_lng is greater than its max_lng crosses the
+    antimeridian. The latitude range is served by the
+    ix_listings_latitude_longitude index.
+    """
+
+    query = query.filter(Listing.latitude.between(min_lat, max_lat))
+
+    if min_lng <= max_lng:
+        return query.filter(Listing.longitude.between(min_lng, max_lng))
+
+    return query.filter(or_(Listing.longitude >= min_lng,
+                            Listing.longitude <= max_lng))
+
+
+def available_between(query, check_in, check_out):
+    """Filter `query` to listings with no booking overlapping the stay.
+
+    A booking overlaps when it starts before `check_out` and ends after
+    `check_in`, so back-to-back stays are allowed. Runs as one NOT EXISTS
+    anti-join probing ix_bookings_property_id_dates per listing.
+    """
+
+    overlapping = (db.session.query(Booking.id)
+                   .filter(Booking.property_id == Listing.id,
+                           Booking.check_in_date < check_out,
+                           Booking.check_out_date > check_in)
+                   .exists())
+
+    return query.filter(~overlapping)
+
+
+def price_between(query, min_price=None, max_price=None):
+    """Filter `query` to listings priced per night within the given bounds."""
+
+    if min_price is not None:
+        query = query.filter(Listing.price_per_night >= min_price)
+
+    if max_price is not None:
+        query = query.filter(Listing.price_per_night <= max_price)
+
+    return query
+
+
+def nearby_listings(query, lat, lng, radius_km, limit, cursor=None):
+    """Listings in `query` within `radius_km` of (lat, lng), nearest first.
+
+    The circle's bounding box narrows rows through the (latitude, longitude)
+    index before the exact haversine distance is computed, so only nearby
+    rows are ever scored.
+
+    Returns (rows, next_cursor), with each row's distance in km as `row.score`.
+    """
+
+    position = decode_cursor(cursor) if cursor else None
+
+    if position and position.get('mode') != 'nearby':
+        raise InvalidCursor(cursor)
+
+    dlat = radius_km / KM_PER_DEGREE_LAT
+    min_lat, max_lat = max(lat - dlat, -90.0), min(lat + dlat, 90.0)
+
+    if max_lat >= 90 or min_lat <= -90:
+        # The circle covers a pole, so it spans every longitude.
+        min_lng, max_lng = -180.0, 180.0
+    else:
+        # Degrees of longitude shrink toward the poles, so size the box for
+        # the edge of the circle nearest a pole.
+        smallest_cos = min(math.cos(math.radians(max_lat)),
+                           math.cos(math.radians(min_lat)))
+        dlng = dlat / smallest_cos
+        if dlng >= 180:
+            min_lng, max_lng = -180.0, 180.0
+        else:
+            min_lng = (lng - dlng + 540) % 360 - 180
+            max_lng = (lng + dlng + 540) % 360 - 180
+
+    distance = distance_km(lat, lng)
+    query = within_bbox(query, min_lng, min_lat, max_lng, max_lat)
+
+    return _ranked_page(
+        query.filter(distance <= radius_km),
+        distance, limit, 'nearby', position, descending=False)
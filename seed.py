@@ -2,9 +2,11 @@
 
 from app import app
 from models import  db, Listing, User, Message, Booking
+from schemaMigrations import stamp
 
 db.drop_all()
 db.create_all()
+stamp(db.engine)
 
 u1 = User(
     username="testuser1",